@@ -0,0 +1,120 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import quota
+
+
+class AsyncCurrencyClient:
+    """
+    Асинхронная обертка над CurrencyClient с объединением одинаковых запросов (single-flight).
+
+    Все запросы выполняются в одном цикле asyncio, работающем в отдельном потоке.
+    Если такой же запрос (endpoint + параметры) уже выполняется, новый вызов не идет
+    в сеть, а ждет результата первого: N одновременных запросов курса RUB -> THB
+    дают ровно один запрос к API. Сам HTTP-запрос выполняется синхронным клиентом
+    (пул соединений, таймауты, повторы) в пуле потоков, поэтому несколько разных
+    запросов идут параллельно.
+
+    Квоту расходуют HTTP-попытки самого клиента (см. QuotaManager.before_request);
+    здесь для них задается полоса priority. Объединенные запросы квоту не расходуют.
+
+    Для синхронного кода (обработчики telebot) есть фасад get_sync() / run().
+    """
+
+    def __init__(self, client, max_concurrency=8):
+        """
+        Args:
+            client: CurrencyClient (или другой источник курсов с методом get), выполняющий запросы
+            max_concurrency: Сколько запросов к API может выполняться одновременно
+        """
+        self._client = client
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="currency-http")
+        self._inflight = {}
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    async def get(self, endpoint, params=None, required=(), priority=None):
+        """
+        Асинхронный запрос к endpoint; одинаковые одновременные запросы объединяются.
+        priority — полоса квоты (quota.INTERACTIVE или quota.BACKGROUND) для HTTP-попыток этого запроса.
+        """
+        params = dict(params or {})
+        key = (endpoint, tuple(sorted(params.items())), tuple(required))
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            # shield: отмена одного ожидающего не должна отменять общий запрос
+            return await asyncio.shield(pending)
+
+        loop = asyncio.get_running_loop()
+        pending = loop.create_future()
+        self._inflight[key] = pending
+        self.upstream_calls += 1
+        try:
+            result = await loop.run_in_executor(
+                self._executor, functools.partial(self._call, endpoint, params, required, priority)
+            )
+        except Exception as exc:
+            pending.set_exception(exc)
+            # Исключение уже передается вызывающему — помечаем его как полученное
+            pending.exception()
+            raise
+        else:
+            pending.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+
+    def _call(self, endpoint, params, required, priority):
+        with quota.request_priority(priority or quota.INTERACTIVE):
+            return self._client.get(endpoint, params, required=required)
+
+    async def get_many(self, requests, priority=None):
+        """
+        Выполнить несколько запросов одновременно.
+
+        Args:
+            requests: Список кортежей (endpoint, params, required)
+            priority: Полоса квоты для всех запросов
+
+        Returns:
+            Список результатов в том же порядке; на месте неудачных запросов — исключение
+        """
+        return await asyncio.gather(
+            *(self.get(endpoint, params, required, priority) for endpoint, params, required in requests),
+            return_exceptions=True,
+        )
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="currency-async", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro):
+        """Выполнить корутину в цикле клиента и дождаться результата (из любого потока)"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop()).result()
+
+    def get_sync(self, endpoint, params=None, required=(), priority=None):
+        """Синхронный фасад для get()"""
+        return self.run(self.get(endpoint, params, required, priority))
+
+    def get_many_sync(self, requests, priority=None):
+        """Синхронный фасад для get_many()"""
+        return self.run(self.get_many(requests, priority))
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join()
+            loop.close()
+        self._executor.shutdown(wait=False)
@@ -1,10 +1,12 @@
 import telebot
 from telebot import types
-import sqlite3
 import os
 from dotenv import load_dotenv
 import current_api as api_client
 import database
+import dispatcher
+import rate_refresher
+import state_store
 import visualization
 
 load_dotenv()
@@ -12,16 +14,27 @@ load_dotenv()
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 bot = telebot.TeleBot(TOKEN)
 
+# Telegram ID пользователей, которым доступна служебная команда /apistats (через запятую)
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
+# Все обновления разбирает один маршрутизатор: тексты меню и команды ищутся в словаре,
+# callback_data — в префиксном дереве, шаги диалога — в таблице шаг -> обработчик
+router = dispatcher.Router(lambda user_id: user_data.get(user_id))
+router.install(bot)
+
+# Размеры страниц истории и списка расходов для редактирования
+HISTORY_PAGE_SIZE = 10
+EDIT_LIST_PAGE_SIZE = 20
+
 # --- Database Helpers ---
 
 def get_db_connection():
     """
-    Создает соединение с базой данных SQLite.
-    Возвращает объект соединения с установленным row_factory для доступа к полям по имени.
+    Возвращает долгоживущее соединение с базой данных SQLite для текущего потока.
+    Соединение берется из пула database.py (row_factory и PRAGMA уже настроены),
+    поэтому закрывать его после использования не нужно.
     """
-    conn = sqlite3.connect('travel_bot.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return database.get_connection()
 
 def get_user_active_trip(user_id):
     """
@@ -33,17 +46,37 @@ def get_user_active_trip(user_id):
     Returns:
         Словарь с информацией о путешествии и его валютах или None, если нет активного путешествия
     """
+    # Контекст путешествия кэшируется в database.py и сбрасывается при его изменении
+    return database.get_active_trip(user_id)
+
+def get_user_trip(user_id, trip_id):
+    """
+    Получает путешествие пользователя по ID вместе с его валютами.
+    Обычно это активное путешествие, и тогда оно берется из кэша без обращения к базе.
+    
+    Args:
+        user_id: ID пользователя в Telegram
+        trip_id: ID путешествия
+    
+    Returns:
+        Словарь с информацией о путешествии и его валютах или None, если путешествие не найдено
+    """
+    trip = get_user_active_trip(user_id)
+    if trip and trip['trip_id'] == trip_id:
+        return trip
     conn = get_db_connection()
-    user = conn.execute('SELECT active_trip_id FROM users WHERE user_id = ?', (user_id,)).fetchone()
-    if user and user['active_trip_id']:
-        trip = conn.execute('SELECT * FROM trips WHERE trip_id = ?', (user['active_trip_id'],)).fetchone()
-        # Get all currencies for this trip
-        currencies = conn.execute('SELECT * FROM trip_currencies WHERE trip_id = ?', (user['active_trip_id'],)).fetchall()
-        trip_dict = dict(trip)
-        trip_dict['currencies'] = currencies
-        conn.close()
-        return trip_dict
-    conn.close()
+    trip = conn.execute('SELECT * FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
+    if not trip:
+        return None
+    trip_dict = dict(trip)
+    trip_dict['currencies'] = conn.execute('SELECT * FROM trip_currencies WHERE trip_id = ?', (trip_id,)).fetchall()
+    return trip_dict
+
+def find_trip_currency(trip, currency_code):
+    """Находит валюту путешествия по коду среди trip['currencies'] или возвращает None"""
+    for currency in trip['currencies']:
+        if currency['currency_code'] == currency_code:
+            return currency
     return None
 
 def add_currency_to_trip(trip_id, currency_code, balance, exchange_rate_to_home):
@@ -56,14 +89,7 @@ def add_currency_to_trip(trip_id, currency_code, balance, exchange_rate_to_home)
         balance: Баланс в этой валюте
         exchange_rate_to_home: Курс обмена относительно домашней валюты
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO trip_currencies (trip_id, currency_code, balance, exchange_rate_to_home)
-        VALUES (?, ?, ?, ?)
-    ''', (trip_id, currency_code, balance, exchange_rate_to_home))
-    conn.commit()
-    conn.close()
+    database.add_trip_currency(trip_id, currency_code, balance, exchange_rate_to_home)
 
 def set_active_trip(user_id, trip_id):
     """
@@ -73,11 +99,7 @@ def set_active_trip(user_id, trip_id):
         user_id: ID пользователя в Telegram
         trip_id: ID путешествия, которое нужно сделать активным
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO users (user_id, active_trip_id) VALUES (?, ?)', (user_id, trip_id))
-    conn.commit()
-    conn.close()
+    database.set_active_trip(user_id, trip_id)
 
 # --- Keyboards ---
 
@@ -128,7 +150,7 @@ def inline_confirm_expense_multi(amount, currency_code, trip_id):
 
 # --- Handlers ---
 
-@bot.message_handler(commands=['start', 'menu'])
+@router.text("/start", "/menu")
 def send_welcome(message):
     """
     Обработчик команд /start и /menu.
@@ -151,15 +173,33 @@ def send_welcome(message):
 
 # --- Create Trip Flow ---
 
-user_data = {} # Temporary storage for trip creation state
+# Состояние диалогов пользователей (шаги создания путешествия, temp_expense_data, редактирование).
+# Хранилище выбирается переменной окружения FSM_STORAGE: memory (по умолчанию) или sqlite.
+user_data = state_store.create_state_store()
+
+@router.error(state_store.StateExpiredError)
+def dialog_state_expired(update, exc):
+    """
+    Состояние диалога истекло (FSM_STATE_TTL) или было удалено, пока пользователь
+    отвечал на шаг: вместо ошибки просим начать действие заново.
+    """
+    text = "⌛ Этот диалог устарел. Начните действие заново из меню."
+    if isinstance(update, types.CallbackQuery):
+        bot.answer_callback_query(update.id, text)
+        bot.send_message(update.message.chat.id, text, reply_markup=main_menu_keyboard())
+    else:
+        bot.send_message(update.chat.id, text, reply_markup=main_menu_keyboard())
+
+# Курсы активных путешествий с политикой "auto" обновляются одним снимком на все путешествия
+trip_rate_refresher = rate_refresher.TripRateRefresher(api_client.get_snapshot_rates)
 
-@bot.message_handler(func=lambda message: message.text == "🆕 Создать новое путешествие" or message.text == "/newtrip")
+@router.text("🆕 Создать новое путешествие", "/newtrip")
 def start_new_trip(message):
     user_id = message.from_user.id
     user_data[user_id] = {'step': 'home_country'}
     bot.send_message(message.chat.id, "Откуда вы выезжаете? (Введите название страны, например: Россия, США, Германия)")
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'home_country')
+@router.step("home_country")
 def process_home_country(message):
     user_id = message.from_user.id
     country = message.text
@@ -174,19 +214,34 @@ def process_home_country(message):
         user_data[user_id]['step'] = 'target_country'
         bot.send_message(message.chat.id, f"💰 Валюта: {currency}. \n\nКуда вы направляетесь?")
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'home_currency_manual')
+def check_currency_code(chat_id, currency):
+    """
+    Проверить код валюты по каталогу поддерживаемых валют (без запроса к API).
+    Если код неизвестен — отправить подсказку и вернуть False.
+    """
+    if len(currency) != 3 or not currency.isalpha():
+        bot.send_message(chat_id, "Код валюты должен состоять из 3 букв. Попробуйте еще раз:")
+        return False
+    if api_client.currency_catalog.is_supported(currency):
+        return True
+    suggestions = api_client.currency_catalog.suggest(currency)
+    text = f"Валюта {currency} не найдена."
+    if suggestions:
+        text += f" Возможно, вы имели в виду: {', '.join(suggestions)}?"
+    bot.send_message(chat_id, text + " Попробуйте еще раз:")
+    return False
+
+@router.step("home_currency_manual")
 def process_home_currency_manual(message):
     user_id = message.from_user.id
-    currency = message.text.upper()
-    # Simple validation
-    if len(currency) != 3:
-        bot.send_message(message.chat.id, "Код валюты должен состоять из 3 букв. Попробуйте еще раз:")
+    currency = message.text.strip().upper()
+    if not check_currency_code(message.chat.id, currency):
         return
     user_data[user_id]['home_currency'] = currency
     user_data[user_id]['step'] = 'target_country'
     bot.send_message(message.chat.id, "Принято. Куда вы направляетесь?")
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'target_country')
+@router.step("target_country")
 def process_target_country(message):
     user_id = message.from_user.id
     country = message.text
@@ -201,12 +256,11 @@ def process_target_country(message):
         user_data[user_id]['target_country_name'] = country
         fetch_rate_and_ask(message)
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'target_currency_manual')
+@router.step("target_currency_manual")
 def process_target_currency_manual(message):
     user_id = message.from_user.id
-    currency = message.text.upper()
-    if len(currency) != 3:
-        bot.send_message(message.chat.id, "Код валюты должен состоять из 3 букв. Попробуйте еще раз:")
+    currency = message.text.strip().upper()
+    if not check_currency_code(message.chat.id, currency):
         return
     user_data[user_id]['target_currency'] = currency
     user_data[user_id]['target_country_name'] = currency # Use code as name if unknown
@@ -232,45 +286,55 @@ def fetch_rate_and_ask(message):
         )
         return
     
-    rate = api_client.get_exchange_rate(home_cur, target_cur)
+    quote = api_client.lookup_rate(home_cur, target_cur)
     
-    if rate is None:
+    if quote is None:
         bot.send_message(message.chat.id, f"Не удалось получить курс для пары {home_cur} -> {target_cur}. Пожалуйста, введите курс вручную (сколько {target_cur} дают за 1 {home_cur}):")
         user_data[user_id]['step'] = 'manual_rate'
     else:
+        rate = quote.rate
         user_data[user_id]['rate'] = rate
         markup = types.InlineKeyboardMarkup()
         markup.add(
             types.InlineKeyboardButton("Да, подходит", callback_data="rate_ok"),
             types.InlineKeyboardButton("Нет, введу сам", callback_data="rate_manual")
         )
-        bot.send_message(message.chat.id, f"Текущий курс: 1 {home_cur} = {rate} {target_cur}. Подходит?", reply_markup=markup)
-
-@bot.callback_query_handler(func=lambda call: call.data == "rate_ok")
+        text = f"Текущий курс: 1 {home_cur} = {rate} {target_cur}. Подходит?"
+        if quote.stale:
+            # API сейчас не ответило — показываем последний известный курс
+            minutes = max(int(quote.age // 60), 1)
+            text = (f"Последний известный курс: 1 {home_cur} = {rate} {target_cur} ({minutes} мин назад).\n"
+                    f"⚠️ Сервис курсов сейчас недоступен, курс может быть неточным. Подходит?")
+        bot.send_message(message.chat.id, text, reply_markup=markup)
+
+@router.callback("rate_ok")
 def rate_ok_callback(call):
     user_id = call.from_user.id
     user_data[user_id]['step'] = 'initial_balance'
+    # Курс взят с рынка — пусть и дальше следует за рынком
+    user_data[user_id]['rate_policy'] = database.RATE_POLICY_AUTO
     bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=f"Отлично. Курс 1 {user_data[user_id]['home_currency']} = {user_data[user_id]['rate']} {user_data[user_id]['target_currency']} подтвержден.")
     bot.send_message(call.message.chat.id, f"Какую сумму в {user_data[user_id]['home_currency']} вы берете с собой?")
 
-@bot.callback_query_handler(func=lambda call: call.data == "rate_manual")
+@router.callback("rate_manual")
 def rate_manual_callback(call):
     user_id = call.from_user.id
     user_data[user_id]['step'] = 'manual_rate'
     bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text="Хорошо, введите курс обмена вручную (сколько единиц валюты назначения дают за 1 единицу домашней валюты):")
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'manual_rate')
+@router.step("manual_rate")
 def process_manual_rate(message):
     try:
         rate = float(message.text.replace(',', '.'))
         user_id = message.from_user.id
         user_data[user_id]['rate'] = rate
+        user_data[user_id]['rate_policy'] = database.RATE_POLICY_PINNED
         user_data[user_id]['step'] = 'initial_balance'
         bot.send_message(message.chat.id, f"Курс установлен: 1 {user_data[user_id]['home_currency']} = {rate} {user_data[user_id]['target_currency']}. Какую сумму в {user_data[user_id]['home_currency']} вы берете с собой?")
     except ValueError:
         bot.send_message(message.chat.id, "Пожалуйста, введите число.")
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'initial_balance')
+@router.step("initial_balance")
 def process_initial_balance(message):
     try:
         home_amount = float(message.text.replace(',', '.'))
@@ -294,7 +358,7 @@ def process_initial_balance(message):
     except ValueError:
         bot.send_message(message.chat.id, "Пожалуйста, введите число.")
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'budget_limit')
+@router.step("budget_limit")
 def process_budget_limit(message):
     try:
         budget_limit = float(message.text.replace(',', '.'))
@@ -325,15 +389,11 @@ def process_budget_limit(message):
 
 def continue_trip_creation(user_id, chat_id):
     """Продолжает создание путешествия после установки бюджетов"""
-    # Создаем путешествие в базе данных
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Создаем путешествие вместе с основной валютой и делаем его активным
     target_initial_amount = user_data[user_id]['home_initial_amount'] * user_data[user_id]['rate']
+    rate_policy = user_data[user_id].get('rate_policy', database.RATE_POLICY_PINNED)
     
-    cursor.execute('''
-        INSERT INTO trips (user_id, name, home_currency, target_currency, exchange_rate, home_balance, target_balance, budget_limit, notification_threshold)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
+    database.create_trip(
         user_id,
         user_data[user_id]['target_country_name'],
         user_data[user_id]['home_currency'],
@@ -342,30 +402,21 @@ def continue_trip_creation(user_id, chat_id):
         user_data[user_id]['home_initial_amount'],
         target_initial_amount,
         user_data[user_id]['budget_limit'],
-        user_data[user_id]['notification_threshold']
-    ))
-    
-    trip_id = cursor.lastrowid
-    conn.commit()
-    
-    # Добавляем основную валюту путешествия
-    add_currency_to_trip(trip_id, user_data[user_id]['target_currency'], target_initial_amount, user_data[user_id]['rate'])
-    
-    conn.close()
-    
-    # Устанавливаем это путешествие как активное
-    set_active_trip(user_id, trip_id)
+        user_data[user_id]['notification_threshold'],
+        rate_policy,
+    )
     
+    rate_note = " (обновляется автоматически)" if rate_policy == database.RATE_POLICY_AUTO else ""
     bot.send_message(chat_id, f"🎉 Путешествие '{user_data[user_id]['target_country_name']}' создано!\n"
                      f"Начальный баланс: {target_initial_amount:.2f} {user_data[user_id]['target_currency']} = {user_data[user_id]['home_initial_amount']:.2f} {user_data[user_id]['home_currency']}\n"
-                     f"Курс: 1 {user_data[user_id]['home_currency']} = {user_data[user_id]['rate']} {user_data[user_id]['target_currency']}")
+                     f"Курс: 1 {user_data[user_id]['home_currency']} = {user_data[user_id]['rate']} {user_data[user_id]['target_currency']}{rate_note}")
     
     # Очищаем данные пользователя
     if user_id in user_data:
         del user_data[user_id]
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "set_category_budgets_yes")
+@router.callback("set_category_budgets_yes")
 def handle_category_budgets_yes(call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
@@ -382,7 +433,7 @@ def handle_category_budgets_yes(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "set_category_budgets_no")
+@router.callback("set_category_budgets_no")
 def handle_category_budgets_no(call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
@@ -397,11 +448,10 @@ def handle_category_budgets_no(call):
 
 # --- My Trips & Switch ---
 
-@bot.message_handler(func=lambda message: message.text == "🌍 Мои путешествия" or message.text == "/switch")
+@router.text("🌍 Мои путешествия", "/switch")
 def list_trips(message):
     conn = get_db_connection()
     trips = conn.execute('SELECT * FROM trips WHERE user_id = ?', (message.from_user.id,)).fetchall()
-    conn.close()
     
     if not trips:
         bot.send_message(message.chat.id, "У вас пока нет созданных путешествий. Нажмите '🆕 Создать новое путешествие'.")
@@ -414,11 +464,10 @@ def list_trips(message):
     bot.send_message(message.chat.id, "Выберите активное путешествие:", reply_markup=markup)
 
 
-@bot.message_handler(func=lambda message: message.text == "🗑 Удалить путешествие")
+@router.text("🗑 Удалить путешествие")
 def delete_trip_prompt(message):
     conn = get_db_connection()
     trips = conn.execute('SELECT * FROM trips WHERE user_id = ?', (message.from_user.id,)).fetchall()
-    conn.close()
     
     if not trips:
         bot.send_message(message.chat.id, "У вас пока нет созданных путешествий.")
@@ -431,7 +480,7 @@ def delete_trip_prompt(message):
     bot.send_message(message.chat.id, "Выберите путешествие для удаления:", reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("delete_trip_"))
+@router.callback_prefix("delete_trip_")
 def confirm_delete_trip_callback(call):
     trip_id = int(call.data.split('_')[2])
     
@@ -450,7 +499,7 @@ def confirm_delete_trip_callback(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("confirm_delete_"))
+@router.callback_prefix("confirm_delete_")
 def delete_trip_callback(call):
     trip_id = int(call.data.split('_')[2])
     
@@ -459,18 +508,9 @@ def delete_trip_callback(call):
     trip = conn.execute('SELECT name FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
     
     if trip:
-        # Удаляем путешествие и все связанные данные
+        # Удаляем путешествие и все связанные данные (в том числе сбрасываем его как активное)
         database.delete_trip(trip_id)
         
-        # Проверяем, не является ли это активным путешествием у пользователя
-        user_active_trip = conn.execute('SELECT active_trip_id FROM users WHERE user_id = ?', (call.from_user.id,)).fetchone()
-        if user_active_trip and user_active_trip['active_trip_id'] == trip_id:
-            # Если это было активное путешествие, сбрасываем его
-            conn.execute('UPDATE users SET active_trip_id = NULL WHERE user_id = ?', (call.from_user.id,))
-        
-        conn.commit()
-        conn.close()
-        
         bot.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
@@ -484,7 +524,7 @@ def delete_trip_callback(call):
         )
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "cancel_delete")
+@router.callback("cancel_delete")
 def cancel_delete_callback(call):
     bot.edit_message_text(
         chat_id=call.message.chat.id,
@@ -492,20 +532,19 @@ def cancel_delete_callback(call):
         text="❌ Удаление отменено."
     )
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("switch_"))
+@router.callback_prefix("switch_")
 def switch_trip_callback(call):
     trip_id = int(call.data.split('_')[1])
     set_active_trip(call.from_user.id, trip_id)
     
     conn = get_db_connection()
     trip = conn.execute('SELECT name FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
-    conn.close()
     
     bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=f"Активное путешествие переключено на: {trip['name']}")
 
 # --- Balance ---
 
-@bot.message_handler(func=lambda message: message.text == "💰 Баланс" or message.text == "/balance")
+@router.text("💰 Баланс", "/balance")
 def show_balance(message):
     trip = get_user_active_trip(message.from_user.id)
     if not trip:
@@ -526,8 +565,7 @@ def show_balance(message):
     
     # Add budget information if set
     if trip['budget_limit'] > 0:
-        spent_result = get_db_connection().execute('SELECT SUM(amount_home) as total_spent FROM expenses WHERE trip_id = ?', (trip['trip_id'],)).fetchone()
-        total_spent = spent_result['total_spent'] or 0
+        total_spent = database.get_trip_total_spent(trip['trip_id'])
         remaining_budget = trip['budget_limit'] - (total_spent * trip['exchange_rate'])
         percentage_spent = min((total_spent * trip['exchange_rate']) / trip['budget_limit'] * 100, 100)
         
@@ -551,35 +589,128 @@ def show_balance(message):
 
 # --- History ---
 
-@bot.message_handler(func=lambda message: message.text == "📜 История расходов" or message.text == "/history")
+@router.text("📜 История расходов", "/history")
 def show_history(message):
     trip = get_user_active_trip(message.from_user.id)
     if not trip:
         bot.send_message(message.chat.id, "Сначала выберите или создайте путешествие.")
         return
     
-    conn = get_db_connection()
-    expenses = conn.execute('SELECT * FROM expenses WHERE trip_id = ? ORDER BY timestamp DESC LIMIT 10', (trip['trip_id'],)).fetchall()
-    conn.close()
+    page = database.get_expenses_page(trip['trip_id'], HISTORY_PAGE_SIZE)
     
-    if not expenses:
+    if not page['expenses']:
         bot.send_message(message.chat.id, "В этом путешествии еще нет расходов.")
         return
     
-    text = f"Последние 10 расходов ({trip['name']}):\n\n"
-    for exp in expenses:
-        # Получаем имя категории
-        category = database.get_all_categories()[exp['category_id']-1]['name']
+    text, markup = render_history_page(trip, page)
+    bot.send_message(message.chat.id, text, reply_markup=markup)
+
+
+@router.callback_prefix("hist_")
+def history_page_callback(call):
+    """Листание истории расходов кнопками «Новее» / «Старше»"""
+    trip = get_user_active_trip(call.from_user.id)
+    if not trip:
+        bot.answer_callback_query(call.id, "Ошибка: активное путешествие не найдено")
+        return
+    
+    page = load_expenses_page(trip['trip_id'], HISTORY_PAGE_SIZE, call.data[len("hist_"):])
+    if not page['expenses']:
+        bot.answer_callback_query(call.id, "В этом путешествии еще нет расходов.")
+        return
+    
+    text, markup = render_history_page(trip, page)
+    bot.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=text,
+        reply_markup=markup
+    )
+    bot.answer_callback_query(call.id)
+
+
+def load_expenses_page(trip_id, limit, token):
+    """
+    Загружает страницу расходов по курсору из callback_data.
+    
+    Args:
+        trip_id: ID путешествия
+        limit: Размер страницы
+        token: Строка вида "o_<курсор>" (старше курсора) или "n_<курсор>" (новее курсора)
+    
+    Returns:
+        Страница из database.get_expenses_page; если по курсору ничего не нашлось
+        (например, расходы удалены), возвращается самая новая страница
+    """
+    direction, _, cursor = token.partition("_")
+    try:
+        position = database.decode_page_cursor(cursor)
+    except (ValueError, IndexError):
+        position = None
+    
+    if position is None:
+        page = database.get_expenses_page(trip_id, limit)
+    elif direction == "n":
+        page = database.get_expenses_page(trip_id, limit, after=position)
+    else:
+        page = database.get_expenses_page(trip_id, limit, before=position)
+    
+    if not page['expenses'] and position is not None:
+        page = database.get_expenses_page(trip_id, limit)
+    return page
+
+
+def page_navigation_buttons(prefix, page):
+    """
+    Создает кнопки навигации для страницы расходов.
+    
+    Args:
+        prefix: Префикс callback_data (например: "hist_")
+        page: Страница из database.get_expenses_page
+    
+    Returns:
+        Список кнопок «Новее» / «Старше» (может быть пустым)
+    """
+    buttons = []
+    expenses = page['expenses']
+    if page['has_newer']:
+        buttons.append(types.InlineKeyboardButton(
+            "⬅️ Новее", callback_data=f"{prefix}n_{database.encode_page_cursor(expenses[0])}"))
+    if page['has_older']:
+        buttons.append(types.InlineKeyboardButton(
+            "Старше ➡️", callback_data=f"{prefix}o_{database.encode_page_cursor(expenses[-1])}"))
+    return buttons
+
+
+def render_history_page(trip, page):
+    """
+    Формирует текст и клавиатуру навигации для страницы истории расходов.
+    
+    Args:
+        trip: Словарь с информацией о путешествии
+        page: Страница из database.get_expenses_page
+    
+    Returns:
+        Кортеж (текст, InlineKeyboardMarkup или None)
+    """
+    text = f"История расходов ({trip['name']}):\n\n"
+    for exp in page['expenses']:
+        category = exp['category_name'] or 'Прочее'
         text += f"- {exp['amount_target']:.2f} {exp['currency_target']} ({exp['amount_home']:.2f} {exp['currency_home']})\n"
         text += f"  Категория: {category}\n"
         text += f"  Дата: {exp['timestamp'][:16]}\n\n"
     
-    bot.send_message(message.chat.id, text)
+    buttons = page_navigation_buttons("hist_", page)
+    markup = None
+    if buttons:
+        markup = types.InlineKeyboardMarkup()
+        markup.row(*buttons)
+    return text, markup
 
 
 # --- Visualization ---
 
-@bot.message_handler(func=lambda message: message.text == "📈 Графики расходов")
+@router.text("📈 Графики расходов")
 def show_charts_menu(message):
     """
     Показывает меню выбора типа графика.
@@ -614,7 +745,7 @@ def show_charts_menu(message):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("chart_"))
+@router.callback_prefix("chart_")
 def handle_chart_request(call):
     """
     Обрабатывает запросы на создание графиков.
@@ -714,7 +845,7 @@ def handle_chart_request(call):
         bot.send_message(call.message.chat.id, f"Произошла ошибка при создании графика. Попробуйте позже.")
 
 
-@bot.message_handler(func=lambda message: message.text == "✏️ Редактировать расходы")
+@router.text("✏️ Редактировать расходы")
 def edit_expenses_menu(message):
     """Показать список расходов для редактирования"""
     trip = get_user_active_trip(message.from_user.id)
@@ -722,21 +853,50 @@ def edit_expenses_menu(message):
         bot.send_message(message.chat.id, "Сначала выберите или создайте путешествие.")
         return
     
-    expenses = database.get_expenses_by_category(trip['trip_id'])
+    page = database.get_expenses_page(trip['trip_id'], EDIT_LIST_PAGE_SIZE)
     
-    if not expenses:
+    if not page['expenses']:
         bot.send_message(message.chat.id, "В этом путешествии еще нет расходов.")
         return
     
-    # Показываем последние 20 расходов с кнопками редактирования
-    text = f"Выберите расход для редактирования ({trip['name']}):\n\n"
+    bot.send_message(message.chat.id, "Выберите расход для редактирования:", reply_markup=edit_list_markup(page))
+
+
+@router.callback_prefix("edit_pg_")
+def edit_list_page_callback(call):
+    """Листание списка расходов для редактирования"""
+    trip = get_user_active_trip(call.from_user.id)
+    if not trip:
+        bot.answer_callback_query(call.id, "Ошибка: активное путешествие не найдено")
+        return
+    
+    page = load_expenses_page(trip['trip_id'], EDIT_LIST_PAGE_SIZE, call.data[len("edit_pg_"):])
+    if not page['expenses']:
+        bot.answer_callback_query(call.id, "В этом путешествии еще нет расходов.")
+        return
+    
+    bot.edit_message_reply_markup(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=edit_list_markup(page)
+    )
+    bot.answer_callback_query(call.id)
+
+
+def edit_list_markup(page):
+    """
+    Создает клавиатуру со страницей расходов для редактирования.
+    
+    Args:
+        page: Страница из database.get_expenses_page
+    
+    Returns:
+        InlineKeyboardMarkup с кнопкой на каждый расход, навигацией и кнопкой «Назад»
+    """
     markup = types.InlineKeyboardMarkup()
     
-    # Ограничиваем до 20 расходов для удобства
-    for exp in expenses[:20]:
-        category_name = exp.get('category_name', 'Прочее')
+    for exp in page['expenses']:
         date_str = exp['timestamp'][:16] if exp['timestamp'] else 'Неизвестно'
-        text_line = f"{exp['amount_target']:.2f} {exp['currency_target']} - {category_name} ({date_str})"
         
         # Создаем кнопку для каждого расхода
         btn_text = f"{exp['amount_target']:.2f} {exp['currency_target']} ({date_str[:10]})"
@@ -748,12 +908,14 @@ def edit_expenses_menu(message):
             callback_data=f"edit_exp_{exp['expense_id']}"
         ))
     
+    buttons = page_navigation_buttons("edit_pg_", page)
+    if buttons:
+        markup.row(*buttons)
     markup.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_to_main"))
-    
-    bot.send_message(message.chat.id, "Выберите расход для редактирования:", reply_markup=markup)
+    return markup
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("edit_exp_amount_"))
+@router.callback_prefix("edit_exp_amount_")
 def edit_expense_amount_prompt(call):
     """Запросить новую сумму расхода"""
     try:
@@ -785,7 +947,7 @@ def edit_expense_amount_prompt(call):
     bot.answer_callback_query(call.id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("edit_exp_category_"))
+@router.callback_prefix("edit_exp_category_")
 def edit_expense_category_prompt(call):
     """Запросить новую категорию расхода"""
     try:
@@ -818,7 +980,7 @@ def edit_expense_category_prompt(call):
     bot.answer_callback_query(call.id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("edit_exp_") and not call.data.startswith("edit_exp_amount_") and not call.data.startswith("edit_exp_category_"))
+@router.callback_prefix("edit_exp_")
 def select_expense_to_edit(call):
     """Обработчик выбора расхода для редактирования"""
     try:
@@ -872,7 +1034,7 @@ def select_expense_to_edit(call):
     bot.answer_callback_query(call.id)
 
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'editing_expense_amount')
+@router.step("editing_expense_amount")
 def process_expense_amount_edit(message):
     """Обработать новую сумму расхода"""
     try:
@@ -911,12 +1073,7 @@ def process_expense_amount_edit(message):
     else:
         # Используем курс из расхода (если мультивалютность)
         # Находим курс для этой валюты
-        conn = get_db_connection()
-        currency_row = conn.execute('''
-            SELECT exchange_rate_to_home FROM trip_currencies 
-            WHERE trip_id = ? AND currency_code = ?
-        ''', (trip['trip_id'], expense['currency_target'])).fetchone()
-        conn.close()
+        currency_row = find_trip_currency(trip, expense['currency_target'])
         
         if currency_row:
             exchange_rate = currency_row['exchange_rate_to_home']
@@ -953,7 +1110,7 @@ def process_expense_amount_edit(message):
 
 
 
-@bot.callback_query_handler(func=lambda call: call.from_user.id in user_data and user_data[call.from_user.id].get('step') == 'editing_expense_category' and call.data.startswith('cat_'))
+@router.callback_prefix("cat_", step="editing_expense_category")
 def process_expense_category_edit(call):
     """Обработать новую категорию расхода"""
     try:
@@ -976,8 +1133,8 @@ def process_expense_category_edit(call):
         return
     
     # Проверяем валидность категории
-    categories = database.get_all_categories()
-    if new_category_id < 1 or new_category_id > len(categories):
+    category = database.get_category(new_category_id)
+    if not category:
         bot.answer_callback_query(call.id, "Ошибка: категория не найдена")
         return
     
@@ -990,7 +1147,7 @@ def process_expense_category_edit(call):
     )
     
     if success:
-        category_name = categories[new_category_id-1]['name']
+        category_name = category['name']
         bot.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
@@ -1005,7 +1162,13 @@ def process_expense_category_edit(call):
         del user_data[user_id]
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("delete_exp_"))
+@router.step("editing_expense_category")
+def remind_expense_category(message):
+    """Пока выбирается новая категория расхода, текст не должен записываться как новый расход"""
+    bot.send_message(message.chat.id, "Выберите новую категорию кнопкой выше.")
+
+
+@router.callback_prefix("delete_exp_")
 def delete_expense_confirm(call):
     """Подтверждение удаления расхода"""
     try:
@@ -1041,7 +1204,7 @@ def delete_expense_confirm(call):
     bot.answer_callback_query(call.id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("confirm_delete_exp_"))
+@router.callback_prefix("confirm_delete_exp_")
 def confirm_delete_expense(call):
     """Подтвердить удаление расхода"""
     try:
@@ -1069,7 +1232,7 @@ def confirm_delete_expense(call):
         bot.answer_callback_query(call.id, "❌ Ошибка при удалении расхода")
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "back_to_edit_list")
+@router.callback("back_to_edit_list")
 def back_to_edit_list(call):
     """Вернуться к списку расходов для редактирования"""
     user_id = call.from_user.id
@@ -1078,9 +1241,9 @@ def back_to_edit_list(call):
         bot.answer_callback_query(call.id, "Ошибка: активное путешествие не найдено")
         return
     
-    expenses = database.get_expenses_by_category(trip['trip_id'])
+    page = database.get_expenses_page(trip['trip_id'], EDIT_LIST_PAGE_SIZE)
     
-    if not expenses:
+    if not page['expenses']:
         bot.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
@@ -1089,59 +1252,36 @@ def back_to_edit_list(call):
         bot.answer_callback_query(call.id)
         return
     
-    markup = types.InlineKeyboardMarkup()
-    
-    for exp in expenses[:20]:
-        date_str = exp['timestamp'][:16] if exp['timestamp'] else 'Неизвестно'
-        btn_text = f"{exp['amount_target']:.2f} {exp['currency_target']} ({date_str[:10]})"
-        if len(btn_text) > 64:
-            btn_text = btn_text[:61] + "..."
-        
-        markup.add(types.InlineKeyboardButton(
-            btn_text,
-            callback_data=f"edit_exp_{exp['expense_id']}"
-        ))
-    
-    markup.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_to_main"))
-    
     bot.edit_message_text(
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
         text="Выберите расход для редактирования:",
-        reply_markup=markup
+        reply_markup=edit_list_markup(page)
     )
     bot.answer_callback_query(call.id)
 
 
-@bot.message_handler(func=lambda message: message.text == "📦 Расходы по категориям")
+@router.text("📦 Расходы по категориям")
 def show_expenses_by_categories(message):
     trip = get_user_active_trip(message.from_user.id)
     if not trip:
         bot.send_message(message.chat.id, "Сначала выберите или создайте путешествие.")
         return
     
-    # Получаем расходы по категориям
-    expenses_by_cat = database.get_expenses_by_category(trip['trip_id'])
+    # Получаем итоги по категориям из агрегатов путешествия
+    totals = database.get_trip_totals(trip['trip_id'])
     
-    if not expenses_by_cat:
+    if not totals['expense_count']:
         bot.send_message(message.chat.id, "В этом путешествии еще нет расходов.")
         return
     
-    # Группируем расходы по категориям
     cat_expenses = {}
-    for exp in expenses_by_cat:
-        cat_name = exp['category_name']
-        if cat_name not in cat_expenses:
-            cat_expenses[cat_name] = {'total_target': 0, 'total_home': 0, 'count': 0, 'details': []}
-        cat_expenses[cat_name]['total_target'] += exp['amount_target']
-        cat_expenses[cat_name]['total_home'] += exp['amount_home']
-        cat_expenses[cat_name]['count'] += 1
-        cat_expenses[cat_name]['details'].append({
-            'amount_target': exp['amount_target'],
-            'amount_home': exp['amount_home'],
-            'timestamp': exp['timestamp'],
-            'currency_target': exp['currency_target']
-        })
+    for cat in totals['by_category'].values():
+        cat_expenses[cat['category_name']] = {
+            'total_target': cat['amount_target'],
+            'total_home': cat['amount_home'],
+            'count': cat['expense_count']
+        }
     
     text = f"Расходы по категориям ({trip['name']}):\n\n"
     for cat_name, stats in cat_expenses.items():
@@ -1152,9 +1292,91 @@ def show_expenses_by_categories(message):
     
     bot.send_message(message.chat.id, text)
 
+@router.text("/reconcile")
+def reconcile_totals(message):
+    """
+    Обработчик команды /reconcile.
+    Пересобирает агрегаты расходов активного путешествия по записанным расходам.
+    """
+    trip = get_user_active_trip(message.from_user.id)
+    if not trip:
+        bot.send_message(message.chat.id, "Сначала выберите или создайте путешествие.")
+        return
+    
+    database.reconcile_trip_totals(trip['trip_id'])
+    database.reset_category_spending(trip['trip_id'])
+    totals = database.get_trip_totals(trip['trip_id'])
+    bot.send_message(
+        message.chat.id,
+        f"✅ Итоги путешествия '{trip['name']}' пересчитаны.\n"
+        f"Расходов: {totals['expense_count']}, всего: {totals['amount_home']:.2f} {trip['home_currency']}"
+    )
+
+@router.text("/revalue")
+def revalue_expenses(message):
+    """
+    Обработчик команды /revalue.
+    Пересчитывает суммы расходов активного путешествия в домашней валюте по курсу на дату каждого расхода.
+    Расходы в валюте с закрепленным вручную курсом пересчитываются только по команде /revalue force.
+    """
+    trip = get_user_active_trip(message.from_user.id)
+    if not trip:
+        bot.send_message(message.chat.id, "Сначала выберите или создайте путешествие.")
+        return
+    
+    include_pinned = message.text.split()[1:2] == ['force']
+    result = api_client.revalue_trip_expenses(trip['trip_id'], include_pinned=include_pinned)
+    if result is None:
+        bot.send_message(message.chat.id, "Путешествие не найдено — возможно, оно было удалено.")
+        return
+    text = (f"✅ Расходы путешествия '{trip['name']}' переоценены по курсам на дату покупки.\n"
+            f"Пересчитано расходов: {result['updated']}\n"
+            f"Всего было: {result['total_before']:.2f} {trip['home_currency']}, "
+            f"стало: {result['total_after']:.2f} {trip['home_currency']}")
+    if result['history_unavailable']:
+        text += ("\n⚠️ Настроенный источник курсов не отдает исторические курсы, а сохраненных курсов "
+                 "на нужные даты нет — часть расходов не пересчитана.")
+    elif result['missing']:
+        text += (f"\n⚠️ Не удалось получить курс для {result['missing']} сочетаний валюты и даты покупки, "
+                 f"расходы с ними не изменены.")
+    if result['skipped_currencies']:
+        text += (f"\n📌 Расходы в {', '.join(result['skipped_currencies'])} не пересчитаны: курс задан вручную. "
+                 f"Чтобы пересчитать и их, отправьте /revalue force.")
+    bot.send_message(message.chat.id, text)
+
+@router.text("/apistats")
+def api_stats(message):
+    """
+    Служебная команда /apistats (только для ADMIN_USER_IDS).
+    Показывает расход и остаток месячной квоты API по источникам курсов,
+    статистику кэша курсов и состояние предохранителя API.
+    """
+    if message.from_user.id not in ADMIN_USER_IDS:
+        return
+    
+    text = "📡 Квота API курсов:\n"
+    for name, quota_stats in api_client.get_quota_stats().items():
+        if quota_stats['remaining'] is None:
+            budget = "без лимита"
+        else:
+            budget = (f"осталось {quota_stats['remaining']} из {quota_stats['monthly_limit']} "
+                      f"(фоновым обновлениям — {quota_stats['remaining_background']})")
+        text += (f"  - {name}: {quota_stats['used']} запросов за {quota_stats['period']}, {budget}, "
+                 f"отклонено {sum(quota_stats['rejected'].values())}\n")
+    
+    cache_stats = api_client.get_rate_cache_stats()
+    breaker_stats = cache_stats['breaker']
+    text += (f"\n💾 Кэш курсов: попаданий {cache_stats['hit_rate']:.0%} "
+             f"(по обратной паре {cache_stats['inverse_hits']}, устаревшим курсом {cache_stats['stale_hits']}), "
+             f"промахов {cache_stats['misses']}, записей {cache_stats['size']}, "
+             f"средний возраст курса {cache_stats['age_avg']:.0f} с\n"
+             f"🔌 Предохранитель API: {breaker_stats['state']}, срабатываний {breaker_stats['trips']}, "
+             f"отклонено запросов {breaker_stats['rejected']}")
+    bot.send_message(message.chat.id, text)
+
 # --- Budget Settings Menu ---
 
-@bot.message_handler(func=lambda message: message.text == "📊 Настройки бюджета")
+@router.text("📊 Настройки бюджета")
 def budget_settings_menu(message):
     trip = get_user_active_trip(message.from_user.id)
     if not trip:
@@ -1164,7 +1386,7 @@ def budget_settings_menu(message):
     bot.send_message(message.chat.id, "🔧 Настройки бюджета:", reply_markup=budget_settings_keyboard())
 
 
-@bot.message_handler(func=lambda message: message.text == "📈 Установить бюджеты по категориям")
+@router.text("📈 Установить бюджеты по категориям")
 def start_category_budget_setup(message):
     """
     Начинает процесс установки бюджетов по категориям для активного путешествия.
@@ -1181,7 +1403,7 @@ def start_category_budget_setup(message):
     bot.send_message(message.chat.id, "Выберите категорию для установки бюджета:", reply_markup=select_category_keyboard())
 
 
-@bot.message_handler(func=lambda message: message.text == "💱 Валюты путешествия")
+@router.text("💱 Валюты путешествия")
 def manage_trip_currencies(message):
     """
     Меню управления валютами в активном путешествии:
@@ -1219,7 +1441,7 @@ def manage_trip_currencies(message):
     bot.send_message(message.chat.id, text, reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("cur_setbal_"))
+@router.callback_prefix("cur_setbal_")
 def currency_set_balance_prompt(call):
     user_id = call.from_user.id
     try:
@@ -1230,7 +1452,6 @@ def currency_set_balance_prompt(call):
 
     conn = get_db_connection()
     cur = conn.execute("SELECT * FROM trip_currencies WHERE currency_id = ?", (currency_id,)).fetchone()
-    conn.close()
     if not cur:
         bot.answer_callback_query(call.id, "Ошибка: валюта не найдена")
         return
@@ -1244,7 +1465,7 @@ def currency_set_balance_prompt(call):
     bot.answer_callback_query(call.id)
 
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'set_currency_balance')
+@router.step("set_currency_balance")
 def process_currency_set_balance(message):
     user_id = message.from_user.id
     try:
@@ -1261,20 +1482,17 @@ def process_currency_set_balance(message):
     conn = get_db_connection()
     cur = conn.execute("SELECT * FROM trip_currencies WHERE currency_id = ?", (currency_id,)).fetchone()
     if not cur:
-        conn.close()
         bot.send_message(message.chat.id, "Ошибка: валюта не найдена.")
         return
 
-    conn.execute("UPDATE trip_currencies SET balance = ? WHERE currency_id = ?", (new_balance, currency_id))
-    conn.commit()
-    conn.close()
+    database.set_currency_balance(currency_id, new_balance)
 
     bot.send_message(message.chat.id, f"✅ Баланс {cur['currency_code']} обновлен: {new_balance:.2f}")
     if user_id in user_data:
         del user_data[user_id]
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("cur_del_"))
+@router.callback_prefix("cur_del_")
 def currency_delete_confirm(call):
     try:
         currency_id = int(call.data.split("_")[2])
@@ -1284,7 +1502,6 @@ def currency_delete_confirm(call):
 
     conn = get_db_connection()
     cur = conn.execute("SELECT * FROM trip_currencies WHERE currency_id = ?", (currency_id,)).fetchone()
-    conn.close()
     if not cur:
         bot.answer_callback_query(call.id, "Ошибка: валюта не найдена")
         return
@@ -1301,7 +1518,7 @@ def currency_delete_confirm(call):
     bot.answer_callback_query(call.id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("cur_del_ok_"))
+@router.callback_prefix("cur_del_ok_")
 def currency_delete_execute(call):
     try:
         currency_id = int(call.data.split("_")[3])
@@ -1312,20 +1529,17 @@ def currency_delete_execute(call):
     conn = get_db_connection()
     cur = conn.execute("SELECT * FROM trip_currencies WHERE currency_id = ?", (currency_id,)).fetchone()
     if not cur:
-        conn.close()
         bot.answer_callback_query(call.id, "Ошибка: валюта не найдена")
         return
 
-    # Не удаляем валюту, если по ней есть расходы
-    exp_cnt = conn.execute("SELECT COUNT(1) as cnt FROM expenses WHERE trip_id = ? AND currency_target = ?", (cur['trip_id'], cur['currency_code'])).fetchone()
-    if exp_cnt and exp_cnt['cnt'] > 0:
-        conn.close()
+    # Не удаляем валюту, если по ней есть расходы (проверка и удаление выполняются атомарно)
+    status = database.delete_trip_currency(currency_id)
+    if status == 'has_expenses':
         bot.answer_callback_query(call.id, "Нельзя удалить: есть расходы в этой валюте")
         return
-
-    conn.execute("DELETE FROM trip_currencies WHERE currency_id = ?", (currency_id,))
-    conn.commit()
-    conn.close()
+    if status == 'not_found':
+        bot.answer_callback_query(call.id, "Ошибка: валюта не найдена")
+        return
 
     bot.edit_message_text(
         chat_id=call.message.chat.id,
@@ -1336,7 +1550,7 @@ def currency_delete_execute(call):
 
 # --- Budget Settings Handlers ---
 
-@bot.message_handler(func=lambda message: message.text == "📊 Установить лимит бюджета")
+@router.text("📊 Установить лимит бюджета")
 def set_budget_limit(message):
     """
     Обработчик команды "📊 Установить лимит бюджета".
@@ -1354,7 +1568,7 @@ def set_budget_limit(message):
     bot.send_message(message.chat.id, f"Текущий лимит бюджета: {trip['budget_limit']} {trip['target_currency']}\nВведите новый лимит бюджета (в {trip['target_currency']}), или 0, чтобы отключить:")
 
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('state') == 'setting_budget_limit')
+@router.step("setting_budget_limit", field="state")
 def process_set_budget_limit(message):
     """
     Обработчик ввода нового лимита бюджета.
@@ -1380,26 +1594,19 @@ def process_set_budget_limit(message):
             target_currency = target_currency_result[0]
         else:
             bot.send_message(message.chat.id, "Ошибка: не удалось найти информацию о путешествии.")
-            conn.close()
             if user_id in user_data:
                 del user_data[user_id]
             return
         
-        # Обновляем лимит бюджета
-        conn.execute('UPDATE trips SET budget_limit = ? WHERE trip_id = ?', (new_limit, trip_id))
-        
-        # Автоматически устанавливаем порог уведомления (80% от лимита, если лимит > 0)
+        # Обновляем лимит бюджета и автоматически устанавливаем порог уведомления (80% от лимита, если лимит > 0)
         if new_limit > 0:
             new_threshold = new_limit * 0.8
-            conn.execute('UPDATE trips SET notification_threshold = ? WHERE trip_id = ?', (new_threshold, trip_id))
+            database.set_budget_limit(trip_id, new_limit, new_threshold)
             bot.send_message(message.chat.id, f"Лимит бюджета обновлен: {new_limit} {target_currency}\nПорог уведомления: {new_threshold} {target_currency} (80% от лимита)")
         else:
-            conn.execute('UPDATE trips SET notification_threshold = 0 WHERE trip_id = ?', (trip_id,))
+            database.set_budget_limit(trip_id, new_limit, 0)
             bot.send_message(message.chat.id, f"Лимит бюджета отключен.")
         
-        conn.commit()
-        conn.close()
-        
         # Очищаем состояние пользователя
         if user_id in user_data:
             del user_data[user_id]
@@ -1408,7 +1615,7 @@ def process_set_budget_limit(message):
         bot.send_message(message.chat.id, "Пожалуйста, введите корректное число.")
 
 
-@bot.message_handler(func=lambda message: message.text == "🔔 Установить порог уведомления")
+@router.text("🔔 Установить порог уведомления")
 def set_notification_threshold(message):
     trip = get_user_active_trip(message.from_user.id)
     if not trip:
@@ -1422,7 +1629,7 @@ def set_notification_threshold(message):
     bot.send_message(message.chat.id, f"Текущий порог уведомления: {trip['notification_threshold']} {trip['target_currency']}\nВведите новый порог уведомления (в {trip['target_currency']}):")
 
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('state') == 'setting_notification_threshold')
+@router.step("setting_notification_threshold", field="state")
 def process_set_notification_threshold(message):
     user_id = message.from_user.id
     user_state = user_data.get(user_id, {})
@@ -1444,16 +1651,13 @@ def process_set_notification_threshold(message):
             target_currency = target_currency_result[0]
         else:
             bot.send_message(message.chat.id, "Ошибка: не удалось найти информацию о путешествии.")
-            conn.close()
             if user_id in user_data:
                 del user_data[user_id]
             return
         
         # Обновляем порог уведомления
-        conn.execute('UPDATE trips SET notification_threshold = ? WHERE trip_id = ?', (new_threshold, trip_id))
+        database.set_notification_threshold(trip_id, new_threshold)
         bot.send_message(message.chat.id, f"Порог уведомления обновлен: {new_threshold} {target_currency}")
-        conn.commit()
-        conn.close()
         
         # Очищаем состояние пользователя
         if user_id in user_data:
@@ -1463,7 +1667,7 @@ def process_set_notification_threshold(message):
         bot.send_message(message.chat.id, "Пожалуйста, введите корректное число.")
 
 
-@bot.message_handler(func=lambda message: message.text == "💰 Просмотреть бюджет")
+@router.text("💰 Просмотреть бюджет")
 def view_budget(message):
     """
     Обработчик команды "💰 Просмотреть бюджет".
@@ -1476,12 +1680,7 @@ def view_budget(message):
     
     if trip['budget_limit'] > 0:
         # Calculate total spent across all currencies
-        conn = get_db_connection()
-        total_spent_result = conn.execute('''
-            SELECT SUM(amount_home) as total_spent FROM expenses WHERE trip_id = ?
-        ''', (trip['trip_id'],)).fetchone()
-        conn.close()
-        total_spent = total_spent_result['total_spent'] or 0
+        total_spent = database.get_trip_total_spent(trip['trip_id'])
         
         # Convert to target currency for comparison with budget
         total_spent_in_target = total_spent * trip['exchange_rate']
@@ -1497,7 +1696,7 @@ def view_budget(message):
         bot.send_message(message.chat.id, f"Лимит бюджета не установлен для {trip['name']}.")
 
 
-@bot.message_handler(func=lambda message: message.text == "📋 План по категориям")
+@router.text("📋 План по категориям")
 def view_category_budgets(message):
     """
     Обработчик команды "📋 План по категориям".
@@ -1547,7 +1746,7 @@ def view_category_budgets(message):
     bot.send_message(message.chat.id, text)
 
 
-@bot.message_handler(func=lambda message: message.text == "🔙 Назад в меню")
+@router.text("🔙 Назад в меню")
 def back_to_main_menu(message):
     """
     Обработчик команды "🔙 Назад в меню".
@@ -1556,7 +1755,7 @@ def back_to_main_menu(message):
     bot.send_message(message.chat.id, "Возвращаемся в главное меню.", reply_markup=main_menu_keyboard())
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "back_to_main")
+@router.callback("back_to_main")
 def back_to_main_callback(call):
     """Обработчик callback для кнопки 'Назад' - возвращает в главное меню"""
     bot.edit_message_text(
@@ -1570,6 +1769,117 @@ def back_to_main_callback(call):
 
 # --- Change Rate ---
 
+@router.text("📈 Изменить курс", "/setrate")
+def change_rate_menu(message):
+    """
+    Обработчик кнопки "📈 Изменить курс" и команды /setrate.
+    Позволяет вручную задать курс любой валюты активного путешествия.
+    """
+    trip = get_user_active_trip(message.from_user.id)
+    if not trip:
+        bot.send_message(message.chat.id, "Сначала выберите или создайте путешествие.")
+        return
+    
+    currencies = [cur for cur in trip['currencies'] if cur['currency_code'] != trip['home_currency']]
+    if not currencies:
+        bot.send_message(message.chat.id, "В путешествии нет валют, для которых можно задать курс.")
+        return
+    if len(currencies) == 1:
+        ask_new_rate(message.chat.id, message.from_user.id, trip, currencies[0])
+        return
+    
+    markup = types.InlineKeyboardMarkup()
+    for cur in currencies:
+        markup.add(types.InlineKeyboardButton(
+            f"{cur['currency_code']} (1 {trip['home_currency']} = {cur['exchange_rate_to_home']:.4f})",
+            callback_data=f"setrate_cur_{cur['currency_code']}"
+        ))
+    markup.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_to_main"))
+    bot.send_message(message.chat.id, "Для какой валюты изменить курс?", reply_markup=markup)
+
+
+def ask_new_rate(chat_id, user_id, trip, cur):
+    """Запросить у пользователя новый курс валюты cur"""
+    user_data[user_id] = {'step': 'setrate_value', 'trip_id': trip['trip_id'], 'currency_code': cur['currency_code']}
+    bot.send_message(
+        chat_id,
+        f"Текущий курс: 1 {trip['home_currency']} = {cur['exchange_rate_to_home']:.4f} {cur['currency_code']}.\n"
+        f"Введите новый курс (сколько {cur['currency_code']} дают за 1 {trip['home_currency']}):"
+    )
+
+
+@router.callback_prefix("setrate_cur_")
+def change_rate_select_currency(call):
+    trip = get_user_active_trip(call.from_user.id)
+    code = call.data[len("setrate_cur_"):]
+    cur = next((c for c in trip['currencies'] if c['currency_code'] == code), None) if trip else None
+    if not cur:
+        bot.answer_callback_query(call.id, "Ошибка: валюта не найдена")
+        return
+    bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=f"Изменение курса {code}")
+    ask_new_rate(call.message.chat.id, call.from_user.id, trip, cur)
+    bot.answer_callback_query(call.id)
+
+
+@router.step("setrate_value")
+def process_new_rate(message):
+    user_id = message.from_user.id
+    try:
+        rate = float(message.text.replace(',', '.'))
+    except ValueError:
+        bot.send_message(message.chat.id, "Пожалуйста, введите число.")
+        return
+    if rate <= 0:
+        bot.send_message(message.chat.id, "Курс должен быть больше нуля.")
+        return
+    
+    user_data[user_id]['rate'] = rate
+    user_data[user_id]['step'] = 'setrate_confirm'
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔄 Да, пересчитать расходы", callback_data="setrate_recalc_yes"))
+    markup.add(types.InlineKeyboardButton("➡️ Только новые расходы", callback_data="setrate_recalc_no"))
+    bot.send_message(
+        message.chat.id,
+        f"Пересчитать уже записанные расходы в {user_data[user_id]['currency_code']} по новому курсу?",
+        reply_markup=markup
+    )
+
+
+@router.callback("setrate_recalc_yes", "setrate_recalc_no")
+def apply_new_rate(call):
+    user_id = call.from_user.id
+    data = user_data.get(user_id, {})
+    if data.get('step') != 'setrate_confirm':
+        bot.answer_callback_query(call.id, "Откройте изменение курса заново.")
+        return
+    
+    trip = get_user_active_trip(user_id)
+    if not trip or trip['trip_id'] != data['trip_id']:
+        del user_data[user_id]
+        bot.answer_callback_query(call.id, "Активное путешествие изменилось, откройте изменение курса заново.")
+        return
+    result = database.set_trip_currency_rate(
+        data['trip_id'], data['currency_code'], data['rate'],
+        recompute_expenses=call.data == "setrate_recalc_yes"
+    )
+    del user_data[user_id]
+    if result is None:
+        bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id,
+                              text="Ошибка: валюта не найдена в путешествии.")
+        bot.answer_callback_query(call.id)
+        return
+    
+    text = f"✅ Курс установлен: 1 {trip['home_currency']} = {data['rate']} {data['currency_code']}."
+    if trip['rate_policy'] == database.RATE_POLICY_AUTO:
+        text += (f"\n📌 Курс {data['currency_code']} закреплен и больше не обновляется автоматически, "
+                 f"курсы остальных валют путешествия по-прежнему следуют за рынком.")
+    if result['updated']:
+        text += (f"\nПересчитано расходов: {result['updated']}\n"
+                 f"Всего было: {result['total_before']:.2f} {trip['home_currency']}, "
+                 f"стало: {result['total_after']:.2f} {trip['home_currency']}")
+    bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=text)
+    bot.answer_callback_query(call.id)
+
 
 # --- Multi-Currency Support ---
 
@@ -1594,80 +1904,83 @@ def select_currency_keyboard(trip):
     return markup
 
 
+# Готовая клавиатура выбора категории: (версия справочника категорий, InlineKeyboardMarkup)
+_category_keyboard = (None, None)
+
 def select_category_keyboard():
     """
     Создает inline-клавиатуру для выбора категории расхода.
+    Клавиатура собирается один раз и переиспользуется, пока не изменится справочник категорий.
     
     Returns:
         Объект InlineKeyboardMarkup с кнопками категорий расходов
     """
-    categories = database.get_all_categories()
+    global _category_keyboard
+    version, markup = _category_keyboard
+    if markup is not None and version == database.get_categories_version():
+        return markup
+    
+    version = database.get_categories_version()
     markup = types.InlineKeyboardMarkup()
     
-    for cat in categories:
+    for cat in database.get_all_categories():
         markup.add(
             types.InlineKeyboardButton(cat['name'], callback_data=f"cat_{cat['category_id']}")
         )
     
+    _category_keyboard = (version, markup)
     return markup
 
 
-def check_category_budget_limits(trip_id, category_id, amount_home):
+def budget_notifications(result):
     """
-    Проверяет, не превышены ли лимиты бюджета по категории, и возвращает список уведомлений.
+    Формирует уведомления о приближении к лимиту бюджета или его превышении.
     
     Args:
-        trip_id: ID путешествия
-        category_id: ID категории расхода
-        amount_home: Сумма расхода в домашней валюте
+        result: Результат database.record_expense с уже вычисленными статусами порогов
     
     Returns:
-        Список уведомлений о приближении или превышении лимита бюджета по категории
+        Список уведомлений: сначала по общему бюджету путешествия, затем по категории
     """
     notifications = []
+    trip = result['trip']
     
-    # Получаем информацию о бюджете для данной категории
-    conn = get_db_connection()
-    cat_budget = conn.execute('''
-        SELECT planned_amount, spent_amount, currency_code
-        FROM category_budgets
-        WHERE trip_id = ? AND category_id = ?
-    ''', (trip_id, category_id)).fetchone()
-    
-    if cat_budget and cat_budget['planned_amount'] > 0:
-        planned = cat_budget['planned_amount']
-        spent_before = cat_budget['spent_amount']
-        spent_after = spent_before + amount_home
-        currency_code = cat_budget['currency_code']
-        
-        # Проверяем, не превышен ли порог уведомления (обычно 80% от лимита)
-        notification_threshold = planned * 0.8
-        if spent_before <= notification_threshold < spent_after:
-            pct = (spent_after / planned) * 100
+    if result['budget_status']:
+        total_spent_in_target = result['total_spent_after'] * trip['exchange_rate']
+        if result['budget_status'] == 'threshold':
+            # Just crossed the notification threshold
             notifications.append(
-                f"⚠️ Вы приближаетесь к лимиту бюджета по категории '{database.get_all_categories()[category_id-1]['name']}'! "
-                f"Потрачено: {spent_after:.2f} {currency_code} из {planned:.2f} {currency_code} ({pct:.1f}%)"
+                f"⚠️ Вы приближаетесь к лимиту бюджета! Потрачено: {total_spent_in_target:.2f} {trip['target_currency']} из {trip['budget_limit']:.2f} {trip['target_currency']} (лимит)"
             )
-        elif spent_before < planned <= spent_after:
-            # Превышен лимит бюджета по категории
-            exceeded_amount = spent_after - planned
+        else:
+            # Exceeded budget limit
+            exceeded_amount = total_spent_in_target - trip['budget_limit']
             notifications.append(
-                f"⚠️ Вы превысили лимит бюджета по категории '{database.get_all_categories()[category_id-1]['name']}'! "
-                f"Превышение: {exceeded_amount:.2f} {currency_code}"
+                f"⚠️ Вы превысили лимит бюджета! Превышение: {exceeded_amount:.2f} {trip['target_currency']}"
             )
     
-    conn.close()
+    cat_budget = result['category_budget']
+    if result['category_status'] == 'threshold':
+        pct = (cat_budget['spent_after'] / cat_budget['planned_amount']) * 100
+        notifications.append(
+            f"⚠️ Вы приближаетесь к лимиту бюджета по категории '{result['category_name']}'! "
+            f"Потрачено: {cat_budget['spent_after']:.2f} {cat_budget['currency_code']} из {cat_budget['planned_amount']:.2f} {cat_budget['currency_code']} ({pct:.1f}%)"
+        )
+    elif result['category_status'] == 'exceeded':
+        # Превышен лимит бюджета по категории
+        exceeded_amount = cat_budget['spent_after'] - cat_budget['planned_amount']
+        notifications.append(
+            f"⚠️ Вы превысили лимит бюджета по категории '{result['category_name']}'! "
+            f"Превышение: {exceeded_amount:.2f} {cat_budget['currency_code']}"
+        )
+    
     return notifications
 
 # --- Expense Tracking ---
 #
-# Обрабатываем только не-командные текстовые сообщения, чтобы команды
-# (например, /setcatbudget) не перехватывались этим обработчиком.
-# Также не обрабатываем сообщения, когда пользователь редактирует расход или находится в других специальных режимах.
-@bot.message_handler(func=lambda message: not message.text.startswith('/') and 
-                     user_data.get(message.from_user.id, {}).get('step') not in 
-                     ('editing_expense_amount', 'editing_expense_category', 'enter_budget_amount_for_category',
-                      'add_currency_code', 'add_currency_balance', 'select_category_for_budget'))
+# Сюда попадают сообщения, для которых нет ни кнопки меню, ни команды, ни обработчика
+# текущего шага диалога: число записывается как расход.
+@router.fallback
 def handle_text(message):
     # Try to see if it's a number
     try:
@@ -1702,14 +2015,13 @@ def handle_text(message):
         else:
             bot.send_message(message.chat.id, "Я понимаю только числа (как расходы) или команды из меню.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("exp_yes_"))
+@router.callback_prefix("exp_yes_")
 def confirm_expense_callback(call):
     parts = call.data.split('_')
     amount_target = float(parts[2])
     trip_id = int(parts[3])
     
-    conn = get_db_connection()
-    trip = conn.execute('SELECT * FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
+    trip = get_user_trip(call.from_user.id, trip_id)
     
     if trip:
         amount_home = amount_target / trip['exchange_rate']
@@ -1733,9 +2045,8 @@ def confirm_expense_callback(call):
             reply_markup=select_category_keyboard()
         )
     
-    conn.close()
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("sel_curr_"))
+@router.callback_prefix("sel_curr_")
 def select_currency_callback(call):
     user_id = call.from_user.id
     temp_data = user_data.get(user_id, {})
@@ -1775,26 +2086,21 @@ def select_currency_callback(call):
         reply_markup=inline_confirm_expense_multi(amount, currency_code, trip['trip_id'])
     )
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("exp_multi_yes_"))
+@router.callback_prefix("exp_multi_yes_")
 def confirm_multi_expense_callback(call):
     parts = call.data.split('_')
     amount = float(parts[3])
     currency_code = parts[4]
     trip_id = int(parts[5])
     
-    conn = get_db_connection()
-    trip = conn.execute('SELECT * FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
+    trip = get_user_trip(call.from_user.id, trip_id)
     
     if trip:
         # Get currency info
-        currency_info = conn.execute(
-            'SELECT * FROM trip_currencies WHERE trip_id = ? AND currency_code = ?',
-            (trip_id, currency_code)
-        ).fetchone()
+        currency_info = find_trip_currency(trip, currency_code)
         
         if not currency_info:
             bot.answer_callback_query(call.id, "Ошибка: валюта не найдена")
-            conn.close()
             return
         
         exchange_rate_to_home = currency_info['exchange_rate_to_home']
@@ -1807,9 +2113,7 @@ def confirm_multi_expense_callback(call):
                 'amount_target': amount,
                 'amount_home': home_amount,
                 'currency_target': currency_code,
-                'currency_home': trip['home_currency'],
-                'currency_id': currency_info['currency_id'],
-                'new_balance': currency_info['balance'] - amount
+                'currency_home': trip['home_currency']
             }
         }
         
@@ -1821,9 +2125,8 @@ def confirm_multi_expense_callback(call):
             reply_markup=select_category_keyboard()
         )
     
-    conn.close()
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("cat_") and not (call.from_user.id in user_data and user_data[call.from_user.id].get('step') in ('select_category_for_budget', 'editing_expense_category')))
+@router.callback_prefix("cat_")
 def select_category_callback(call):
     user_id = call.from_user.id
     temp_data = user_data.get(user_id, {}).get('temp_expense_data')
@@ -1841,78 +2144,26 @@ def select_category_callback(call):
     currency_target = temp_data['currency_target']
     currency_home = temp_data['currency_home']
     
-    # Connect to database
-    conn = get_db_connection()
-    trip = conn.execute('SELECT * FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
+    # Записываем расход, бюджеты, балансы и проверяем пороги одной транзакцией
+    result = database.record_expense(
+        trip_id,
+        category_id,
+        amount_target,
+        amount_home,
+        currency_target,
+        currency_home
+    )
     
-    if not trip:
+    if not result:
         bot.answer_callback_query(call.id, "Ошибка: путешествие не найдено")
-        conn.close()
         return
     
-    # Add expense to category using our database helper function
-    database.add_expense_to_category(
-        trip_id, 
-        category_id, 
-        amount_home, 
-        amount_target, 
-        currency_home, 
-        currency_target
-    )
-    
-    # Update currency balance if this is multi-currency
-    if 'currency_id' in temp_data and 'new_balance' in temp_data:
-        conn.execute(
-            'UPDATE trip_currencies SET balance = ? WHERE currency_id = ?',
-            (temp_data['new_balance'], temp_data['currency_id'])
-        )
-    
-    # Update main trip balance if this is the target currency
-    if currency_target == trip['target_currency']:
-        new_target_balance = trip['target_balance'] - amount_target
-        new_home_balance = trip['home_balance'] - amount_home
-        conn.execute(
-            'UPDATE trips SET target_balance = ?, home_balance = ? WHERE trip_id = ?',
-            (new_target_balance, new_home_balance, trip_id)
-        )
-    
-    conn.commit()
-    
-    # Check category budget limits and collect notifications
-    category_budget_notifications = check_category_budget_limits(trip_id, category_id, amount_home)
-    
-    # Also check the overall trip budget limit
-    overall_budget_notifications = []
-    if trip['budget_limit'] > 0 and trip['notification_threshold'] > 0:
-        # Calculate total spent across all currencies
-        total_spent_result = conn.execute('''
-            SELECT SUM(amount_home) as total_spent FROM expenses WHERE trip_id = ?
-        ''', (trip_id,)).fetchone()
-        total_spent = total_spent_result['total_spent'] or 0
-        
-        if total_spent > 0:
-            total_spent_in_target = total_spent * trip['exchange_rate']
-            
-            if total_spent_in_target >= trip['notification_threshold'] and total_spent_in_target - (amount_home * trip['exchange_rate']) < trip['notification_threshold']:
-                # Just crossed the notification threshold
-                overall_budget_notifications.append(
-                    f"⚠️ Вы приближаетесь к лимиту бюджета! Потрачено: {total_spent_in_target:.2f} {trip['target_currency']} из {trip['budget_limit']:.2f} {trip['target_currency']} (лимит)"
-                )
-            elif total_spent_in_target >= trip['budget_limit']:
-                # Exceeded budget limit
-                exceeded_amount = total_spent_in_target - trip['budget_limit']
-                overall_budget_notifications.append(
-                    f"⚠️ Вы превысили лимит бюджета! Превышение: {exceeded_amount:.2f} {trip['target_currency']}"
-                )
-    
-    conn.close()
-    
     # Clear temporary data
     if user_id in user_data and 'temp_expense_data' in user_data[user_id]:
         del user_data[user_id]['temp_expense_data']
     
     # Send confirmation message
-    message_text = f"✅ Расход учтен: {amount_target} {currency_target}\nКатегория: {database.get_all_categories()[category_id-1]['name']}"
+    message_text = f"✅ Расход учтен: {amount_target} {currency_target}\nКатегория: {result['category_name']}"
     
     # Send the main confirmation
     bot.edit_message_text(
@@ -1925,11 +2176,11 @@ def select_category_callback(call):
     bot.send_message(call.message.chat.id, "Записано")
     
     # Send all budget notifications
-    for notification in overall_budget_notifications + category_budget_notifications:
+    for notification in budget_notifications(result):
         bot.send_message(call.message.chat.id, notification)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "exp_no")
+@router.callback("exp_no")
 def cancel_expense_callback(call):
     # Clear temporary data if exists
     user_id = call.from_user.id
@@ -1937,7 +2188,7 @@ def cancel_expense_callback(call):
         del user_data[user_id]['temp_expense_amount']
     bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text="❌ Расход не учтен.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "add_currency")
+@router.callback("add_currency")
 def add_currency_callback(call):
     user_id = call.from_user.id
     trip = get_user_active_trip(user_id)
@@ -1953,20 +2204,19 @@ def add_currency_callback(call):
         text="Введите код валюты, которую хотите добавить (например: USD, EUR, JPY):"
     )
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'add_currency_code')
+@router.step("add_currency_code")
 def process_add_currency_code(message):
     user_id = message.from_user.id
     currency_code = message.text.strip().upper()
     
-    if len(currency_code) != 3:
-        bot.send_message(message.chat.id, "Код валюты должен состоять из 3 букв. Попробуйте еще раз:")
+    if not check_currency_code(message.chat.id, currency_code):
         return
     
     user_data[user_id]['step'] = 'add_currency_balance'
     user_data[user_id]['new_currency_code'] = currency_code
     bot.send_message(message.chat.id, f"Введите начальный баланс для {currency_code}:")
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'add_currency_balance')
+@router.step("add_currency_balance")
 def process_add_currency_balance(message):
     try:
         user_id = message.from_user.id
@@ -1982,7 +2232,6 @@ def process_add_currency_balance(message):
         exchange_rate = api_client.get_exchange_rate(trip['home_currency'], currency_code)
         if exchange_rate is None:
             bot.send_message(message.chat.id, f"Не удалось получить курс для {currency_code}. Валюта не добавлена.")
-            conn.close()
             del user_data[user_id]
             return
         
@@ -1993,14 +2242,13 @@ def process_add_currency_balance(message):
             message.chat.id,
             f"Валюта {currency_code} с балансом {balance} добавлена к путешествию!"
         )
-        conn.close()
         del user_data[user_id]
     except ValueError:
         bot.send_message(message.chat.id, "Пожалуйста, введите число.")
 
 # --- Category Budget Management ---
 
-@bot.message_handler(commands=['setcatbudget'])
+@router.text("/setcatbudget")
 def start_set_category_budget(message):
     """
     Обработчик команды /setcatbudget.
@@ -2018,7 +2266,7 @@ def start_set_category_budget(message):
     bot.send_message(message.chat.id, "Выберите категорию для установки бюджета:", reply_markup=select_category_keyboard())
 
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'select_category_for_budget')
+@router.step("select_category_for_budget")
 def process_category_budget_selection(message):
     """
     Обработчик выбора категории для установки бюджета.
@@ -2044,7 +2292,7 @@ def process_category_budget_selection(message):
 
 
 # Callback handler для кнопок "Другая категория" и "Готово" при установке бюджета
-@bot.callback_query_handler(func=lambda call: call.data in ("cat_budget_again", "cat_budget_done"))
+@router.callback("cat_budget_again", "cat_budget_done")
 def category_budget_next_action(call):
     user_id = call.from_user.id
     if call.data == "cat_budget_again":
@@ -2098,7 +2346,7 @@ def category_budget_next_action(call):
 
 
 # Callback handler для выбора категории при установке бюджета
-@bot.callback_query_handler(func=lambda call: call.from_user.id in user_data and (user_data[call.from_user.id].get('step') == 'select_category_for_budget' or 'select_category_for_budget' in str(user_data[call.from_user.id])))
+@router.callback_prefix("cat_", step="select_category_for_budget")
 def select_category_for_budget_callback(call):
     """
     Обработчик callback-запроса при выборе категории для установки бюджета.
@@ -2123,16 +2371,12 @@ def select_category_for_budget_callback(call):
         bot.answer_callback_query(call.id, "Ошибка: активное путешествие не найдено")
         return
     
-    # Получаем список категорий
-    try:
-        categories = database.get_all_categories()
-        if category_id < 1 or category_id > len(categories):
-            bot.answer_callback_query(call.id, "Ошибка: категория не найдена")
-            return
-        category_name = categories[category_id-1]['name']
-    except (IndexError, TypeError):
+    # Получаем категорию из справочника
+    category = database.get_category(category_id)
+    if not category:
         bot.answer_callback_query(call.id, "Ошибка: категория не найдена")
         return
+    category_name = category['name']
     
     # Обновляем состояние пользователя: выбрали категорию, теперь ждём сумму
     # Проверяем, есть ли уже step, если нет, то создаём его
@@ -2154,7 +2398,7 @@ def select_category_for_budget_callback(call):
     )
 
 
-@bot.message_handler(func=lambda message: user_data.get(message.from_user.id, {}).get('step') == 'enter_budget_amount_for_category')
+@router.step("enter_budget_amount_for_category")
 def process_category_budget_amount(message):
     """
     Обработчик ввода суммы бюджета для выбранной категории.
@@ -2184,8 +2428,8 @@ def process_category_budget_amount(message):
         database.set_category_budget(trip_id, category_id, planned_amount, currency_code)
         
         # Получаем название категории
-        categories = database.get_all_categories()
-        category_name = categories[category_id-1]['name'] if 1 <= category_id <= len(categories) else "Категория"
+        category = database.get_category(category_id)
+        category_name = category['name'] if category else "Категория"
             
         bot.send_message(message.chat.id, f"✅ Бюджет записан в категорию '{category_name}': {planned_amount:.2f} {currency_code}")
         
@@ -2212,8 +2456,16 @@ def process_category_budget_amount(message):
 
 
 if __name__ == "__main__":
-    database.init_db() # Ensure tables exist
-    database.ensure_category_id_column()  # Ensure category_id column exists
-    database.update_all_old_expenses()  # Update all old expenses without category
+    database.init_db() # Применяем недостающие миграции схемы
+    select_category_keyboard() # Загружаем справочник категорий и собираем клавиатуру заранее
+    api_client.rate_matrix.start() # Фоновое обновление снимка курсов /live
+    api_client.currency_catalog.start() # Каталог поддерживаемых валют (/list), обновляется раз в неделю
+    trip_rate_refresher.start() # Фоновое обновление курсов путешествий с политикой "auto"
     print("Бот запущен...")
     bot.infinity_polling()
+    trip_rate_refresher.stop()
+    api_client.rate_matrix.stop()
+    api_client.currency_catalog.stop()
+    api_client.flush_quota_usage() # Сохранить учтенный расход квоты API
+    database.shutdown_writer()
+    database.close_all_connections()
@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Потокобезопасный кэш ограниченного размера с вытеснением давно не использованных
+    записей (LRU) и необязательным временем жизни записей (TTL).
+
+    Считает попадания, промахи и вытеснения — их можно получить через stats().
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        """
+        Args:
+            maxsize: Максимальное число записей
+            ttl: Время жизни записи в секундах (None — без ограничения)
+            clock: Источник времени (нужен для подмены в отладке)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Получить значение по ключу (просроченные записи считаются отсутствующими)"""
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires_at = entry
+                if expires_at is None or expires_at > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """Сохранить значение; ttl переопределяет время жизни по умолчанию для этой записи"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = self._clock() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Удалить запись и вернуть ее значение"""
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def purge_expired(self):
+        """Удалить все просроченные записи. Возвращает число удаленных"""
+        now = self._clock()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._data.items()
+                       if expires_at is not None and expires_at <= now]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            return entry is not _MISSING and (entry[1] is None or entry[1] > self._clock())
+
+    def stats(self):
+        """Счетчики кэша: размер, попадания, промахи, вытеснения и доля попаданий"""
+        with self._lock:
+            size, hits, misses, evictions = len(self._data), self.hits, self.misses, self.evictions
+        total = hits + misses
+        return {
+            'size': size,
+            'maxsize': self.maxsize,
+            'hits': hits,
+            'misses': misses,
+            'evictions': evictions,
+            'hit_rate': hits / total if total else 0.0,
+        }
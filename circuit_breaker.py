@@ -0,0 +1,88 @@
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса.
+
+    В состоянии closed запросы проходят. После failure_threshold неудач подряд
+    предохранитель размыкается (open): запросы сразу отклоняются, не тратя время
+    на таймауты. Через reset_timeout секунд пропускается один пробный запрос
+    (half_open): успех замыкает цепь, неудача снова размыкает ее.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        # Вызывается под self._lock
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return self._state
+
+    def allow(self):
+        """Можно ли выполнить запрос сейчас"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if self._clock() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self._state = HALF_OPEN
+                self._trial_in_flight = False
+            # half_open: пропускаем только один пробный запрос
+            if self._trial_in_flight:
+                self.rejected += 1
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def cancel(self):
+        """Разрешенный запрос так и не был отправлен: освободить место пробного запроса"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self.trips += 1
+                self._state = OPEN
+                self._opened_at = self._clock()
+                self._trial_in_flight = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self._current_state(),
+                "failures": self._failures,
+                "rejected": self.rejected,
+                "trips": self.trips,
+            }
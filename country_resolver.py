@@ -0,0 +1,152 @@
+import functools
+import os
+import threading
+import unicodedata
+from collections import defaultdict, namedtuple
+
+# Компактный файл со всеми странами и территориями ISO 3166-1 и их валютами
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "countries.dat")
+
+# Минимальное сходство (коэффициент Дайса по триграммам), при котором опечатка считается совпадением
+FUZZY_THRESHOLD = 0.58
+# Более короткие запросы сравниваются только точно: "ne" или "ит" — не опечатки
+FUZZY_MIN_LENGTH = 4
+
+Country = namedtuple("Country", ["alpha2", "alpha3", "currency", "name_en", "name_ru"])
+
+_TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z", "и": "i",
+    "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s",
+    "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch",
+    "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+}
+
+
+def normalize(text):
+    """Привести название к виду для сравнения: регистр, ё/е, диакритика, пунктуация и лишние пробелы"""
+    text = text.casefold().replace("ё", "е").replace("й", "\0")
+    # Снимаем диакритику латиницы (México -> mexico); "й" защищаем, иначе она распадется в "и"
+    text = "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+    text = text.replace("\0", "й")
+    return " ".join("".join(ch if ch.isalnum() else " " for ch in text).split())
+
+
+def transliterate(text):
+    """Кириллица -> латиница (германия -> germaniya), чтобы находить названия, набранные транслитом"""
+    return "".join(_TRANSLIT.get(ch, ch) for ch in text)
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CountryIndex:
+    """
+    Индекс стран для поиска валюты по названию, введенному пользователем.
+
+    Точное совпадение ищется в словаре по нормализованным названиям (ru/en),
+    синонимам и их транслитерации, а коды alpha-2/alpha-3 — в отдельном словаре
+    без транслитерации. Опечатки находит триграммный индекс: кандидаты — названия
+    с общими триграммами, лучший выбирается по коэффициенту Дайса.
+    """
+
+    def __init__(self, countries):
+        self.countries = list(countries)
+        self._exact = {}
+        self._codes = {}
+        self._keys = []
+        self._key_countries = []
+        self._key_trigrams = []
+        self._trigram_index = defaultdict(list)
+        for country, names in self.countries:
+            for code in (country.alpha2, country.alpha3):
+                if code:
+                    self._codes.setdefault(normalize(code), country)
+            for name in names:
+                key = normalize(name)
+                if not key:
+                    continue
+                for variant in dict.fromkeys((key, transliterate(key))):
+                    self._exact.setdefault(variant, country)
+                    if len(variant) >= FUZZY_MIN_LENGTH:
+                        self._add_fuzzy_key(variant, country)
+
+    def _add_fuzzy_key(self, key, country):
+        key_id = len(self._keys)
+        trigrams = _trigrams(key)
+        self._keys.append(key)
+        self._key_countries.append(country)
+        self._key_trigrams.append(len(trigrams))
+        for trigram in trigrams:
+            self._trigram_index[trigram].append(key_id)
+
+    @classmethod
+    def load(cls, path=DATA_FILE):
+        """Прочитать файл countries.dat"""
+        countries = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                alpha2, alpha3, currency, name_en, name_ru, aliases = line.split(";", 5)
+                country = Country(alpha2, alpha3 or None, currency or None, name_en, name_ru)
+                names = [name_en, name_ru, *aliases.split("|")]
+                countries.append((country, names))
+        return cls(countries)
+
+    def resolve(self, text):
+        """Найти страну по названию, коду или синониму (с учетом опечаток); None, если не найдена"""
+        query = normalize(text)
+        if not query:
+            return None
+        # Коды сравниваем только с запросом как есть: транслитерация "дом" -> "dom" не должна давать код DOM
+        country = self._exact.get(query) or self._codes.get(query) or self._exact.get(transliterate(query))
+        if country is not None:
+            return country
+        return self._fuzzy(transliterate(query)) if len(query) >= FUZZY_MIN_LENGTH else None
+
+    def _fuzzy(self, query):
+        trigrams = _trigrams(query)
+        common = defaultdict(int)
+        for trigram in trigrams:
+            for key_id in self._trigram_index.get(trigram, ()):
+                common[key_id] += 1
+        best, best_score = None, FUZZY_THRESHOLD
+        for key_id, count in common.items():
+            score = 2 * count / (len(trigrams) + self._key_trigrams[key_id])
+            if score > best_score:
+                best, best_score = self._key_countries[key_id], score
+        return best
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Индекс стран; файл читается один раз при первом обращении"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = CountryIndex.load()
+    return _index
+
+
+@functools.lru_cache(maxsize=4096)
+def resolve(text):
+    """Найти страну (Country) по введенному тексту или вернуть None"""
+    return get_index().resolve(text)
+
+
+def currencies():
+    """Коды валют всех стран из файла (запасной каталог валют без сети)"""
+    return frozenset(country.currency for country, _ in get_index().countries if country.currency)
+
+
+def guess_currency(text):
+    """Код валюты страны по введенному тексту или None"""
+    country = resolve(text)
+    return country.currency if country else None
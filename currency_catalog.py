@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+
+
+class CurrencyCatalog:
+    """
+    Каталог поддерживаемых валют для мгновенной проверки кодов.
+
+    Ответ /list хранится в файле на диске и при запуске загружается во frozenset,
+    поэтому проверка кода — это поиск в памяти без обращения к API. Раз в
+    refresh_interval секунд каталог обновляется (в фоне, если запущен start()).
+    Пока каталог ни разу не загружался, используется запасной список (fallback).
+    """
+
+    def __init__(self, fetch_list, path, refresh_interval=7 * 24 * 3600, retry_interval=3600, fallback=None):
+        """
+        Args:
+            fetch_list: Функция fetch_list() -> ответ /list ({'success': True, 'currencies': {'USD': '...', ...}})
+            path: Файл, в котором хранится каталог
+            refresh_interval: Период обновления каталога в секундах
+            retry_interval: Через сколько секунд повторять неудачное обновление
+            fallback: Функция fallback() -> {код: название}, если сохраненного каталога нет
+        """
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self._fetch_list = fetch_list
+        self._fallback = fallback
+        self._names = {}
+        self._codes = frozenset()
+        self._fetched_at = None
+        self._retry_at = 0.0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            if not self._load_file() and self._fallback is not None:
+                self._set(self._fallback(), None)
+            self._loaded = True
+
+    def _load_file(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                stored = json.load(f)
+            currencies = stored["currencies"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if not currencies:
+            return False
+        self._set(currencies, stored.get("fetched_at"))
+        return True
+
+    def _set(self, currencies, fetched_at):
+        # Подменяем словарь и множество целиком: читатели без блокировок видят согласованный каталог
+        self._names = {code.upper(): name for code, name in currencies.items()}
+        self._codes = frozenset(self._names)
+        self._fetched_at = fetched_at
+
+    def refresh(self):
+        """Загрузить каталог из API и сохранить его на диск. Возвращает True при успехе"""
+        try:
+            data = self._fetch_list()
+        except Exception:
+            data = None
+        currencies = (data or {}).get("currencies") if (data or {}).get("success") else None
+        if not currencies:
+            self._retry_at = time.time() + self.retry_interval
+            return False
+        fetched_at = time.time()
+        with self._lock:
+            self._set(currencies, fetched_at)
+            self._loaded = True
+        self._save(currencies, fetched_at)
+        return True
+
+    def _save(self, currencies, fetched_at):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"fetched_at": fetched_at, "currencies": currencies}, f, ensure_ascii=False)
+            # Атомарная замена: при сбое на диске остается прежний каталог
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    def is_stale(self):
+        self._ensure_loaded()
+        return self._fetched_at is None or time.time() - self._fetched_at >= self.refresh_interval
+
+    def refresh_if_stale(self):
+        if self.is_stale() and time.time() >= self._retry_at:
+            return self.refresh()
+        return False
+
+    @property
+    def codes(self):
+        """frozenset поддерживаемых кодов валют"""
+        self._ensure_loaded()
+        return self._codes
+
+    def is_supported(self, code):
+        """Есть ли валюта с таким кодом в каталоге"""
+        return code.upper() in self.codes
+
+    def name(self, code):
+        """Название валюты или None"""
+        self._ensure_loaded()
+        return self._names.get(code.upper())
+
+    def suggest(self, code, limit=3):
+        """Коды из каталога, отличающиеся от code одной буквой или перестановкой соседних букв"""
+        code = code.upper()
+        return sorted(candidate for candidate in self.codes if _is_near_miss(code, candidate))[:limit]
+
+    def start(self):
+        """Запустить фоновое обновление каталога раз в refresh_interval секунд"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="currency-catalog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh_if_stale()
+            if self._fetched_at is not None and not self.is_stale():
+                wait = self.refresh_interval - (time.time() - self._fetched_at)
+            else:
+                wait = max(self._retry_at - time.time(), 1)
+            self._stop.wait(wait)
+
+    def stats(self):
+        self._ensure_loaded()
+        return {
+            "currencies": len(self._codes),
+            "fetched_at": self._fetched_at,
+            "stale": self.is_stale(),
+        }
+
+
+def _is_near_miss(code, candidate):
+    # Одна замененная буква (EUE -> EUR) или переставленные соседние буквы (UDS -> USD)
+    if len(code) != len(candidate) or code == candidate:
+        return False
+    diff = [i for i in range(len(code)) if code[i] != candidate[i]]
+    if len(diff) == 1:
+        return True
+    return (len(diff) == 2 and diff[1] == diff[0] + 1
+            and code[diff[0]] == candidate[diff[1]] and code[diff[1]] == candidate[diff[0]])
@@ -0,0 +1,179 @@
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CurrencyAPIError(Exception):
+    """Не удалось получить корректный ответ от API курсов"""
+
+
+class RequestRejectedError(CurrencyAPIError):
+    """API ответило ошибкой 4xx на сам запрос (сервис при этом доступен)"""
+
+
+class UnsupportedEndpointError(RequestRejectedError):
+    """Источник курсов не умеет выполнять такой запрос (например, исторические курсы timeframe)"""
+
+
+class CircuitOpenError(CurrencyAPIError):
+    """Предохранитель разомкнут: API недавно не отвечало, запрос не отправлялся"""
+
+
+class RequestNotSentError(CurrencyAPIError):
+    """Запрос не отправлен по решению самого клиента (например, исчерпана квота)"""
+
+
+# Статусы, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CurrencyClient:
+    """
+    HTTP-клиент API курсов валют.
+
+    Держит один requests.Session с пулом keep-alive соединений, поэтому повторные
+    запросы не платят за новое TCP/TLS-соединение. Каждый запрос ограничен таймаутами
+    на подключение и чтение; сетевые ошибки, 429 и 5xx повторяются ограниченное число
+    раз с экспоненциальной паузой со случайным разбросом (jitter). Ответ проверяется:
+    это должен быть JSON-объект с полем success.
+
+    Если задан предохранитель (CircuitBreaker), то после серии неудач запросы
+    отклоняются сразу с CircuitOpenError, пока сервис не восстановится.
+
+    before_request вызывается перед каждой HTTP-попыткой, включая повторы, — здесь
+    учитывается квота: каждая попытка расходует ее так же, как первая.
+    """
+
+    def __init__(self, base_url, access_key=None, connect_timeout=3.05, read_timeout=10,
+                 retries=2, backoff=0.3, max_backoff=5.0, pool_size=10, session=None, breaker=None,
+                 before_request=None):
+        """
+        Args:
+            base_url: Адрес API (например: http://api.exchangerate.host)
+            access_key: Ключ доступа, добавляется к каждому запросу
+            connect_timeout: Таймаут подключения в секундах
+            read_timeout: Таймаут чтения ответа в секундах
+            retries: Сколько раз повторять неудачный запрос
+            backoff: Базовая пауза перед повтором в секундах (удваивается с каждой попыткой)
+            max_backoff: Максимальная пауза перед повтором
+            pool_size: Размер пула соединений (по числу потоков, одновременно обращающихся к API)
+            session: Готовый requests.Session (по умолчанию создается новый)
+            breaker: CircuitBreaker для быстрого отказа при недоступности API
+            before_request: Функция before_request(endpoint), вызываемая перед каждой HTTP-попыткой;
+                может отменить попытку, выбросив RequestNotSentError (например, QuotaExceededError)
+        """
+        self.base_url = base_url.rstrip("/")
+        self.access_key = access_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = session or self._make_session(pool_size)
+        self.breaker = breaker
+        self.before_request = before_request
+        self.requests_sent = 0
+        self.failures = 0
+
+    @staticmethod
+    def _make_session(pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def get(self, endpoint, params=None, required=()):
+        """
+        Выполнить GET-запрос к endpoint и вернуть разобранный JSON.
+
+        Args:
+            endpoint: Путь без ведущего слэша (например: "live")
+            params: Параметры запроса (access_key добавляется автоматически)
+            required: Поля, обязательные в успешном ответе (success = true)
+
+        Raises:
+            CurrencyAPIError: если после всех попыток нет корректного ответа
+            CircuitOpenError: если предохранитель разомкнут
+        """
+        if self.breaker is None:
+            return self._get(endpoint, params, required)
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"API курсов временно недоступно, запрос к {endpoint} не отправлен")
+        try:
+            data = self._get(endpoint, params, required)
+        except RequestNotSentError:
+            # Ответа сервиса не было — ни успех, ни неудача; место пробного запроса освобождаем
+            self.breaker.cancel()
+            raise
+        except RequestRejectedError:
+            # Сервис ответил — это не признак его недоступности
+            self.breaker.record_success()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return data
+
+    def _get(self, endpoint, params, required):
+        url = f"{self.base_url}/{endpoint}"
+        params = dict(params or {})
+        if self.access_key:
+            params.setdefault("access_key", self.access_key)
+
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._sleep_before_retry(attempt)
+            if self.before_request is not None:
+                self.before_request(endpoint)
+            self.requests_sent += 1
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                last_error = exc
+                continue
+            if response.status_code in RETRY_STATUSES:
+                last_error = CurrencyAPIError(f"HTTP {response.status_code} от {endpoint}")
+                continue
+            if response.status_code >= 400:
+                self.failures += 1
+                raise RequestRejectedError(f"HTTP {response.status_code} от {endpoint}")
+            try:
+                data = response.json()
+            except ValueError as exc:
+                # Обрезанный ответ или HTML-страница прокси — имеет смысл повторить
+                last_error = CurrencyAPIError(f"Некорректный JSON от {endpoint}: {exc}")
+                continue
+            return self._validate(endpoint, data, required)
+
+        self.failures += 1
+        if isinstance(last_error, CurrencyAPIError):
+            raise last_error
+        raise CurrencyAPIError(f"Запрос к {endpoint} не выполнен: {last_error}") from last_error
+
+    def supports(self, endpoint):
+        """API exchangerate.host выполняет любые свои запросы (live, convert, list, timeframe)"""
+        return True
+
+    def _validate(self, endpoint, data, required):
+        if not isinstance(data, dict) or "success" not in data:
+            self.failures += 1
+            raise CurrencyAPIError(f"Неожиданный формат ответа от {endpoint}")
+        if data["success"]:
+            missing = [field for field in required if field not in data]
+            if missing:
+                self.failures += 1
+                raise CurrencyAPIError(f"В ответе {endpoint} нет полей: {', '.join(missing)}")
+        return data
+
+    def _sleep_before_retry(self, attempt):
+        # "Full jitter": случайная пауза от 0 до экспоненциального предела,
+        # чтобы повторы из разных потоков не приходили к API одновременно
+        limit = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        time.sleep(random.uniform(0, limit))
+
+    def close(self):
+        self.session.close()
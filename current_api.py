@@ -1,84 +1,685 @@
-import requests
 from dotenv import load_dotenv
+import functools
 import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import country_resolver
+import database
+import quota
+from async_currency_client import AsyncCurrencyClient
+from circuit_breaker import CircuitBreaker
+from currency_catalog import CurrencyCatalog
+from currency_client import CurrencyAPIError, CurrencyClient
+from rate_matrix import RateMatrix
+from rate_providers import FileRatesProvider, HedgedProvider, OpenERAPIClient, OpenERAPIProvider
 
 load_dotenv()
 
 API_KEY = os.getenv("CURRENCY_ACCESS_KEY")
-BASE_URL = "http://api.exchangerate.host"
+# Адрес API; для тестов и замеров можно указать локальный fake_rates_server.py
+BASE_URL = os.getenv("CURRENCY_API_URL", "http://api.exchangerate.host")
+
+# Таймауты (подключение, чтение) и число повторов запросов к API, секунды
+CONNECT_TIMEOUT = float(os.getenv("CURRENCY_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.getenv("CURRENCY_READ_TIMEOUT", 10))
+RETRIES = int(os.getenv("CURRENCY_RETRIES", 2))
+
+# Квота API: запросов в секунду (в среднем и подряд), лимит за месяц (0 — без ограничения),
+# доля месячного лимита для фоновых обновлений и сколько секунд запрос может ждать своей очереди
+QUOTA_PER_SECOND = float(os.getenv("CURRENCY_QUOTA_PER_SECOND", 5))
+QUOTA_BURST = int(os.getenv("CURRENCY_QUOTA_BURST", 5))
+QUOTA_MONTHLY = int(os.getenv("CURRENCY_QUOTA_MONTHLY", 0))
+QUOTA_BACKGROUND_SHARE = float(os.getenv("CURRENCY_QUOTA_BACKGROUND_SHARE", 0.8))
+QUOTA_MAX_WAIT = float(os.getenv("CURRENCY_QUOTA_MAX_WAIT", 2))
+# Месячный лимит резервного источника open_er_api (0 — без ограничения, только учет)
+OPEN_ER_API_QUOTA_MONTHLY = int(os.getenv("OPEN_ER_API_QUOTA_MONTHLY", 0))
+
+# Источники курсов в порядке приоритета: exchangerate_host, open_er_api, file
+RATE_PROVIDERS = [name.strip() for name in os.getenv("RATE_PROVIDERS", "exchangerate_host").split(",") if name.strip()]
+# Через сколько секунд без ответа источника запрашивать следующий (hedged-запрос)
+RATE_HEDGE_DELAY = float(os.getenv("RATE_HEDGE_DELAY", 0.5))
+# Локальный файл курсов для источника file (XML ЕЦБ или JSON)
+RATES_FILE = os.getenv("RATES_FILE", "rates.xml")
+OPEN_ER_API_URL = os.getenv("OPEN_ER_API_URL", "https://open.er-api.com/v6")
+
+# Предохранитель: после скольких неудачных запросов подряд перестать обращаться к API и на сколько секунд
+BREAKER_FAILURES = int(os.getenv("CURRENCY_BREAKER_FAILURES", 5))
+BREAKER_RESET = float(os.getenv("CURRENCY_BREAKER_RESET", 30))
+
+# Кэш курсов: сколько секунд курс считается свежим и сколько пар хранить
+RATE_CACHE_TTL = float(os.getenv("RATE_CACHE_TTL", 600))
+RATE_CACHE_SIZE = int(os.getenv("RATE_CACHE_SIZE", 512))
+# Сколько секунд после истечения RATE_CACHE_TTL курс еще можно отдавать как устаревший
+RATE_STALE_TTL = float(os.getenv("RATE_STALE_TTL", 24 * 3600))
+
+# Матрица кросс-курсов: базовая валюта снимка /live и период его обновления в секундах
+RATE_MATRIX_BASE = os.getenv("RATE_MATRIX_BASE", "USD")
+RATE_MATRIX_REFRESH = float(os.getenv("RATE_MATRIX_REFRESH", 3600))
+
+# Каталог поддерживаемых валют (ответ /list): файл на диске и период его обновления в секундах
+CURRENCY_CATALOG_FILE = os.getenv("CURRENCY_CATALOG_FILE", "currencies.json")
+CURRENCY_CATALOG_REFRESH = float(os.getenv("CURRENCY_CATALOG_REFRESH", 7 * 24 * 3600))
+
+# Насколько старый сохраненный в базе курс можно использовать без нового запроса, секунды
+RATE_STORE_MAX_AGE = float(os.getenv("RATE_STORE_MAX_AGE", 6 * 3600))
+
+def _load_api_usage(provider, period):
+    try:
+        return database.get_api_usage(period, provider)
+    except sqlite3.Error:
+        # До применения миграций учет ведется только в памяти
+        return 0
+
+
+def _save_api_usage(provider, period, delta):
+    return database.add_api_usage(period, delta, provider)
+
+
+def _make_quota_manager(name, monthly_limit):
+    return quota.QuotaManager(
+        per_second=QUOTA_PER_SECOND,
+        burst=QUOTA_BURST,
+        monthly_limit=monthly_limit,
+        background_share=QUOTA_BACKGROUND_SHARE,
+        max_wait=QUOTA_MAX_WAIT,
+        load_usage=functools.partial(_load_api_usage, name),
+        save_usage=functools.partial(_save_api_usage, name),
+        name=name,
+    )
+
+
+# Учет и ограничение запросов отдельно по каждому сетевому источнику: квоту расходует каждая
+# HTTP-попытка (включая повторы), пользовательские запросы идут раньше фоновых обновлений
+quota_manager = _make_quota_manager("exchangerate_host", QUOTA_MONTHLY)
+quota_managers = {
+    "exchangerate_host": quota_manager,
+    "open_er_api": _make_quota_manager("open_er_api", OPEN_ER_API_QUOTA_MONTHLY),
+}
+
+# Общий клиент: пул keep-alive соединений, таймауты, повторы с jitter и предохранитель
+breaker = CircuitBreaker(failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET)
+client = CurrencyClient(
+    BASE_URL,
+    access_key=API_KEY,
+    connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT,
+    retries=RETRIES,
+    breaker=breaker,
+    before_request=quota_manager.before_request,
+)
+
+
+def _make_provider(name):
+    if name == "exchangerate_host":
+        return client
+    if name == "open_er_api":
+        return OpenERAPIProvider(OpenERAPIClient(
+            OPEN_ER_API_URL,
+            connect_timeout=CONNECT_TIMEOUT,
+            read_timeout=READ_TIMEOUT,
+            retries=RETRIES,
+            breaker=CircuitBreaker(failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET),
+            before_request=quota_managers["open_er_api"].before_request,
+        ), base=RATE_MATRIX_BASE)
+    if name == "file":
+        return FileRatesProvider(RATES_FILE)
+    raise ValueError(f"Неизвестный источник курсов: {name}")
+
+
+# Один источник используется напрямую, несколько — с подстраховывающими запросами
+if len(RATE_PROVIDERS) == 1:
+    provider = _make_provider(RATE_PROVIDERS[0])
+else:
+    provider = HedgedProvider([(name, _make_provider(name)) for name in RATE_PROVIDERS], hedge_delay=RATE_HEDGE_DELAY)
+
+# Асинхронная обертка: одинаковые одновременные запросы из разных потоков бота объединяются в один
+async_client = AsyncCurrencyClient(provider)
+
+
+def _error_response(exc):
+    return {"success": False, "error": {"info": str(exc)}}
+
+
+def _request(endpoint, params=None, required=(), priority=quota.INTERACTIVE):
+    """
+    Запрос к API через общий клиент (с объединением одинаковых одновременных запросов).
+    priority — полоса квоты: quota.INTERACTIVE для запросов пользователя, quota.BACKGROUND для фоновых.
+    Сетевые ошибки и исчерпанная квота возвращаются в том же виде, что и ошибки самого API:
+    {'success': False, 'error': {...}}
+    """
+    try:
+        return async_client.get_sync(endpoint, params, required=required, priority=priority)
+    except CurrencyAPIError as exc:
+        return _error_response(exc)
+
 
 # функция для получения курсов
-def get_current_rate(default: str = "USD", currencies: list[str] = ["EUR", "GBP", "JPY"]) :
-    url = f"{BASE_URL}/live"
+def get_current_rate(default: str = "USD", currencies: list[str] = ["EUR", "GBP", "JPY"], priority=quota.INTERACTIVE) :
     params = {
-        "access_key": API_KEY,
         "source": default,
-        "currencies": ",".join(currencies)
     }
+    # Без списка валют /live возвращает курсы ко всем поддерживаемым валютам
+    if currencies:
+        params["currencies"] = ",".join(currencies)
 
-    response = requests.get(url, params=params)
-    data = response.json()
+    data = _request("live", params, required=("quotes",), priority=priority)
+    if data.get("success"):
+        source = data.get("source", default)
+        timestamp = data.get("timestamp") or int(time.time())
+        store_rates([
+            (source, pair[len(source):], timestamp, rate)
+            for pair, rate in data["quotes"].items()
+            if pair.startswith(source) and rate
+        ])
     return data
 
 
 # функция конвертации
-def convert_currency(amount, from_currency, to_currency):
+def convert_currency(amount, from_currency, to_currency, priority=quota.INTERACTIVE):
     """ Выходный данные:
     {'success': True, 'query': {'from': 'RUB', 'to': 'KZT', 'amount': 100}, 'info': {'timestamp': 1768685464, 'quote': 6.572788}, 'result': 657.2788}
     """
-    url = f"{BASE_URL}/convert"
     params = {
-        "access_key": API_KEY,
         "from": from_currency,
         "to": to_currency,
         "amount": amount
     }
 
-    response = requests.get(url, params=params)
-    data = response.json()
+    data = _request("convert", params, required=("info", "result"), priority=priority)
+    _store_convert_response(from_currency, to_currency, data)
     return data
 
+
+def _store_convert_response(from_currency, to_currency, data):
+    if data.get("success"):
+        info = data["info"] or {}
+        if info.get("quote"):
+            store_rates([(from_currency, to_currency, info.get("timestamp") or int(time.time()), info["quote"])])
+
 # Поддерживаемая валюта
-def get_all_supported_currencies():
-    url = f"{BASE_URL}/list"
-    params = {
-        "access_key": API_KEY,
-    }
-    response = requests.get(url, params=params)
-    data = response.json()
-    return data
+def get_all_supported_currencies(priority=quota.INTERACTIVE):
+    return _request("list", required=("currencies",), priority=priority)
 
-# --- Хелперы для бота ---
 
-COUNTRY_TO_CURRENCY = {
-    "Russia": "RUB", "Russia (RU)": "RUB", "RU": "RUB", "РФ": "RUB", "Россия": "RUB",
-    "USA": "USD", "United States": "USD", "US": "USD", "США": "USD",
-    "EU": "EUR", "Europe": "EUR", "Germany": "EUR", "France": "EUR", "Italy": "EUR",
-    "China": "CNY", "CN": "CNY", "Китай": "CNY",
-    "Turkey": "TRY", "TR": "TRY", "Турция": "TRY",
-    "Thailand": "THB", "TH": "THB", "Таиланд": "THB",
-    "UAE": "AED", "AE": "AED", "ОАЭ": "AED",
-    "UK": "GBP", "United Kingdom": "GBP", "GB": "GBP", "Великобритания": "GBP",
-    "Kazakhstan": "KZT", "KZ": "KZT", "Казахстан": "KZT",
-    "Georgia": "GEL", "GE": "GEL", "Грузия": "GEL",
-    "Armenia": "AMD", "AM": "AMD", "Армения": "AMD",
-}
+# Каталог валют для проверки кодов, введенных пользователем: поиск во frozenset без запросов к API.
+# Пока /list ни разу не загружался, используются валюты всех стран из country_resolver
+currency_catalog = CurrencyCatalog(
+    lambda: get_all_supported_currencies(priority=quota.BACKGROUND),
+    path=CURRENCY_CATALOG_FILE,
+    refresh_interval=CURRENCY_CATALOG_REFRESH,
+    fallback=lambda: {code: code for code in country_resolver.currencies()},
+)
+
+
+def get_quota_stats():
+    """
+    Расход квоты API по источникам курсов: {источник: учтенные HTTP-запросы за месяц,
+    оставшийся бюджет (для пользователей и для фоновых обновлений; None — без ограничения),
+    токены в ведре, выданные и отклоненные разрешения по полосам приоритета}.
+    """
+    return {name: manager.stats() for name, manager in quota_managers.items()}
+
+
+def flush_quota_usage():
+    """Сохранить учтенный расход квоты всех источников"""
+    for manager in quota_managers.values():
+        manager.flush()
+
+# --- Хелперы для бота ---
 
 def guess_currency(country_name):
     """
     Попытка угадать код валюты по названию страны.
+    Понимает русские и английские названия, коды ISO (RU, RUS), транслит и опечатки
+    (см. country_resolver); работает без сети.
     """
-    return COUNTRY_TO_CURRENCY.get(country_name)
+    return country_resolver.guess_currency(country_name)
 
-def get_exchange_rate(from_currency, to_currency):
+# --- Кэш курсов ---
+
+# Результат поиска курса: сам курс, устарел ли он (старше RATE_CACHE_TTL) и его возраст в секундах
+RateQuote = namedtuple("RateQuote", ["rate", "stale", "age"])
+
+# (from, to) -> (курс, время получения по time.monotonic).
+# Записи живут RATE_CACHE_TTL + RATE_STALE_TTL: после RATE_CACHE_TTL курс отдается как устаревший
+_rate_cache = cache.LRUCache(maxsize=RATE_CACHE_SIZE, ttl=RATE_CACHE_TTL + RATE_STALE_TTL)
+_rate_stats_lock = threading.Lock()
+_rate_stats = {"hits": 0, "inverse_hits": 0, "stale_hits": 0, "misses": 0, "age_total": 0.0, "age_max": 0.0}
+
+
+def _record_rate_lookup(kind, age=0.0):
+    with _rate_stats_lock:
+        _rate_stats[kind] += 1
+        if kind != "misses":
+            _rate_stats["age_total"] += age
+            _rate_stats["age_max"] = max(_rate_stats["age_max"], age)
+
+
+def _cached_rate(from_currency, to_currency):
+    # (курс, возраст) из кэша, в том числе через обратную пару, или None
+    entry = _rate_cache.get((from_currency, to_currency))
+    if entry is not None:
+        rate, fetched_at = entry
+        return rate, time.monotonic() - fetched_at, "hits"
+    entry = _rate_cache.get((to_currency, from_currency))
+    if entry is not None and entry[0]:
+        rate, fetched_at = entry
+        return 1 / rate, time.monotonic() - fetched_at, "inverse_hits"
+    return None
+
+
+def get_cached_rate(from_currency, to_currency):
     """
-    Получает курс обмена через endpoint convert.
+    Свежий (не старше RATE_CACHE_TTL) курс из кэша или None. Если в кэше есть только
+    обратная пара (to -> from), курс вычисляется как 1 / обратный.
     """
-    data = convert_currency(1, from_currency, to_currency)
+    cached = _cached_rate(from_currency, to_currency)
+    if cached is None or cached[1] > RATE_CACHE_TTL:
+        return None
+    rate, age, kind = cached
+    _record_rate_lookup(kind, age)
+    return rate
+
+
+def remember_rate(from_currency, to_currency, rate):
+    """Сохранить полученный курс в кэш"""
+    _rate_cache.set((from_currency, to_currency), (rate, time.monotonic()))
+
+
+def get_rate_cache_stats():
+    """
+    Статистика кэша курсов: попадания (в том числе по обратной паре и устаревшими курсами),
+    промахи, доля попаданий, средний и максимальный возраст отданных курсов (в секундах),
+    а также состояние предохранителя API.
+    """
+    with _rate_stats_lock:
+        stats = dict(_rate_stats)
+    served = stats["hits"] + stats["inverse_hits"] + stats["stale_hits"]
+    total = served + stats["misses"]
+    age_total = stats.pop("age_total")
+    stats["hit_rate"] = served / total if total else 0.0
+    stats["age_avg"] = age_total / served if served else 0.0
+    cache_stats = _rate_cache.stats()
+    stats["size"] = cache_stats["size"]
+    stats["evictions"] = cache_stats["evictions"]
+    stats["breaker"] = breaker.stats()
+    return stats
+
+
+# --- История курсов в базе ---
+
+def store_rates(rates):
+    """Сохранить полученные курсы [(base, quote, timestamp, rate)] в таблицу exchange_rates"""
+    if not rates:
+        return
+    try:
+        database.save_exchange_rates(rates)
+    except sqlite3.Error:
+        # Сохранение истории не должно мешать получению курса (например, до применения миграций)
+        pass
+
+
+def _stored_rate(from_currency, to_currency, max_age):
+    # (курс, возраст в секундах) из таблицы exchange_rates, в том числе через обратную пару, или None
+    now = time.time()
+    since = int(now - max_age)
+    try:
+        stored = database.get_latest_exchange_rate(from_currency, to_currency, since)
+        if stored:
+            return stored[0], max(now - stored[1], 0)
+        stored = database.get_latest_exchange_rate(to_currency, from_currency, since)
+    except sqlite3.Error:
+        return None
+    if stored and stored[0]:
+        return 1 / stored[0], max(now - stored[1], 0)
+    return None
+
+
+def get_stored_rate(from_currency, to_currency, max_age=RATE_STORE_MAX_AGE):
+    """
+    Самый свежий сохраненный курс пары (или обратной пары) не старше max_age секунд, либо None.
+    Позволяет после перезапуска не запрашивать курсы заново.
+    """
+    stored = _stored_rate(from_currency, to_currency, max_age)
+    return stored[0] if stored else None
+
+
+def _restore_snapshot(base):
+    # Последний сохраненный снимок /live для матрицы: (quotes, возраст в секундах)
+    now = time.time()
+    stored = database.get_latest_exchange_rates(base, since=int(now - RATE_MATRIX_REFRESH))
+    if not stored:
+        return None
+    quotes = {base: 1.0}
+    quotes.update({quote: rate for quote, (rate, _) in stored.items()})
+    oldest = min(timestamp for _, timestamp in stored.values())
+    return quotes, max(now - oldest, 0)
+
+
+# --- Матрица кросс-курсов ---
+
+# Снимок курсов всех валют к RATE_MATRIX_BASE, обновляемый одним запросом /live
+rate_matrix = RateMatrix(
+    lambda base: get_current_rate(base, []),
+    base=RATE_MATRIX_BASE,
+    refresh_interval=RATE_MATRIX_REFRESH,
+    restore=_restore_snapshot,
+    background_fetch=lambda base: get_current_rate(base, [], priority=quota.BACKGROUND),
+)
+
+
+def get_matrix_rate(from_currency, to_currency):
+    """
+    Кросс-курс из матрицы или None, если пары в снимке нет.
+    Если фоновое обновление не запущено, устаревший снимок обновляется при обращении
+    (после неудачи — не чаще раза в retry_interval).
+    """
+    rate_matrix.refresh_if_stale()
+    return rate_matrix.rate(from_currency, to_currency)
+
+
+def get_snapshot_rates(pairs):
+    """
+    Курсы сразу для множества пар по одному снимку /live (для фонового обновления курсов путешествий).
+    Отдельных запросов по парам не делается: пары, которых нет в свежем снимке, пропускаются.
+    
+    Returns:
+        ({(from_currency, to_currency): курс}, unix timestamp снимка); ({}, None), если свежего снимка нет
+    """
+    rate_matrix.refresh_if_stale(background=True)
+    if rate_matrix.is_stale():
+        return {}, None
+    rates = {}
+    for pair in pairs:
+        rate = rate_matrix.rate(*pair)
+        if rate is not None:
+            rates[pair] = rate
+    return rates, int(time.time() - rate_matrix.age())
+
+
+# --- Поиск курса: stale-while-revalidate ---
+#
+# Свежий курс (из кэша, матрицы или базы) отдается сразу. Если есть только устаревший,
+# он тоже отдается сразу с пометкой stale, а обновление запускается в фоне.
+# Ждать ответа API приходится, только когда курса нет нигде; если API недоступно,
+# предохранитель (breaker) отклоняет такие запросы мгновенно.
+
+_revalidate_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="rate-revalidate")
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+
+
+def _revalidate_in_background(from_currency, to_currency):
+    # Одно фоновое обновление на пару; заодно обновляем снимок матрицы, если он устарел
+    with _revalidating_lock:
+        if (from_currency, to_currency) in _revalidating:
+            return
+        _revalidating.add((from_currency, to_currency))
+    _revalidate_executor.submit(_revalidate, from_currency, to_currency)
+
+
+def _revalidate(from_currency, to_currency):
+    try:
+        if rate_matrix.needs_refresh():
+            rate_matrix.refresh_if_stale(background=True)
+            if rate_matrix.rate(from_currency, to_currency) is not None:
+                return
+        data = convert_currency(1, from_currency, to_currency, priority=quota.BACKGROUND)
+        _rate_from_convert(from_currency, to_currency, data)
+    finally:
+        with _revalidating_lock:
+            _revalidating.discard((from_currency, to_currency))
+
+
+def _lookup_local(from_currency, to_currency):
+    # Курс без ожидания API: RateQuote или None. Устаревший курс запускает фоновое обновление
+    if from_currency == to_currency:
+        return RateQuote(1.0, False, 0.0)
+
+    cached = _cached_rate(from_currency, to_currency)
+    if cached is not None and cached[1] <= RATE_CACHE_TTL:
+        rate, age, kind = cached
+        _record_rate_lookup(kind, age)
+        return RateQuote(rate, False, age)
+
+    matrix_rate = rate_matrix.rate(from_currency, to_currency)
+    matrix_age = rate_matrix.age()
+    if matrix_rate is not None and not rate_matrix.is_stale():
+        return RateQuote(matrix_rate, False, matrix_age)
+
+    stored = _stored_rate(from_currency, to_currency, RATE_STORE_MAX_AGE)
+    if stored is not None and stored[1] <= RATE_CACHE_TTL:
+        rate, age = stored
+        _rate_cache.set((from_currency, to_currency), (rate, time.monotonic() - age))
+        _record_rate_lookup("hits", age)
+        return RateQuote(rate, False, age)
+
+    # Свежего курса нет — берем самый свежий из устаревших и обновляем в фоне
+    candidates = []
+    if cached is not None:
+        candidates.append(cached[:2])
+    if matrix_rate is not None:
+        candidates.append((matrix_rate, matrix_age))
+    if stored is not None:
+        candidates.append(stored)
+    if not candidates:
+        _record_rate_lookup("misses")
+        return None
+    rate, age = min(candidates, key=lambda candidate: candidate[1])
+    _record_rate_lookup("stale_hits", age)
+    _revalidate_in_background(from_currency, to_currency)
+    return RateQuote(rate, True, age)
+
+
+def _rate_from_convert(from_currency, to_currency, data):
     if data.get("success"):
-        return data.get("info", {}).get("quote")
+        rate = data.get("info", {}).get("quote")
+        if rate:
+            remember_rate(from_currency, to_currency, rate)
+        return rate
     return None
 
+
+def lookup_rate(from_currency, to_currency):
+    """
+    Найти курс обмена (сколько to_currency дают за 1 from_currency).
+    
+    Returns:
+        RateQuote(rate, stale, age) или None, если курс получить не удалось.
+        stale=True означает, что API сейчас не дало свежего курса и отдан последний известный
+        (он обновляется в фоне).
+    """
+    quote = _lookup_local(from_currency, to_currency)
+    if quote is not None:
+        return quote
+    
+    # Холодный старт: пробуем загрузить снимок матрицы, затем конкретную пару
+    rate = get_matrix_rate(from_currency, to_currency)
+    if rate is not None:
+        return RateQuote(rate, False, rate_matrix.age())
+    data = convert_currency(1, from_currency, to_currency)
+    rate = _rate_from_convert(from_currency, to_currency, data)
+    return RateQuote(rate, False, 0.0) if rate else None
+
+
+def get_exchange_rate(from_currency, to_currency):
+    """
+    Получает курс обмена (сколько to_currency дают за 1 from_currency).
+    Порядок: кэш курсов, матрица кросс-курсов из снимка /live, сохраненный в базе курс,
+    и только если пары нигде нет — запрос endpoint convert (ответ кэшируется и сохраняется).
+    Устаревший курс отдается сразу и обновляется в фоне (см. lookup_rate).
+    """
+    quote = lookup_rate(from_currency, to_currency)
+    return quote.rate if quote else None
+
+
+def get_exchange_rates(pairs):
+    """
+    Получает курсы сразу для нескольких пар (например, для всех валют путешествия).
+    Пары, которых нет локально, запрашиваются через convert одновременно.
+    
+    Args:
+        pairs: Список кортежей (from_currency, to_currency)
+    
+    Returns:
+        Словарь {(from_currency, to_currency): курс или None}
+    """
+    rates = {}
+    missing = []
+    for pair in dict.fromkeys(pairs):
+        quote = _lookup_local(*pair)
+        rates[pair] = quote.rate if quote else None
+        if quote is None:
+            missing.append(pair)
+    if not missing:
+        return rates
+    
+    rate_matrix.refresh_if_stale()
+    still_missing = []
+    for pair in missing:
+        rates[pair] = rate_matrix.rate(*pair)
+        if rates[pair] is None:
+            still_missing.append(pair)
+    if not still_missing:
+        return rates
+    
+    responses = async_client.get_many_sync([
+        ("convert", {"from": from_currency, "to": to_currency, "amount": 1}, ("info", "result"))
+        for from_currency, to_currency in still_missing
+    ])
+    for (from_currency, to_currency), data in zip(still_missing, responses):
+        if isinstance(data, CurrencyAPIError):
+            data = _error_response(data)
+        elif isinstance(data, Exception):
+            raise data
+        _store_convert_response(from_currency, to_currency, data)
+        rates[(from_currency, to_currency)] = _rate_from_convert(from_currency, to_currency, data)
+    return rates
+
+
+# --- Исторические курсы и переоценка расходов ---
+
+# Максимальный период одного запроса timeframe, дней
+TIMEFRAME_MAX_DAYS = 365
+
+
+def get_timeframe_rates(start_date, end_date, currencies, source=RATE_MATRIX_BASE, priority=quota.INTERACTIVE):
+    """
+    Дневные курсы за период одним запросом (endpoint timeframe). Курсы сохраняются в базе.
+    
+    Выходные данные:
+    {'success': True, 'source': 'USD', 'quotes': {'2026-10-01': {'USDEUR': 0.92, ...}, ...}}
+    """
+    params = {
+        "start_date": start_date,
+        "end_date": end_date,
+        "source": source,
+        "currencies": ",".join(sorted(currencies)),
+    }
+    data = _request("timeframe", params, required=("quotes",), priority=priority)
+    if data.get("success"):
+        store_rates([
+            (source, pair[len(source):], database.day_timestamp(day), rate)
+            for day, quotes in data["quotes"].items()
+            for pair, rate in (quotes or {}).items()
+            if pair.startswith(source) and rate
+        ])
+    return data
+
+
+def _day_ranges(days, max_days):
+    # Отсортированные даты -> периоды (start, end) не длиннее max_days дней
+    ranges = []
+    for day in days:
+        if ranges and (database.day_timestamp(day) - database.day_timestamp(ranges[-1][0])) // 86400 < max_days:
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [tuple(day_range) for day_range in ranges]
+
+
+def historical_rates_available():
+    """Может ли настроенный источник курсов (хотя бы один из RATE_PROVIDERS) отдавать курсы timeframe"""
+    return provider.supports("timeframe")
+
+
+def get_daily_quotes(days, currencies, source=RATE_MATRIX_BASE):
+    """
+    Дневные курсы валют к source на даты days: {'YYYY-MM-DD': {код: сколько валюты за 1 source}}.
+    Сначала берутся сохраненные в базе курсы; недостающие даты запрашиваются через timeframe
+    (один запрос на каждые TIMEFRAME_MAX_DAYS дней, а не по запросу на дату или пару),
+    если настроенный источник курсов отдает исторические курсы.
+    """
+    wanted = set(currencies) - {source}
+    try:
+        quotes = database.get_daily_exchange_rates(source, days)
+    except sqlite3.Error:
+        quotes = {}
+    missing = []
+    if historical_rates_available():
+        missing = sorted(day for day in days if not wanted <= set(quotes.get(day, {})))
+    for start_date, end_date in _day_ranges(missing, TIMEFRAME_MAX_DAYS):
+        data = get_timeframe_rates(start_date, end_date, wanted, source)
+        if not data.get("success"):
+            continue
+        for day, day_quotes in data["quotes"].items():
+            quotes.setdefault(day, {}).update(
+                (pair[len(source):], rate) for pair, rate in (day_quotes or {}).items() if pair.startswith(source) and rate
+            )
+    for day_quotes in quotes.values():
+        day_quotes[source] = 1.0
+    return quotes
+
+
+def revalue_trip_expenses(trip_id, include_pinned=False):
+    """
+    Переоценить расходы путешествия по курсу на дату каждого расхода.
+    
+    Курсы для всех различных (валюта, дата) загружаются пачкой (см. get_daily_quotes),
+    затем amount_home всех расходов, потраченные суммы категорий и агрегаты пересчитываются
+    в базе одной операцией. Расходы в валютах с закрепленным вручную курсом
+    пересчитываются только при include_pinned=True.
+    
+    Returns:
+        {'updated': пересчитано расходов,
+         'missing': сколько сочетаний (валюта расхода, домашняя валюта, дата) остались без курса,
+         'history_unavailable': True, если курсы не найдены, потому что источник курсов
+             не отдает исторические курсы, а в базе их нет,
+         'total_before': ..., 'total_after': ... (суммы в домашней валюте),
+         'skipped_currencies': валюты, пропущенные из-за закрепленного курса}
+        или None, если путешествие не найдено
+    """
+    keys = database.get_expense_rate_keys(trip_id)
+    if not keys:
+        # Пустой список курсов: база только проверит, что путешествие существует
+        result = database.revalue_expenses(trip_id, [], include_pinned)
+        if result is not None:
+            result['missing'] = 0
+            result['history_unavailable'] = False
+        return result
+    
+    currencies = {code for currency_target, currency_home, _ in keys for code in (currency_target, currency_home)}
+    quotes = get_daily_quotes({day for _, _, day in keys}, currencies)
+    rates = []
+    for currency_target, currency_home, day in keys:
+        day_quotes = quotes.get(day, {})
+        if day_quotes.get(currency_target) and day_quotes.get(currency_home):
+            rates.append((currency_target, currency_home, day, day_quotes[currency_home] / day_quotes[currency_target]))
+    
+    result = database.revalue_expenses(trip_id, rates, include_pinned)
+    if result is None:
+        return None
+    found = {rate[:3] for rate in rates}
+    skipped = set(result['skipped_currencies'])
+    result['missing'] = sum(1 for key in keys if key not in found and key[0] not in skipped)
+    result['history_unavailable'] = bool(result['missing']) and not historical_rates_available()
+    return result
+
 # Точка входа
 if __name__ == "__main__":
     print(convert_currency(100,"RUB","KZT"))
@@ -1,9 +1,166 @@
+import calendar
+import json
+import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 
-def init_db():
-    conn = sqlite3.connect('travel_bot.db')
-    cursor = conn.cursor()
+import cache
+import db_writer
+
+DB_PATH = os.getenv("TRAVEL_BOT_DB", "travel_bot.db")
+
+# Профиль PRAGMA, применяемый к каждому новому соединению.
+# Значения можно переопределить через configure().
+PRAGMAS = {
+    "journal_mode": "WAL",       # читатели не блокируют писателя
+    "synchronous": "NORMAL",     # в режиме WAL fsync только на checkpoint
+    "cache_size": -16000,        # ~16 МБ (отрицательное значение задаётся в КиБ)
+    "mmap_size": 134217728,      # 128 МБ
+    "busy_timeout": 5000,        # мс ожидания блокировки вместо "database is locked"
+}
+
+# Окно группового коммита потока-писателя, секунды
+WRITE_BATCH_WINDOW = 0.003
+
+# Сколько пользователей держать в кэше активных путешествий
+TRIP_CACHE_SIZE = 1024
+
+# Политика курса путешествия: обновлять по рынку или держать зафиксированным
+RATE_POLICY_AUTO = "auto"
+RATE_POLICY_PINNED = "pinned"
+
+# Домашний баланс путешествия: trips.home_balance = target_balance / exchange_rate — остаток
+# в основной валюте по текущему курсу путешествия. Расходы и пополнения записываются по этому
+# же курсу и сдвигают оба баланса согласованно, а каждый путь, меняющий курс или переоценивающий
+# расходы (ручная смена курса, автообновление, /revalue), выводит home_balance заново.
+
+# Источник курсов, к которому относится учет api_usage, если источник не указан
+DEFAULT_API_PROVIDER = "exchangerate_host"
+
+# Одно долгоживущее соединение на поток (telebot обрабатывает апдейты в пуле потоков)
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+
+# Все записи выполняет один поток-писатель со своим соединением (см. db_writer.py)
+_writer = None
+_writer_lock = threading.Lock()
+
+# Справочник категорий расходов в памяти процесса: {category_id: категория}.
+# Загружается при первом обращении; _categories_version растет при каждой инвалидации,
+# чтобы зависимые кэши (например, клавиатуры в bot.py) знали, что их нужно пересобрать.
+_categories = None
+_categories_version = 0
+_categories_lock = threading.Lock()
+
+# Кэш контекста активного путешествия: {user_id: путешествие с валютами или None}.
+# Операции записи отмечают затронутые путешествия и пользователей (_touch_trip / _touch_user),
+# а поток-писатель сбрасывает их записи сразу после завершения транзакции пачки.
+# _trip_cache_generation защищает от записи в кэш данных, прочитанных до этого сброса.
+_trip_cache = cache.LRUCache(maxsize=TRIP_CACHE_SIZE)
+_trip_cache_lock = threading.Lock()
+_trip_cache_generation = 0
+_trip_owners = {}
+_touched_trips = set()
+_touched_users = set()
+_NOT_CACHED = object()
+
+
+def configure(db_path=None, **pragmas):
+    """Изменить путь к базе данных и/или профиль PRAGMA. Открытые соединения будут пересозданы."""
+    global DB_PATH
+    if db_path is not None:
+        DB_PATH = db_path
+    PRAGMAS.update(pragmas)
+    shutdown_writer()
+    close_all_connections()
+    invalidate_categories()
+    invalidate_active_trips()
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    for name, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def get_connection():
+    """Получить соединение текущего потока (создается при первом обращении и затем переиспользуется)"""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.generation != _generation:
+        conn = _connect()
+        _local.conn = conn
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+@contextmanager
+def transaction():
+    """Выполнить блок в одной транзакции: commit при успехе, rollback при исключении"""
+    conn = get_connection()
+    # BEGIN IMMEDIATE сразу берет блокировку записи (ожидание регулируется busy_timeout)
+    # и делает атомарными в том числе DDL-команды миграций
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def submit_write(func, *args, **kwargs):
+    """
+    Поставить операцию записи в очередь потока-писателя.
     
+    func вызывается как func(cursor, *args, **kwargs) внутри общей транзакции пачки;
+    возвращается Future с результатом операции.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = db_writer.WriteQueue(_connect, batch_window=WRITE_BATCH_WINDOW,
+                                           after_batch=_flush_touched)
+            _writer.start()
+        writer = _writer
+    return writer.submit(func, *args, **kwargs)
+
+
+def shutdown_writer():
+    """Дописать очередь записей и остановить поток-писатель"""
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop()
+
+
+def close_all_connections():
+    """Закрыть все соединения пула (при остановке бота или смене настроек)"""
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        for conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+
+
+def init_db():
+    """Создать или обновить схему базы данных до последней версии"""
+    return migrate()
+
+
+def _migration_base_schema(cursor):
     # Table for users (optional, but good for tracking active trip)
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -102,41 +259,307 @@ def init_db():
         FOREIGN KEY(category_id) REFERENCES expense_categories(category_id)
     )
     ''')
-    
-    conn.commit()
-    conn.close()
 
 
-def get_all_categories():
-    """Получить все доступные категории расходов"""
-    conn = sqlite3.connect('travel_bot.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    categories = cursor.execute('SELECT * FROM expense_categories ORDER BY category_id').fetchall()
-    conn.close()
-    return [dict(cat) for cat in categories]
-
-
-def update_all_old_expenses():
-    """Обновить все старые расходы, у которых нет категории, установив им значение по умолчанию (Прочее - 6)"""
-    conn = sqlite3.connect('travel_bot.db')
-    cursor = conn.cursor()
-    
-    # Обновляем все расходы, у которых category_id равен NULL или пустой
+def _migration_default_expense_category(cursor):
+    # Старые расходы без категории относим к "Прочее" (6)
     cursor.execute('''
         UPDATE expenses 
         SET category_id = 6 
         WHERE category_id IS NULL OR category_id = '' OR category_id = 0
     ''')
+
+
+def _migration_unique_category_budgets(cursor):
+    # INSERT OR IGNORE в add_expense_to_category без уникального ключа создавал дубликаты.
+    # Оставляем одну запись на (trip_id, category_id) с максимальным планом...
+    cursor.execute('''
+        UPDATE category_budgets
+        SET planned_amount = (
+            SELECT MAX(cb.planned_amount) FROM category_budgets cb
+            WHERE cb.trip_id = category_budgets.trip_id AND cb.category_id = category_budgets.category_id
+        )
+    ''')
+    cursor.execute('''
+        DELETE FROM category_budgets
+        WHERE budget_id NOT IN (
+            SELECT MIN(budget_id) FROM category_budgets GROUP BY trip_id, category_id
+        )
+    ''')
+    # ...и пересчитываем потраченную сумму по самим расходам
+    cursor.execute('''
+        UPDATE category_budgets
+        SET spent_amount = COALESCE((
+            SELECT SUM(e.amount_home) FROM expenses e
+            WHERE e.trip_id = category_budgets.trip_id AND e.category_id = category_budgets.category_id
+        ), 0)
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_category_budgets_trip_category
+        ON category_budgets (trip_id, category_id)
+    ''')
+
+
+def _migration_indexes(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_trip_timestamp ON expenses (trip_id, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_trip_category ON expenses (trip_id, category_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_trips_user ON trips (user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_trip_currencies_trip_code ON trip_currencies (trip_id, currency_code)')
+
+
+def _migration_trip_totals(cursor):
+    # Агрегат потраченных сумм: одна строка на (путешествие, категория, валюта расхода)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS trip_totals (
+        trip_id INTEGER NOT NULL,
+        category_id INTEGER NOT NULL,
+        currency_code TEXT NOT NULL,
+        amount_home REAL NOT NULL DEFAULT 0.0,
+        amount_target REAL NOT NULL DEFAULT 0.0,
+        expense_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (trip_id, category_id, currency_code)
+    ) WITHOUT ROWID
+    ''')
+    _rebuild_trip_totals(cursor)
+
+
+def _migration_fsm_state(cursor):
+    # Состояние незавершенных диалогов с пользователями (см. state_store.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS fsm_state (
+        user_id INTEGER PRIMARY KEY,
+        state TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state (updated_at)')
+
+
+def _migration_exchange_rates(cursor):
+    # История полученных курсов: сколько quote дают за 1 base на момент timestamp (unix-время).
+    # Первичный ключ (base, quote, timestamp) без rowid одновременно служит индексом по времени для каждой пары.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS exchange_rates (
+        base TEXT NOT NULL,
+        quote TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        rate REAL NOT NULL,
+        PRIMARY KEY (base, quote, timestamp)
+    ) WITHOUT ROWID
+    ''')
+
+
+def _migration_api_usage(cursor):
+    # Сколько запросов к API курсов отправлено за расчетный период (месяц "YYYY-MM")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS api_usage (
+        period TEXT PRIMARY KEY,
+        requests INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+
+def _migration_api_usage_by_provider(cursor):
+    # Квота ведется отдельно для каждого источника курсов; прежний счетчик относился к exchangerate.host
+    cursor.execute('''
+    CREATE TABLE api_usage_by_provider (
+        period TEXT NOT NULL,
+        provider TEXT NOT NULL,
+        requests INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (period, provider)
+    )
+    ''')
+    cursor.execute('''
+        INSERT INTO api_usage_by_provider (period, provider, requests)
+        SELECT period, ?, requests FROM api_usage
+    ''', (DEFAULT_API_PROVIDER,))
+    cursor.execute('DROP TABLE api_usage')
+    cursor.execute('ALTER TABLE api_usage_by_provider RENAME TO api_usage')
+
+
+def _migration_trip_currency_rate_pinned(cursor):
+    # Курс, заданный пользователем вручную, закрепляется только для своей валюты:
+    # автообновление и переоценка его не трогают. Прежние курсы вручную не задавались
+    cursor.execute("ALTER TABLE trip_currencies ADD COLUMN rate_pinned INTEGER NOT NULL DEFAULT 0")
+
+
+def _migration_trip_rate_policy(cursor):
+    # Политика курса путешествия: 'auto' — курс обновляется по рынку, 'pinned' — зафиксирован.
+    # Уже созданные путешествия сохраняют прежнее поведение (курс не меняется)
+    cursor.execute("ALTER TABLE trips ADD COLUMN rate_policy TEXT NOT NULL DEFAULT 'pinned'")
+    cursor.execute("ALTER TABLE trips ADD COLUMN rate_updated_at INTEGER")
+
+
+# Версионированные миграции схемы: (версия, описание, функция).
+# Каждая выполняется один раз в отдельной транзакции, применённые версии хранятся в schema_version.
+# Новые шаги добавляются только в конец списка.
+MIGRATIONS = [
+    (1, "Базовая схема", _migration_base_schema),
+    (2, "Категория по умолчанию для старых расходов", _migration_default_expense_category),
+    (3, "Уникальный бюджет на категорию в путешествии", _migration_unique_category_budgets),
+    (4, "Индексы для запросов по путешествию", _migration_indexes),
+    (5, "Агрегаты расходов trip_totals", _migration_trip_totals),
+    (6, "Хранилище состояния диалогов fsm_state", _migration_fsm_state),
+    (7, "История курсов exchange_rates", _migration_exchange_rates),
+    (8, "Учет запросов к API курсов api_usage", _migration_api_usage),
+    (9, "Политика обновления курса путешествия", _migration_trip_rate_policy),
+    (10, "Учет запросов api_usage по источникам курсов", _migration_api_usage_by_provider),
+    (11, "Закрепление курса отдельной валюты путешествия", _migration_trip_currency_rate_pinned),
+]
+
+
+def get_schema_version():
+    """Получить текущую версию схемы (0, если миграции еще не применялись)"""
+    conn = get_connection()
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def migrate():
+    """Применить все еще не примененные миграции и вернуть итоговую версию схемы"""
+    current = get_schema_version()
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        with transaction() as conn:
+            step(conn.cursor())
+            conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)', (version, description))
+        current = version
+        invalidate_categories()
+    return current
+
+
+# --- Справочник категорий ---
+
+def _load_categories():
+    global _categories
+    with _categories_lock:
+        if _categories is None:
+            rows = get_connection().execute('SELECT * FROM expense_categories ORDER BY category_id').fetchall()
+            _categories = {row['category_id']: dict(row) for row in rows}
+        return _categories
+
+
+def invalidate_categories():
+    """Сбросить справочник категорий в памяти (вызывать после любого изменения expense_categories)"""
+    global _categories, _categories_version
+    with _categories_lock:
+        _categories = None
+        _categories_version += 1
+
+
+def get_categories_version():
+    """Номер версии справочника категорий: меняется при каждой инвалидации"""
+    return _categories_version
+
+
+def get_all_categories():
+    """Получить все доступные категории расходов (из справочника в памяти)"""
+    return [dict(cat) for cat in _load_categories().values()]
+
+
+def get_category(category_id):
+    """Получить категорию по ID из справочника в памяти или None, если такой категории нет"""
+    category = _load_categories().get(category_id)
+    return dict(category) if category else None
+
+
+# --- Активное путешествие пользователя ---
+
+def get_active_trip(user_id):
+    """
+    Получить активное путешествие пользователя вместе с его валютами (ключ 'currencies')
+    или None, если активного путешествия нет. Результат кэшируется до изменения путешествия.
+    """
+    context = _trip_cache.get(user_id, _NOT_CACHED)
+    if context is _NOT_CACHED:
+        generation = _trip_cache_generation
+        conn = get_connection()
+        trip = conn.execute('''
+            SELECT t.* FROM users u
+            JOIN trips t ON t.trip_id = u.active_trip_id
+            WHERE u.user_id = ?
+        ''', (user_id,)).fetchone()
+        context = None
+        if trip:
+            context = dict(trip)
+            context['currencies'] = conn.execute(
+                'SELECT * FROM trip_currencies WHERE trip_id = ?', (trip['trip_id'],)
+            ).fetchall()
+        with _trip_cache_lock:
+            if generation == _trip_cache_generation:
+                _trip_cache.set(user_id, context)
+                if context:
+                    _trip_owners[context['trip_id']] = user_id
     
-    conn.commit()
-    conn.close()
+    if context is None:
+        return None
+    # Отдаем копию, чтобы изменения у вызывающего не попали в кэш
+    trip = dict(context)
+    trip['currencies'] = list(context['currencies'])
+    return trip
+
+
+def invalidate_active_trips(user_id=None, trip_id=None):
+    """Сбросить кэш активных путешествий: для пользователя, для путешествия или целиком (без аргументов)"""
+    global _trip_cache_generation
+    with _trip_cache_lock:
+        _trip_cache_generation += 1
+        if user_id is None and trip_id is None:
+            _trip_cache.clear()
+            _trip_owners.clear()
+            return
+        if trip_id is not None:
+            owner = _trip_owners.pop(trip_id, None)
+            if owner is not None:
+                _trip_cache.pop(owner)
+        if user_id is not None:
+            _trip_cache.pop(user_id)
+
+
+def get_trip_cache_stats():
+    """Счетчики кэша активных путешествий (попадания, промахи, вытеснения)"""
+    return _trip_cache.stats()
+
+
+def _touch_trip(trip_id):
+    # Вызывается только из потока-писателя
+    _touched_trips.add(trip_id)
+
+
+def _touch_user(user_id):
+    _touched_users.add(user_id)
+
+
+def _flush_touched():
+    global _trip_cache_generation
+    if not _touched_trips and not _touched_users:
+        return
+    with _trip_cache_lock:
+        _trip_cache_generation += 1
+        for trip_id in _touched_trips:
+            owner = _trip_owners.pop(trip_id, None)
+            if owner is not None:
+                _trip_cache.pop(owner)
+        for user_id in _touched_users:
+            _trip_cache.pop(user_id)
+    _touched_trips.clear()
+    _touched_users.clear()
 
 
 def delete_trip(trip_id):
     """Удалить путешествие и все связанные с ним данные"""
-    conn = sqlite3.connect('travel_bot.db')
-    cursor = conn.cursor()
+    return submit_write(_delete_trip, trip_id).result()
+
+
+def _delete_trip(cursor, trip_id):
+    _touch_trip(trip_id)
     
     # Удаляем все расходы, связанные с этим путешествием
     cursor.execute('DELETE FROM expenses WHERE trip_id = ?', (trip_id,))
@@ -147,20 +570,132 @@ def delete_trip(trip_id):
     # Удаляем все бюджеты по категориям для этого путешествия
     cursor.execute('DELETE FROM category_budgets WHERE trip_id = ?', (trip_id,))
     
+    # Удаляем агрегаты расходов
+    cursor.execute('DELETE FROM trip_totals WHERE trip_id = ?', (trip_id,))
+    
     # Удаляем само путешествие
     cursor.execute('DELETE FROM trips WHERE trip_id = ?', (trip_id,))
     
     # Если это активное путешествие у пользователя, убираем его
     cursor.execute('UPDATE users SET active_trip_id = NULL WHERE active_trip_id = ?', (trip_id,))
+
+
+def create_trip(user_id, name, home_currency, target_currency, exchange_rate, home_balance, target_balance,
+                budget_limit, notification_threshold, rate_policy=RATE_POLICY_PINNED):
+    """
+    Создать путешествие с основной валютой и сделать его активным. Возвращает trip_id.
+    rate_policy: RATE_POLICY_AUTO — курсы путешествия обновляются в фоне, RATE_POLICY_PINNED — зафиксированы
+    (курс введен вручную, поэтому курс основной валюты еще и закрепляется)
+    """
+    return submit_write(_create_trip, user_id, name, home_currency, target_currency, exchange_rate,
+                        home_balance, target_balance, budget_limit, notification_threshold, rate_policy).result()
+
+
+def _create_trip(cursor, user_id, name, home_currency, target_currency, exchange_rate, home_balance, target_balance,
+                 budget_limit, notification_threshold, rate_policy=RATE_POLICY_PINNED):
+    cursor.execute('''
+        INSERT INTO trips (user_id, name, home_currency, target_currency, exchange_rate, home_balance, target_balance,
+                           budget_limit, notification_threshold, rate_policy, rate_updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, name, home_currency, target_currency, exchange_rate, home_balance, target_balance, budget_limit,
+          notification_threshold, rate_policy, int(time.time())))
+    trip_id = cursor.lastrowid
     
-    conn.commit()
-    conn.close()
+    # Основная валюта путешествия
+    _add_trip_currency(cursor, trip_id, target_currency, target_balance, exchange_rate,
+                       rate_pinned=rate_policy == RATE_POLICY_PINNED)
+    _set_active_trip(cursor, user_id, trip_id)
+    return trip_id
+
+
+def add_trip_currency(trip_id, currency_code, balance, exchange_rate_to_home):
+    """Добавить валюту к путешествию"""
+    return submit_write(_add_trip_currency, trip_id, currency_code, balance, exchange_rate_to_home).result()
+
+
+def _add_trip_currency(cursor, trip_id, currency_code, balance, exchange_rate_to_home, rate_pinned=False):
+    _touch_trip(trip_id)
+    cursor.execute('''
+        INSERT INTO trip_currencies (trip_id, currency_code, balance, exchange_rate_to_home, rate_pinned)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (trip_id, currency_code, balance, exchange_rate_to_home, int(rate_pinned)))
+    return cursor.lastrowid
+
+
+def set_currency_balance(currency_id, balance):
+    """Установить баланс валюты путешествия. Возвращает False, если валюта не найдена"""
+    return submit_write(_set_currency_balance, currency_id, balance).result()
+
+
+def _set_currency_balance(cursor, currency_id, balance):
+    cur = cursor.execute('SELECT trip_id FROM trip_currencies WHERE currency_id = ?', (currency_id,)).fetchone()
+    if not cur:
+        return False
+    _touch_trip(cur['trip_id'])
+    cursor.execute('UPDATE trip_currencies SET balance = ? WHERE currency_id = ?', (balance, currency_id))
+    return True
+
+
+def delete_trip_currency(currency_id):
+    """
+    Удалить валюту из путешествия.
+    
+    Возвращает 'deleted', 'not_found' или 'has_expenses' (валюту с расходами не удаляем).
+    """
+    return submit_write(_delete_trip_currency, currency_id).result()
+
+
+def _delete_trip_currency(cursor, currency_id):
+    cur = cursor.execute('SELECT trip_id, currency_code FROM trip_currencies WHERE currency_id = ?', (currency_id,)).fetchone()
+    if not cur:
+        return 'not_found'
+    has_expenses = cursor.execute(
+        'SELECT 1 FROM expenses WHERE trip_id = ? AND currency_target = ? LIMIT 1',
+        (cur['trip_id'], cur['currency_code'])
+    ).fetchone()
+    if has_expenses:
+        return 'has_expenses'
+    cursor.execute('DELETE FROM trip_currencies WHERE currency_id = ?', (currency_id,))
+    _touch_trip(cur['trip_id'])
+    return 'deleted'
+
+
+def set_active_trip(user_id, trip_id):
+    """Сделать путешествие активным для пользователя"""
+    return submit_write(_set_active_trip, user_id, trip_id).result()
+
+
+def _set_active_trip(cursor, user_id, trip_id):
+    _touch_user(user_id)
+    cursor.execute('INSERT OR REPLACE INTO users (user_id, active_trip_id) VALUES (?, ?)', (user_id, trip_id))
+
+
+def set_budget_limit(trip_id, budget_limit, notification_threshold):
+    """Установить лимит бюджета и порог уведомления путешествия. Возвращает False, если путешествие не найдено"""
+    return submit_write(_set_budget_limit, trip_id, budget_limit, notification_threshold).result()
+
+
+def _set_budget_limit(cursor, trip_id, budget_limit, notification_threshold):
+    _touch_trip(trip_id)
+    cursor.execute('UPDATE trips SET budget_limit = ?, notification_threshold = ? WHERE trip_id = ?',
+                   (budget_limit, notification_threshold, trip_id))
+    return cursor.rowcount > 0
+
+
+def set_notification_threshold(trip_id, notification_threshold):
+    """Установить порог уведомления путешествия. Возвращает False, если путешествие не найдено"""
+    return submit_write(_set_notification_threshold, trip_id, notification_threshold).result()
+
+
+def _set_notification_threshold(cursor, trip_id, notification_threshold):
+    _touch_trip(trip_id)
+    cursor.execute('UPDATE trips SET notification_threshold = ? WHERE trip_id = ?', (notification_threshold, trip_id))
+    return cursor.rowcount > 0
 
 
 def get_trip_categories_with_budgets(trip_id):
     """Получить все категории с запланированными и потраченными суммами для конкретного путешествия"""
-    conn = sqlite3.connect('travel_bot.db')
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cursor = conn.cursor()
     
     # Получаем все категории с информацией о бюджете
@@ -175,15 +710,15 @@ def get_trip_categories_with_budgets(trip_id):
     '''
     result = cursor.execute(query, (trip_id,)).fetchall()
     
-    conn.close()
     return [dict(row) for row in result]
 
 
 def update_old_expenses_category(trip_id):
     """Обновить старые расходы, у которых нет категории (category_id), установив им значение по умолчанию (Прочее - 6)"""
-    conn = sqlite3.connect('travel_bot.db')
-    cursor = conn.cursor()
-    
+    return submit_write(_update_old_expenses_category, trip_id).result()
+
+
+def _update_old_expenses_category(cursor, trip_id):
     # Обновляем все расходы в указанном путешествии, у которых category_id равен NULL или 0
     cursor.execute('''
         UPDATE expenses 
@@ -191,49 +726,37 @@ def update_old_expenses_category(trip_id):
         WHERE trip_id = ? AND (category_id IS NULL OR category_id = '' OR category_id = 0)
     ''', (trip_id,))
     
-    conn.commit()
-    conn.close()
+    # Категории изменились — пересобираем агрегаты путешествия
+    _rebuild_trip_totals(cursor, trip_id)
 
 
 def set_category_budget(trip_id, category_id, planned_amount, currency_code):
     """Установить бюджет для конкретной категории в путешествии"""
-    conn = sqlite3.connect('travel_bot.db')
-    cursor = conn.cursor()
-    
-    # Проверяем, существует ли уже бюджет для этой категории в этом путешествии
-    existing = cursor.execute('''
-        SELECT budget_id FROM category_budgets 
-        WHERE trip_id = ? AND category_id = ?
-    ''', (trip_id, category_id)).fetchone()
-    
-    if existing:
-        # Обновляем существующий бюджет
-        cursor.execute('''
-            UPDATE category_budgets 
-            SET planned_amount = ?, currency_code = ?
-            WHERE trip_id = ? AND category_id = ?
-        ''', (planned_amount, currency_code, trip_id, category_id))
-    else:
-        # Создаем новый бюджет
-        cursor.execute('''
-            INSERT INTO category_budgets (trip_id, category_id, planned_amount, currency_code)
-            VALUES (?, ?, ?, ?)
-        ''', (trip_id, category_id, planned_amount, currency_code))
-    
-    conn.commit()
-    conn.close()
+    return submit_write(_set_category_budget, trip_id, category_id, planned_amount, currency_code).result()
+
+
+def _set_category_budget(cursor, trip_id, category_id, planned_amount, currency_code):
+    # Создаем бюджет или обновляем существующий (уникальный ключ trip_id + category_id)
+    cursor.execute('''
+        INSERT INTO category_budgets (trip_id, category_id, planned_amount, currency_code)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (trip_id, category_id)
+        DO UPDATE SET planned_amount = excluded.planned_amount, currency_code = excluded.currency_code
+    ''', (trip_id, category_id, planned_amount, currency_code))
 
 
 def add_expense_to_category(trip_id, category_id, amount_home, amount_target, currency_home, currency_target):
     """Добавить расход в определенную категорию и обновить потраченную сумму в бюджете"""
-    conn = sqlite3.connect('travel_bot.db')
-    cursor = conn.cursor()
-    
+    submit_write(_insert_expense, trip_id, category_id, amount_home, amount_target, currency_home, currency_target).result()
+
+
+def _insert_expense(cursor, trip_id, category_id, amount_home, amount_target, currency_home, currency_target):
     # Добавляем расход в таблицу expenses
     cursor.execute('''
         INSERT INTO expenses (trip_id, amount_target, amount_home, currency_target, currency_home, category_id)
         VALUES (?, ?, ?, ?, ?, ?)
     ''', (trip_id, amount_target, amount_home, currency_target, currency_home, category_id))
+    expense_id = cursor.lastrowid
     
     # Обновляем потраченную сумму в бюджете категории
     cursor.execute('''
@@ -248,38 +771,87 @@ def add_expense_to_category(trip_id, category_id, amount_home, amount_target, cu
         VALUES (?, ?, 0, ?, ?)
     ''', (trip_id, category_id, amount_home, currency_home))
     
-    conn.commit()
-    conn.close()
+    # Обновляем агрегаты путешествия
+    _add_to_trip_totals(cursor, trip_id, category_id, currency_target, amount_home, amount_target, 1)
+    return expense_id
 
 
-def ensure_category_id_column():
-    """Функция для обеспечения наличия столбца category_id в таблице expenses и обновления старых записей"""
-    conn = sqlite3.connect('travel_bot.db')
-    cursor = conn.cursor()
+def record_expense(trip_id, category_id, amount_target, amount_home, currency_target, currency_home):
+    """
+    Записать расход целиком в одной транзакции: сам расход, бюджет категории, агрегаты,
+    баланс валюты и баланс путешествия, а также проверить пороги бюджета.
     
-    # Проверяем, есть ли столбец category_id
-    cursor.execute("PRAGMA table_info(expenses)")
-    columns = [column[1] for column in cursor.fetchall()]
+    Возвращает словарь со всем, что нужно для ответа пользователю, или None, если путешествие не найдено:
+        expense_id, trip (до списания), category_name,
+        category_budget (planned_amount, spent_before, spent_after, currency_code) или None,
+        category_status и budget_status: None, 'threshold' (пройден порог 80%) или 'exceeded' (превышен лимит),
+        total_spent_before / total_spent_after (в домашней валюте)
+    """
+    return submit_write(_record_expense, trip_id, category_id, amount_target, amount_home, currency_target, currency_home).result()
+
+
+def _record_expense(cursor, trip_id, category_id, amount_target, amount_home, currency_target, currency_home):
+    trip = cursor.execute('SELECT * FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
+    if not trip:
+        return None
+    trip = dict(trip)
     
-    if 'category_id' not in columns:
-        # Добавляем столбец category_id со значением по умолчанию 6 (Прочее)
-        cursor.execute('ALTER TABLE expenses ADD COLUMN category_id INTEGER DEFAULT 6')
+    category = cursor.execute('''
+        SELECT ec.name, cb.planned_amount, cb.spent_amount, cb.currency_code
+        FROM expense_categories ec
+        LEFT JOIN category_budgets cb ON cb.category_id = ec.category_id AND cb.trip_id = ?
+        WHERE ec.category_id = ?
+    ''', (trip_id, category_id)).fetchone()
+    total_spent_before = cursor.execute(
+        'SELECT COALESCE(SUM(amount_home), 0) FROM trip_totals WHERE trip_id = ?', (trip_id,)
+    ).fetchone()[0]
     
-    # Обновляем все старые записи, у которых category_id равен NULL
-    cursor.execute('''
-        UPDATE expenses 
-        SET category_id = 6 
-        WHERE category_id IS NULL OR category_id = ''
-    ''')
+    expense_id = _insert_expense(cursor, trip_id, category_id, amount_home, amount_target, currency_home, currency_target)
+    
+    # Списываем сумму с балансов валюты и путешествия
+    _apply_balance_delta(cursor, trip_id, currency_target, -amount_target, -amount_home)
+    
+    result = {
+        'expense_id': expense_id,
+        'trip': trip,
+        'category_name': category['name'] if category else None,
+        'category_budget': None,
+        'category_status': None,
+        'budget_status': None,
+        'total_spent_before': total_spent_before,
+        'total_spent_after': total_spent_before + amount_home,
+    }
+    
+    # Порог по категории (80% от плана) и превышение плана
+    if category and category['planned_amount'] and category['planned_amount'] > 0:
+        planned = category['planned_amount']
+        spent_before = category['spent_amount'] or 0
+        spent_after = spent_before + amount_home
+        result['category_budget'] = {
+            'planned_amount': planned,
+            'spent_before': spent_before,
+            'spent_after': spent_after,
+            'currency_code': category['currency_code'],
+        }
+        if spent_before <= planned * 0.8 < spent_after:
+            result['category_status'] = 'threshold'
+        elif spent_before < planned <= spent_after:
+            result['category_status'] = 'exceeded'
+    
+    # Общий лимит путешествия (задается в целевой валюте)
+    if trip['budget_limit'] > 0 and trip['notification_threshold'] > 0 and result['total_spent_after'] > 0:
+        spent_in_target = result['total_spent_after'] * trip['exchange_rate']
+        if spent_in_target >= trip['notification_threshold'] and spent_in_target - amount_home * trip['exchange_rate'] < trip['notification_threshold']:
+            result['budget_status'] = 'threshold'
+        elif spent_in_target >= trip['budget_limit']:
+            result['budget_status'] = 'exceeded'
     
-    conn.commit()
-    conn.close()
+    return result
 
 
 def get_expenses_by_category(trip_id, category_id=None):
     """Получить расходы по категориям для конкретного путешествия"""
-    conn = sqlite3.connect('travel_bot.db')
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cursor = conn.cursor()
     
     if category_id:
@@ -303,48 +875,84 @@ def get_expenses_by_category(trip_id, category_id=None):
         '''
         result = cursor.execute(query, (trip_id,)).fetchall()
     
-    conn.close()
     return [dict(row) for row in result]
 
 
+def get_expenses_page(trip_id, limit=10, before=None, after=None):
+    """
+    Получить страницу расходов путешествия (от новых к старым) с постраничной навигацией по курсору.
+
+    Курсор — пара (timestamp, expense_id) крайнего расхода на соседней странице:
+        before: вернуть расходы старше курсора (следующая страница)
+        after: вернуть расходы новее курсора (предыдущая страница)
+    Без курсора возвращается самая новая страница. Каждая страница — один запрос
+    по индексу idx_expenses_trip_timestamp на limit + 1 строк, независимо от числа расходов.
+
+    Возвращает словарь:
+        expenses: список расходов (с category_name), от новых к старым
+        has_older / has_newer: есть ли страницы старше / новее текущей
+    """
+    conn = get_connection()
+    query = '''
+    SELECT e.*, ec.name as category_name
+    FROM expenses e
+    LEFT JOIN expense_categories ec ON e.category_id = ec.category_id
+    WHERE e.trip_id = ? {condition}
+    ORDER BY e.timestamp {order}, e.expense_id {order}
+    LIMIT ?
+    '''
+
+    if after is not None:
+        # Идем к более новым расходам по возрастанию и разворачиваем результат
+        rows = conn.execute(
+            query.format(condition='AND (e.timestamp, e.expense_id) > (?, ?)', order='ASC'),
+            (trip_id, after[0], after[1], limit + 1)
+        ).fetchall()
+        has_newer = len(rows) > limit
+        expenses = [dict(row) for row in rows[:limit]]
+        expenses.reverse()
+        return {'expenses': expenses, 'has_older': True, 'has_newer': has_newer}
+
+    if before is not None:
+        rows = conn.execute(
+            query.format(condition='AND (e.timestamp, e.expense_id) < (?, ?)', order='DESC'),
+            (trip_id, before[0], before[1], limit + 1)
+        ).fetchall()
+    else:
+        rows = conn.execute(query.format(condition='', order='DESC'), (trip_id, limit + 1)).fetchall()
+
+    return {
+        'expenses': [dict(row) for row in rows[:limit]],
+        'has_older': len(rows) > limit,
+        'has_newer': before is not None,
+    }
+
+
+def encode_page_cursor(expense):
+    """Упаковать курсор (timestamp, expense_id) расхода в короткую строку для callback_data"""
+    timestamp = ''.join(ch for ch in (expense['timestamp'] or '') if ch.isdigit())
+    return f"{timestamp}.{expense['expense_id']}"
+
+
+def decode_page_cursor(token):
+    """Распаковать курсор из callback_data обратно в (timestamp, expense_id)"""
+    digits, expense_id = token.split('.')
+    timestamp = f"{digits[0:4]}-{digits[4:6]}-{digits[6:8]} {digits[8:10]}:{digits[10:12]}:{digits[12:14]}"
+    return timestamp, int(expense_id)
+
+
 def reset_category_spending(trip_id):
     """Сбросить потраченные суммы для всех категорий в путешествии (используется при изменении курса и пересчете)"""
-    conn = sqlite3.connect('travel_bot.db')
-    cursor = conn.cursor()
-    
-    # Сбрасываем все потраченные суммы в бюджете категорий для данного путешествия
-    cursor.execute('''
-        UPDATE category_budgets 
-        SET spent_amount = 0.0
-        WHERE trip_id = ?
-    ''', (trip_id,))
-    
-    # Пересчитываем потраченные суммы на основе существующих расходов
-    # Получаем сумму расходов по каждой категории
-    sums = cursor.execute('''
-        SELECT category_id, SUM(amount_home) as total_spent
-        FROM expenses
-        WHERE trip_id = ? AND category_id IS NOT NULL
-        GROUP BY category_id
-    ''', (trip_id,)).fetchall()
-    
-    # Обновляем значения в бюджете категорий
-    for sum_row in sums:
-        if sum_row[0] is not None:  # Убедиться, что category_id не равен NULL
-            cursor.execute('''
-                UPDATE category_budgets 
-                SET spent_amount = ?
-                WHERE trip_id = ? AND category_id = ?
-            ''', (sum_row[1], trip_id, sum_row[0]))
-    
-    conn.commit()
-    conn.close()
+    return submit_write(_reset_category_spending, trip_id).result()
+
+
+def _reset_category_spending(cursor, trip_id):
+    _recompute_category_spent(cursor, trip_id)
 
 
 def get_expense_by_id(expense_id):
     """Получить расход по ID"""
-    conn = sqlite3.connect('travel_bot.db')
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cursor = conn.cursor()
     
     expense = cursor.execute('''
@@ -354,20 +962,18 @@ def get_expense_by_id(expense_id):
         WHERE e.expense_id = ?
     ''', (expense_id,)).fetchone()
     
-    conn.close()
     return dict(expense) if expense else None
 
 
 def update_expense(expense_id, new_amount_home, new_amount_target, new_category_id):
     """Обновить расход и пересчитать балансы и бюджеты категорий"""
-    conn = sqlite3.connect('travel_bot.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
+    return submit_write(_update_expense, expense_id, new_amount_home, new_amount_target, new_category_id).result()
+
+
+def _update_expense(cursor, expense_id, new_amount_home, new_amount_target, new_category_id):
     # Получаем старый расход
     old_expense = cursor.execute('SELECT * FROM expenses WHERE expense_id = ?', (expense_id,)).fetchone()
     if not old_expense:
-        conn.close()
         return False
     
     old_expense = dict(old_expense)
@@ -406,50 +1012,29 @@ def update_expense(expense_id, new_amount_home, new_amount_target, new_category_
         VALUES (?, ?, 0, ?, ?)
     ''', (trip_id, new_category_id, new_amount_home, currency_home))
     
-    # Получаем информацию о путешествии
-    trip = cursor.execute('SELECT * FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
-    if trip:
-        trip = dict(zip([col[0] for col in cursor.description], trip))
-        
-        # Обновляем балансы путешествия (возвращаем старую сумму, вычитаем новую)
-        if currency_target == trip['target_currency']:
-            new_target_balance = trip['target_balance'] + old_amount_target - new_amount_target
-            new_home_balance = trip['home_balance'] + old_amount_home - new_amount_home
-            cursor.execute('''
-                UPDATE trips 
-                SET target_balance = ?, home_balance = ?
-                WHERE trip_id = ?
-            ''', (new_target_balance, new_home_balance, trip_id))
-    
-    # Обновляем балансы в trip_currencies если используется мультивалютность
-    currency_row = cursor.execute('''
-        SELECT * FROM trip_currencies WHERE trip_id = ? AND currency_code = ?
-    ''', (trip_id, currency_target)).fetchone()
-    
-    if currency_row:
-        currency_row = dict(zip([col[0] for col in cursor.description], currency_row))
-        new_balance = currency_row['balance'] + old_amount_target - new_amount_target
-        cursor.execute('''
-            UPDATE trip_currencies 
-            SET balance = ?
-            WHERE currency_id = ?
-        ''', (new_balance, currency_row['currency_id']))
+    # Переносим расход в агрегатах: вычитаем старые суммы, добавляем новые
+    _add_to_trip_totals(cursor, trip_id, old_category_id, currency_target, -old_amount_home, -old_amount_target, -1)
+    _add_to_trip_totals(cursor, trip_id, new_category_id, currency_target, new_amount_home, new_amount_target, 1)
+    
+    # Возвращаем старую сумму на балансы и списываем новую
+    _apply_balance_delta(
+        cursor, trip_id, currency_target,
+        old_amount_target - new_amount_target,
+        old_amount_home - new_amount_home
+    )
     
-    conn.commit()
-    conn.close()
     return True
 
 
 def delete_expense(expense_id):
     """Удалить расход и пересчитать балансы и бюджеты категорий"""
-    conn = sqlite3.connect('travel_bot.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
+    return submit_write(_delete_expense, expense_id).result()
+
+
+def _delete_expense(cursor, expense_id):
     # Получаем расход перед удалением
     expense = cursor.execute('SELECT * FROM expenses WHERE expense_id = ?', (expense_id,)).fetchone()
     if not expense:
-        conn.close()
         return False
     
     expense = dict(expense)
@@ -470,40 +1055,494 @@ def delete_expense(expense_id):
         WHERE trip_id = ? AND category_id = ?
     ''', (amount_home, trip_id, category_id))
     
-    # Получаем информацию о путешествии
-    trip = cursor.execute('SELECT * FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
-    if trip:
-        trip = dict(trip)
+    # Вычитаем расход из агрегатов
+    _add_to_trip_totals(cursor, trip_id, category_id, currency_target, -amount_home, -amount_target, -1)
+    
+    # Возвращаем сумму на балансы валюты и путешествия
+    _apply_balance_delta(cursor, trip_id, currency_target, amount_target, amount_home)
+    
+    return True
+
+
+# --- Изменение балансов ---
+#
+# Балансы меняются только на дельту (SET balance = balance + ?) внутри UPDATE,
+# без чтения текущего значения в Python: параллельные обработчики не теряют
+# обновления друг друга, а между шагами диалога с пользователем ничего не блокируется.
+
+def _apply_balance_delta(cursor, trip_id, currency_code, delta_target, delta_home):
+    _touch_trip(trip_id)
+    cursor.execute('''
+        UPDATE trip_currencies SET balance = balance + ?
+        WHERE trip_id = ? AND currency_code = ?
+    ''', (delta_target, trip_id, currency_code))
+    
+    # Основной баланс путешествия ведется только в его целевой валюте
+    cursor.execute('''
+        UPDATE trips SET target_balance = target_balance + ?, home_balance = home_balance + ?
+        WHERE trip_id = ? AND target_currency = ?
+    ''', (delta_target, delta_home, trip_id, currency_code))
+
+
+def adjust_balance(trip_id, currency_code, delta_target, delta_home=0.0):
+    """
+    Атомарно изменить балансы путешествия на дельту.
+    
+    delta_target меняет баланс валюты currency_code (и target_balance, если это целевая валюта путешествия),
+    delta_home — home_balance путешествия. Отрицательные значения означают списание.
+    """
+    return submit_write(_apply_balance_delta, trip_id, currency_code, delta_target, delta_home).result()
+
+
+# --- Агрегаты расходов по путешествию ---
+#
+# trip_totals хранит суммы расходов в разрезе (категория, валюта), поэтому итог по
+# путешествию читается из нескольких строк независимо от количества расходов.
+# Все функции, меняющие expenses, обновляют агрегаты в той же транзакции.
+
+def _add_to_trip_totals(cursor, trip_id, category_id, currency_code, amount_home, amount_target, count):
+    cursor.execute('''
+        INSERT INTO trip_totals (trip_id, category_id, currency_code, amount_home, amount_target, expense_count)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (trip_id, category_id, currency_code) DO UPDATE SET
+            amount_home = amount_home + excluded.amount_home,
+            amount_target = amount_target + excluded.amount_target,
+            expense_count = expense_count + excluded.expense_count
+    ''', (trip_id, category_id or 6, currency_code or '', amount_home, amount_target, count))
+
+
+def _rebuild_trip_totals(cursor, trip_id=None):
+    if trip_id is None:
+        cursor.execute('DELETE FROM trip_totals')
+        where, params = '', ()
+    else:
+        cursor.execute('DELETE FROM trip_totals WHERE trip_id = ?', (trip_id,))
+        where, params = 'WHERE trip_id = ?', (trip_id,)
+    cursor.execute(f'''
+        INSERT INTO trip_totals (trip_id, category_id, currency_code, amount_home, amount_target, expense_count)
+        SELECT trip_id, COALESCE(NULLIF(category_id, 0), 6), COALESCE(currency_target, ''),
+               COALESCE(SUM(amount_home), 0), COALESCE(SUM(amount_target), 0), COUNT(*)
+        FROM expenses
+        {where}
+        GROUP BY trip_id, COALESCE(NULLIF(category_id, 0), 6), COALESCE(currency_target, '')
+    ''', params)
+
+
+def reconcile_trip_totals(trip_id=None):
+    """Пересобрать агрегаты trip_totals по таблице expenses (для одного путешествия или для всех)"""
+    return submit_write(_rebuild_trip_totals, trip_id).result()
+
+
+def get_trip_total_spent(trip_id):
+    """Получить общую сумму расходов путешествия в домашней валюте"""
+    conn = get_connection()
+    row = conn.execute('SELECT SUM(amount_home) FROM trip_totals WHERE trip_id = ?', (trip_id,)).fetchone()
+    return row[0] or 0
+
+
+def get_trip_totals(trip_id):
+    """Получить итоги путешествия: общую сумму, количество расходов и разбивку по категориям и валютам"""
+    conn = get_connection()
+    rows = conn.execute('''
+        SELECT tt.*, ec.name as category_name
+        FROM trip_totals tt
+        LEFT JOIN expense_categories ec ON tt.category_id = ec.category_id
+        WHERE tt.trip_id = ? AND tt.expense_count > 0
+    ''', (trip_id,)).fetchall()
+    
+    totals = {'amount_home': 0.0, 'expense_count': 0, 'by_category': {}, 'by_currency': {}}
+    for row in rows:
+        totals['amount_home'] += row['amount_home']
+        totals['expense_count'] += row['expense_count']
+        
+        category = totals['by_category'].setdefault(row['category_id'], {
+            'category_name': row['category_name'], 'amount_home': 0.0, 'amount_target': 0.0, 'expense_count': 0
+        })
+        category['amount_home'] += row['amount_home']
+        category['amount_target'] += row['amount_target']
+        category['expense_count'] += row['expense_count']
         
-        # Возвращаем балансы путешествия
-        if currency_target == trip['target_currency']:
-            new_target_balance = trip['target_balance'] + amount_target
-            new_home_balance = trip['home_balance'] + amount_home
-            cursor.execute('''
-                UPDATE trips 
-                SET target_balance = ?, home_balance = ?
-                WHERE trip_id = ?
-            ''', (new_target_balance, new_home_balance, trip_id))
-    
-    # Обновляем балансы в trip_currencies если используется мультивалютность
-    currency_row = cursor.execute('''
-        SELECT * FROM trip_currencies WHERE trip_id = ? AND currency_code = ?
-    ''', (trip_id, currency_target)).fetchone()
-    
-    if currency_row:
-        currency_row = dict(currency_row)
-        new_balance = currency_row['balance'] + amount_target
+        currency = totals['by_currency'].setdefault(row['currency_code'], {
+            'amount_home': 0.0, 'amount_target': 0.0, 'expense_count': 0
+        })
+        currency['amount_home'] += row['amount_home']
+        currency['amount_target'] += row['amount_target']
+        currency['expense_count'] += row['expense_count']
+    return totals
+
+
+
+# --- Состояние диалогов (FSM) ---
+
+def get_fsm_state(user_id):
+    """Получить сохраненное состояние диалога пользователя: (state в JSON, updated_at) или None"""
+    row = get_connection().execute(
+        'SELECT state, updated_at FROM fsm_state WHERE user_id = ?', (user_id,)
+    ).fetchone()
+    return (row['state'], row['updated_at']) if row else None
+
+
+def save_fsm_state(user_id, state, updated_at):
+    """Сохранить состояние диалога пользователя (state — строка JSON)"""
+    return submit_write(_save_fsm_state, user_id, state, updated_at).result()
+
+
+def _save_fsm_state(cursor, user_id, state, updated_at):
+    cursor.execute('''
+        INSERT INTO fsm_state (user_id, state, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+    ''', (user_id, state, updated_at))
+
+
+def delete_fsm_state(user_id):
+    """Удалить состояние диалога пользователя. Возвращает False, если состояния не было"""
+    return submit_write(_delete_fsm_state, user_id).result()
+
+
+def _delete_fsm_state(cursor, user_id):
+    cursor.execute('DELETE FROM fsm_state WHERE user_id = ?', (user_id,))
+    return cursor.rowcount > 0
+
+
+def purge_fsm_states(older_than):
+    """Удалить состояния, не обновлявшиеся с момента older_than (unix-время). Возвращает число удаленных"""
+    return submit_write(_purge_fsm_states, older_than).result()
+
+
+def _purge_fsm_states(cursor, older_than):
+    cursor.execute('DELETE FROM fsm_state WHERE updated_at < ?', (older_than,))
+    return cursor.rowcount
+
+
+
+# --- История курсов валют ---
+
+def save_exchange_rates(rates):
+    """
+    Сохранить полученные курсы.
+    
+    rates: список кортежей (base, quote, timestamp, rate); повторная запись той же
+    пары с тем же timestamp игнорируется.
+    """
+    return submit_write(_save_exchange_rates, rates).result()
+
+
+def _save_exchange_rates(cursor, rates):
+    cursor.executemany('''
+        INSERT INTO exchange_rates (base, quote, timestamp, rate) VALUES (?, ?, ?, ?)
+        ON CONFLICT(base, quote, timestamp) DO NOTHING
+    ''', rates)
+    return cursor.rowcount
+
+
+def get_latest_exchange_rate(base, quote, since=None):
+    """Самый свежий сохраненный курс пары: (rate, timestamp) или None (если since задан — не старше since)"""
+    row = get_connection().execute('''
+        SELECT rate, timestamp FROM exchange_rates
+        WHERE base = ? AND quote = ? AND timestamp >= ?
+        ORDER BY timestamp DESC
+        LIMIT 1
+    ''', (base, quote, since or 0)).fetchone()
+    return (row['rate'], row['timestamp']) if row else None
+
+
+def get_latest_exchange_rates(base, since=None):
+    """Самые свежие сохраненные курсы всех валют к base: {quote: (rate, timestamp)}"""
+    rows = get_connection().execute('''
+        SELECT quote, rate, MAX(timestamp) AS timestamp FROM exchange_rates
+        WHERE base = ? AND timestamp >= ?
+        GROUP BY quote
+    ''', (base, since or 0)).fetchall()
+    return {row['quote']: (row['rate'], row['timestamp']) for row in rows}
+
+
+def get_exchange_rate_history(base, quote, since=None, until=None):
+    """История курса пары за период: список (timestamp, rate) по возрастанию времени"""
+    rows = get_connection().execute('''
+        SELECT timestamp, rate FROM exchange_rates
+        WHERE base = ? AND quote = ? AND timestamp BETWEEN ? AND ?
+        ORDER BY timestamp
+    ''', (base, quote, since or 0, until if until is not None else 2 ** 62)).fetchall()
+    return [(row['timestamp'], row['rate']) for row in rows]
+
+
+# --- Переоценка расходов по историческим курсам ---
+
+def get_expense_rate_keys(trip_id):
+    """
+    Различные (валюта расхода, домашняя валюта, дата 'YYYY-MM-DD') по расходам путешествия
+    в валюте, отличной от домашней, — курсы, нужные для переоценки.
+    """
+    rows = get_connection().execute('''
+        SELECT DISTINCT currency_target, currency_home, date(timestamp) AS day
+        FROM expenses
+        WHERE trip_id = ? AND currency_target != currency_home AND timestamp IS NOT NULL
+    ''', (trip_id,)).fetchall()
+    return [(row['currency_target'], row['currency_home'], row['day']) for row in rows]
+
+
+def get_daily_exchange_rates(base, days):
+    """
+    Сохраненные дневные курсы к base за даты days ('YYYY-MM-DD'): {day: {quote: rate}}.
+    Дневной курс хранится в exchange_rates с timestamp полуночи UTC этой даты.
+    """
+    rows = get_connection().execute('''
+        SELECT date(timestamp, 'unixepoch') AS day, quote, rate FROM exchange_rates
+        WHERE base = ? AND timestamp IN (SELECT value FROM json_each(?))
+    ''', (base, json.dumps([day_timestamp(day) for day in days]))).fetchall()
+    rates = {}
+    for row in rows:
+        rates.setdefault(row['day'], {})[row['quote']] = row['rate']
+    return rates
+
+
+def day_timestamp(day):
+    """'YYYY-MM-DD' -> unix timestamp полуночи UTC"""
+    return calendar.timegm(time.strptime(day, "%Y-%m-%d"))
+
+
+def revalue_expenses(trip_id, rates, include_pinned=False):
+    """
+    Пересчитать amount_home расходов путешествия по курсам на дату расхода одним UPDATE,
+    затем потраченные суммы категорий, агрегаты trip_totals и домашний баланс путешествия.
+    
+    rates: список (валюта расхода, домашняя валюта, 'YYYY-MM-DD', сколько домашней валюты за 1 валюты расхода)
+    Расходы в валютах, курс которых пользователь закрепил вручную (trip_currencies.rate_pinned),
+    не трогаются, пока не передан include_pinned=True.
+    Возвращает {'updated': число пересчитанных расходов, 'total_before': ..., 'total_after': ...,
+    'skipped_currencies': отсортированный список валют, расходы в которых пропущены из-за закрепленного курса}
+    или None, если путешествия нет.
+    """
+    return submit_write(_revalue_expenses, trip_id, rates, include_pinned).result()
+
+
+def _revalue_expenses(cursor, trip_id, rates, include_pinned):
+    if not cursor.execute('SELECT 1 FROM trips WHERE trip_id = ?', (trip_id,)).fetchone():
+        return None
+    skipped_currencies = []
+    if not include_pinned:
+        # Курс этих валют пользователь задал вручную — не перезаписываем их расходы рыночным
+        pinned = {row[0] for row in cursor.execute(
+            'SELECT currency_code FROM trip_currencies WHERE trip_id = ? AND rate_pinned', (trip_id,)
+        )}
+        skipped_currencies = sorted({rate[0] for rate in rates if rate[0] in pinned})
+        rates = [rate for rate in rates if rate[0] not in pinned]
+    cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS revaluation_rates (
+            currency_target TEXT NOT NULL,
+            currency_home TEXT NOT NULL,
+            day TEXT NOT NULL,
+            rate REAL NOT NULL,
+            PRIMARY KEY (currency_target, currency_home, day)
+        )
+    ''')
+    cursor.execute('DELETE FROM temp.revaluation_rates')
+    cursor.executemany('INSERT OR REPLACE INTO temp.revaluation_rates VALUES (?, ?, ?, ?)', rates)
+    
+    total_before = _expense_home_total(cursor, trip_id)
+    cursor.execute('''
+        UPDATE expenses SET amount_home = expenses.amount_target * r.rate
+        FROM temp.revaluation_rates r
+        WHERE expenses.trip_id = ?
+          AND r.currency_target = expenses.currency_target
+          AND r.currency_home = expenses.currency_home
+          AND r.day = date(expenses.timestamp)
+    ''', (trip_id,))
+    updated = cursor.rowcount
+    cursor.execute('DELETE FROM temp.revaluation_rates')
+    total_after = _expense_home_total(cursor, trip_id)
+    
+    _after_expenses_revalued(cursor, trip_id)
+    # Переоценка меняет только amount_home расходов; home_balance выводится по определению
+    # (в начале модуля) из target_balance и текущего курса путешествия, который здесь не меняется
+    cursor.execute('UPDATE trips SET home_balance = target_balance / exchange_rate WHERE trip_id = ? AND exchange_rate > 0',
+                   (trip_id,))
+    return {'updated': updated, 'total_before': total_before, 'total_after': total_after,
+            'skipped_currencies': skipped_currencies}
+
+
+def _expense_home_total(cursor, trip_id):
+    return cursor.execute(
+        'SELECT COALESCE(SUM(amount_home), 0) FROM expenses WHERE trip_id = ?', (trip_id,)
+    ).fetchone()[0]
+
+
+def _after_expenses_revalued(cursor, trip_id):
+    _recompute_category_spent(cursor, trip_id)
+    _rebuild_trip_totals(cursor, trip_id)
+    _touch_trip(trip_id)
+
+
+def _recompute_category_spent(cursor, trip_id):
+    # Потраченные суммы категорий по самим расходам одним UPDATE ... FROM вместо запроса на категорию
+    cursor.execute('UPDATE category_budgets SET spent_amount = 0.0 WHERE trip_id = ?', (trip_id,))
+    cursor.execute('''
+        UPDATE category_budgets SET spent_amount = s.total_spent
+        FROM (
+            SELECT category_id, SUM(amount_home) AS total_spent
+            FROM expenses
+            WHERE trip_id = ? AND category_id IS NOT NULL
+            GROUP BY category_id
+        ) AS s
+        WHERE category_budgets.trip_id = ? AND category_budgets.category_id = s.category_id
+    ''', (trip_id, trip_id))
+
+
+# --- Автообновление курсов путешествий ---
+
+def set_trip_rate_policy(trip_id, policy):
+    """Задать политику курса путешествия (RATE_POLICY_AUTO или RATE_POLICY_PINNED)"""
+    if policy not in (RATE_POLICY_AUTO, RATE_POLICY_PINNED):
+        raise ValueError(f"Неизвестная политика курса: {policy}")
+    return submit_write(_set_trip_rate_policy, trip_id, policy).result()
+
+
+def _set_trip_rate_policy(cursor, trip_id, policy):
+    cursor.execute('UPDATE trips SET rate_policy = ? WHERE trip_id = ?', (policy, trip_id))
+    _touch_trip(trip_id)
+
+
+def set_trip_currency_rate(trip_id, currency_code, rate, recompute_expenses=False):
+    """
+    Вручную изменить курс валюты путешествия (сколько валюты дают за 1 домашнюю).
+    
+    Курс этой валюты закрепляется (trip_currencies.rate_pinned), чтобы автообновление его
+    не перезаписало; курсы остальных валют и политика путешествия не меняются.
+    Для основной валюты обновляется и trips.exchange_rate, а home_balance заново
+    выводится из target_balance по новому курсу.
+    При recompute_expenses amount_home расходов в этой валюте пересчитывается по новому
+    курсу одним UPDATE, затем потраченные суммы категорий и trip_totals.
+    Возвращает {'updated': число пересчитанных расходов, 'total_before': ..., 'total_after': ...}
+    или None, если такой валюты в путешествии нет.
+    """
+    if not rate or rate <= 0:
+        raise ValueError("Курс должен быть положительным числом")
+    return submit_write(_set_trip_currency_rate, trip_id, currency_code, rate, recompute_expenses).result()
+
+
+def _set_trip_currency_rate(cursor, trip_id, currency_code, rate, recompute_expenses):
+    trip = cursor.execute(
+        'SELECT home_currency, target_currency FROM trips WHERE trip_id = ?', (trip_id,)
+    ).fetchone()
+    if not trip:
+        return None
+    cursor.execute('''
+        UPDATE trip_currencies SET exchange_rate_to_home = ?, rate_pinned = 1
+        WHERE trip_id = ? AND currency_code = ?
+    ''', (rate, trip_id, currency_code))
+    if cursor.rowcount == 0:
+        return None
+    if currency_code == trip['target_currency']:
+        # home_balance заново по новому курсу (определение — в начале модуля)
         cursor.execute('''
-            UPDATE trip_currencies 
-            SET balance = ?
-            WHERE currency_id = ?
-        ''', (new_balance, currency_row['currency_id']))
+            UPDATE trips SET exchange_rate = ?, rate_updated_at = ?, home_balance = target_balance / ?
+            WHERE trip_id = ?
+        ''', (rate, int(time.time()), rate, trip_id))
     
-    conn.commit()
-    conn.close()
-    return True
+    total_before = _expense_home_total(cursor, trip_id)
+    updated = 0
+    if recompute_expenses:
+        cursor.execute('''
+            UPDATE expenses SET amount_home = amount_target / ?
+            WHERE trip_id = ? AND currency_target = ? AND currency_home = ?
+        ''', (rate, trip_id, currency_code, trip['home_currency']))
+        updated = cursor.rowcount
+    if not updated:
+        _touch_trip(trip_id)
+        return {'updated': 0, 'total_before': total_before, 'total_after': total_before}
+    
+    total_after = _expense_home_total(cursor, trip_id)
+    _after_expenses_revalued(cursor, trip_id)
+    return {'updated': updated, 'total_before': total_before, 'total_after': total_after}
+
+
+def get_auto_rate_pairs():
+    """
+    Различные пары (домашняя валюта, валюта путешествия) по всем активным путешествиям
+    с политикой RATE_POLICY_AUTO — все курсы, которые нужно обновить (кроме закрепленных вручную).
+    """
+    rows = get_connection().execute('''
+        SELECT DISTINCT t.home_currency, tc.currency_code
+        FROM users u
+        JOIN trips t ON t.trip_id = u.active_trip_id
+        JOIN trip_currencies tc ON tc.trip_id = t.trip_id
+        WHERE t.rate_policy = ? AND tc.currency_code != t.home_currency AND NOT tc.rate_pinned
+    ''', (RATE_POLICY_AUTO,)).fetchall()
+    return [(row['home_currency'], row['currency_code']) for row in rows]
+
+
+def apply_auto_rates(rates, timestamp=None, min_change=1e-9):
+    """
+    Обновить курсы всех активных путешествий с политикой RATE_POLICY_AUTO.
+    Курсы, закрепленные пользователем вручную (rate_pinned), не меняются.
+    
+    rates: {(домашняя валюта, валюта): сколько валюты дают за 1 домашнюю}
+    Курсы меняются только там, где отличаются больше чем на min_change (относительно);
+    при смене курса основной валюты home_balance выводится заново из target_balance.
+    Возвращает число обновленных путешествий.
+    """
+    return submit_write(_apply_auto_rates, rates, timestamp or int(time.time()), min_change).result()
+
+
+def _apply_auto_rates(cursor, rates, timestamp, min_change):
+    cursor.execute('''
+        SELECT t.trip_id, t.home_currency, t.target_currency, tc.currency_id, tc.currency_code, tc.exchange_rate_to_home
+        FROM users u
+        JOIN trips t ON t.trip_id = u.active_trip_id
+        JOIN trip_currencies tc ON tc.trip_id = t.trip_id
+        WHERE t.rate_policy = ? AND NOT tc.rate_pinned
+    ''', (RATE_POLICY_AUTO,))
+    currency_updates = []
+    trip_updates = []
+    updated_trips = set()
+    for row in cursor.fetchall():
+        rate = rates.get((row['home_currency'], row['currency_code']))
+        old = row['exchange_rate_to_home']
+        if not rate or (old and abs(rate - old) <= abs(old) * min_change):
+            continue
+        currency_updates.append((rate, row['currency_id']))
+        if row['currency_code'] == row['target_currency']:
+            trip_updates.append((rate, timestamp, rate, row['trip_id']))
+        updated_trips.add(row['trip_id'])
+    
+    cursor.executemany('UPDATE trip_currencies SET exchange_rate_to_home = ? WHERE currency_id = ?', currency_updates)
+    cursor.executemany('''
+        UPDATE trips SET exchange_rate = ?, rate_updated_at = ?, home_balance = target_balance / ?
+        WHERE trip_id = ?
+    ''', trip_updates)
+    for trip_id in updated_trips:
+        _touch_trip(trip_id)
+    return len(updated_trips)
+
+
+# --- Учет квоты API курсов ---
+
+def get_api_usage(period, provider=DEFAULT_API_PROVIDER):
+    """Сколько запросов к источнику курсов provider учтено за период ("YYYY-MM")"""
+    row = get_connection().execute(
+        'SELECT requests FROM api_usage WHERE period = ? AND provider = ?', (period, provider)
+    ).fetchone()
+    return row['requests'] if row else 0
+
+
+def add_api_usage(period, requests, provider=DEFAULT_API_PROVIDER):
+    """Прибавить requests запросов к счетчику источника provider за период; возвращает новое значение"""
+    return submit_write(_add_api_usage, period, requests, provider).result()
+
+
+def _add_api_usage(cursor, period, requests, provider):
+    cursor.execute('''
+        INSERT INTO api_usage (period, provider, requests) VALUES (?, ?, ?)
+        ON CONFLICT(period, provider) DO UPDATE SET requests = requests + excluded.requests
+    ''', (period, provider, requests))
+    cursor.execute('SELECT requests FROM api_usage WHERE period = ? AND provider = ?', (period, provider))
+    return cursor.fetchone()[0]
 
 
 if __name__ == "__main__":
+    import sys
     init_db()
     print("Database initialized.")
+    if len(sys.argv) > 1 and sys.argv[1] == "reconcile":
+        reconcile_trip_totals()
+        print("Trip totals rebuilt.")
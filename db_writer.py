@@ -0,0 +1,134 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+_STOP = object()
+
+
+class WriteQueue:
+    """
+    Единственный поток-писатель SQLite с групповым коммитом.
+
+    Обработчики не пишут в базу сами: они передают операцию в очередь через submit()
+    и получают Future. Поток-писатель владеет единственным соединением на запись,
+    собирает накопившиеся операции в пачку и выполняет их в одной транзакции
+    (одна блокировка файла и один fsync на пачку). Каждая операция выполняется
+    внутри своего SAVEPOINT, поэтому ошибка в одной из них не откатывает остальные.
+
+    Операция — функция вида func(cursor, *args, **kwargs); ее результат
+    становится результатом Future.
+    """
+
+    def __init__(self, connect, batch_window=0.003, max_batch=256, after_batch=None):
+        """
+        Args:
+            connect: Функция, создающая соединение (вызывается в потоке-писателе)
+            batch_window: Сколько секунд ждать новых операций после первой в пачке
+            max_batch: Максимальное число операций в одной транзакции
+            after_batch: Функция без аргументов, вызываемая после завершения транзакции пачки
+                (и при коммите, и при откате) до того, как вызывающие получат результаты;
+                используется для сброса кэшей
+        """
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.after_batch = after_batch
+        self._connect = connect
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Поставить операцию записи в очередь и вернуть Future с ее результатом"""
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def stop(self, timeout=None):
+        """Дописать уже поставленные операции и остановить поток"""
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        conn = self._connect()
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.batch_window
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._execute(conn, batch)
+        finally:
+            conn.close()
+
+    def _execute(self, conn, batch):
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, func, args, kwargs in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT write_op")
+                try:
+                    result = func(conn.cursor(), *args, **kwargs)
+                except Exception as exc:
+                    conn.execute("ROLLBACK TO write_op")
+                    conn.execute("RELEASE write_op")
+                    outcomes.append((future, None, exc))
+                else:
+                    conn.execute("RELEASE write_op")
+                    outcomes.append((future, result, None))
+            conn.commit()
+        except Exception as exc:
+            # Не удалось закоммитить пачку целиком — сообщаем об ошибке всем ее операциям
+            if conn.in_transaction:
+                conn.rollback()
+            self._notify_after_batch()
+            for future, _, _, _ in batch:
+                if not future.done():
+                    if not future.running():
+                        future.set_running_or_notify_cancel()
+                    future.set_exception(exc)
+            return
+
+        self.batches += 1
+        self.operations += len(outcomes)
+        self._notify_after_batch()
+        for future, result, exc in outcomes:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def _notify_after_batch(self):
+        if self.after_batch is None:
+            return
+        try:
+            self.after_batch()
+        except Exception:
+            # Ошибка хука не должна ронять поток-писатель
+            pass
@@ -0,0 +1,197 @@
+class _PrefixNode:
+    __slots__ = ("children", "handlers")
+
+    def __init__(self):
+        self.children = {}
+        # {шаг диалога или None (любой шаг): обработчик}
+        self.handlers = None
+
+
+class Router:
+    """
+    Маршрутизатор обновлений бота с поиском обработчика за O(1) от числа обработчиков.
+
+    telebot проверяет фильтры обработчиков по очереди для каждого обновления, поэтому
+    стоимость разбора растет с каждой новой кнопкой, а пересекающиеся фильтры
+    (cat_ и cat_budget_done, cur_del_ и cur_del_ok_) зависят от порядка регистрации.
+    Здесь вместо этого:
+
+    - точные тексты кнопок меню и команды ищутся в словаре;
+    - шаги диалога (user_data[...]['step']) — в таблице шаг -> обработчик;
+    - callback_data — в префиксном дереве; выигрывает самый длинный префикс,
+      а обработчик, зарегистрированный для текущего шага, важнее общего.
+
+    Состояние пользователя читается один раз на обновление. Исключения обработчиков
+    можно перехватить по типу (error): например, истекшее посреди диалога состояние.
+    """
+
+    def __init__(self, get_state):
+        """
+        Args:
+            get_state: Функция get_state(user_id) -> состояние диалога (dict) или None
+        """
+        self._get_state = get_state
+        self._texts = {}
+        self._steps = {}
+        self._step_fields = {}
+        self._fallback = None
+        self._callbacks = {}
+        self._prefixes = _PrefixNode()
+        self._errors = {}
+
+    def install(self, bot):
+        """Зарегистрировать в telebot по одному обработчику сообщений и callback-запросов"""
+        bot.message_handler(func=lambda message: True)(self.dispatch_message)
+        bot.callback_query_handler(func=lambda call: True)(self.dispatch_callback)
+
+    # --- Регистрация ---
+
+    def text(self, *texts):
+        """Обработчик точного текста сообщения: кнопки меню или команды ("/balance")"""
+        def decorator(handler):
+            for text in texts:
+                _add_route(self._texts, text, handler, text)
+            return handler
+        return decorator
+
+    def step(self, *steps, field="step"):
+        """Обработчик сообщений, пока user_data[...][field] равно одному из steps"""
+        def decorator(handler):
+            self._step_fields[field] = None
+            for step in steps:
+                _add_route(self._steps, (field, step), handler, f"{field}={step}")
+            return handler
+        return decorator
+
+    def fallback(self, handler):
+        """Обработчик сообщений, которым не подошел ни один текст и ни один шаг"""
+        if self._fallback is not None:
+            raise ValueError("Обработчик по умолчанию уже зарегистрирован")
+        self._fallback = handler
+        return handler
+
+    def callback(self, *values, step=None):
+        """Обработчик callback_data, точно равных одному из values (для шага step или любого)"""
+        def decorator(handler):
+            for value in values:
+                _add_route(self._callbacks.setdefault(value, {}), step, handler, value)
+            return handler
+        return decorator
+
+    def callback_prefix(self, *prefixes, step=None):
+        """Обработчик callback_data, начинающихся с одного из prefixes (для шага step или любого)"""
+        def decorator(handler):
+            for prefix in prefixes:
+                node = self._prefixes
+                for ch in prefix:
+                    node = node.children.setdefault(ch, _PrefixNode())
+                if node.handlers is None:
+                    node.handlers = {}
+                _add_route(node.handlers, step, handler, f"{prefix}*")
+            return handler
+        return decorator
+
+    def error(self, *exceptions):
+        """Обработчик handler(update, exc) исключений exceptions (и их подклассов) из обработчиков обновлений"""
+        def decorator(handler):
+            for exception in exceptions:
+                _add_route(self._errors, exception, handler, exception.__name__)
+            return handler
+        return decorator
+
+    # --- Разбор обновлений ---
+
+    def resolve_message(self, message):
+        """Обработчик для сообщения или None"""
+        text = message.text or ""
+        handler = self._texts.get(text)
+        if handler is None and text.startswith("/"):
+            # "/balance@my_bot 10" -> "/balance", как фильтр commands= в telebot
+            handler = self._texts.get(text.split(maxsplit=1)[0].split("@", 1)[0])
+        if handler is not None:
+            return handler
+        if self._step_fields:
+            state = self._get_state(message.from_user.id) or {}
+            for field in self._step_fields:
+                handler = self._steps.get((field, state.get(field)))
+                if handler is not None:
+                    return handler
+        return self._fallback
+
+    def resolve_callback(self, call):
+        """Обработчик для callback-запроса или None"""
+        data = call.data or ""
+        step = None
+        loaded = False
+
+        candidates = []
+        exact = self._callbacks.get(data)
+        if exact is not None:
+            candidates.append(exact)
+        node = self._prefixes
+        matched = []
+        for ch in data:
+            node = node.children.get(ch)
+            if node is None:
+                break
+            if node.handlers is not None:
+                matched.append(node.handlers)
+        candidates.extend(reversed(matched))
+
+        for handlers in candidates:
+            # Состояние читаем, только если у маршрута есть обработчики для отдельных шагов
+            if len(handlers) > 1 or None not in handlers:
+                if not loaded:
+                    step = (self._get_state(call.from_user.id) or {}).get("step")
+                    loaded = True
+                handler = handlers.get(step)
+                if handler is not None:
+                    return handler
+            handler = handlers.get(None)
+            if handler is not None:
+                return handler
+        return None
+
+    def dispatch_message(self, message):
+        handler = self.resolve_message(message)
+        if handler is not None:
+            self._run(handler, message)
+
+    def dispatch_callback(self, call):
+        handler = self.resolve_callback(call)
+        if handler is not None:
+            self._run(handler, call)
+
+    def _run(self, handler, update):
+        try:
+            handler(update)
+        except Exception as exc:
+            # Ближайший по иерархии классов обработчик ошибки; остальные исключения — как раньше, в telebot
+            for exception in type(exc).__mro__:
+                error_handler = self._errors.get(exception)
+                if error_handler is not None:
+                    error_handler(update, exc)
+                    return
+            raise
+
+    def stats(self):
+        prefixes = 0
+        stack = [self._prefixes]
+        while stack:
+            node = stack.pop()
+            prefixes += node.handlers is not None
+            stack.extend(node.children.values())
+        return {
+            "texts": len(self._texts),
+            "steps": len(self._steps),
+            "callbacks": len(self._callbacks),
+            "callback_prefixes": prefixes,
+            "errors": len(self._errors),
+        }
+
+
+def _add_route(table, key, handler, name):
+    # Один и тот же маршрут не может вести в два обработчика: это и была ошибка порядка регистрации
+    if key in table:
+        raise ValueError(f"Маршрут {name} уже занят обработчиком {table[key].__name__}")
+    table[key] = handler
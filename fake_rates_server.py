@@ -0,0 +1,226 @@
+"""
+Локальная замена exchangerate.host для тестов и нагрузочных замеров.
+
+Отдает детерминированные курсы по тем же endpoint'ам, что использует current_api.py
+(/live, /convert, /list, /timeframe), и умеет имитировать задержку, ошибки и исчерпание квоты.
+Бот переключается на сервер через переменную окружения CURRENCY_API_URL:
+
+    python fake_rates_server.py --port 8765 --latency 0.2 --error-rate 0.1 --quota 500
+    CURRENCY_API_URL=http://127.0.0.1:8765 python bot.py
+"""
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from rate_providers import SnapshotProvider
+
+# Сколько валюты дают за 1 USD; значения фиксированы, чтобы результаты были воспроизводимы
+FAKE_RATES = {
+    "USD": ("United States Dollar", 1.0),
+    "EUR": ("Euro", 0.92),
+    "GBP": ("British Pound Sterling", 0.79),
+    "JPY": ("Japanese Yen", 149.5),
+    "CNY": ("Chinese Yuan", 7.24),
+    "RUB": ("Russian Ruble", 92.5),
+    "KZT": ("Kazakhstani Tenge", 478.0),
+    "TRY": ("Turkish Lira", 32.1),
+    "THB": ("Thai Baht", 35.6),
+    "AED": ("United Arab Emirates Dirham", 3.6725),
+    "GEL": ("Georgian Lari", 2.68),
+    "AMD": ("Armenian Dram", 387.0),
+    "CHF": ("Swiss Franc", 0.88),
+    "CZK": ("Czech Republic Koruna", 23.1),
+    "PLN": ("Polish Zloty", 3.98),
+    "INR": ("Indian Rupee", 83.2),
+    "VND": ("Vietnamese Dong", 24850.0),
+    "IDR": ("Indonesian Rupiah", 15600.0),
+    "EGP": ("Egyptian Pound", 48.3),
+    "KRW": ("South Korean Won", 1340.0),
+}
+# Фиксированное время "получения" курсов
+FAKE_TIMESTAMP = 1767225600
+
+
+class FakeRatesProvider(SnapshotProvider):
+    """Источник с фиксированной таблицей FAKE_RATES"""
+
+    name = "fake"
+
+    def _snapshot(self):
+        return "USD", {code: rate for code, (_, rate) in FAKE_RATES.items()}, FAKE_TIMESTAMP
+
+    def get(self, endpoint, params=None, required=()):
+        if endpoint == "list":
+            return {"success": True, "currencies": {code: name for code, (name, _) in FAKE_RATES.items()}}
+        if endpoint == "timeframe":
+            return self._timeframe(params or {})
+        return super().get(endpoint, params, required)
+
+    def _timeframe(self, params):
+        # Дневные курсы: базовая таблица с детерминированным отклонением до ±0.3% в зависимости от даты
+        try:
+            start = datetime.date.fromisoformat(params["start_date"])
+            end = datetime.date.fromisoformat(params["end_date"])
+        except (KeyError, ValueError):
+            return self._error("start_date и end_date должны быть в формате YYYY-MM-DD")
+        source = params.get("source", "USD")
+        _, rates, _ = self._snapshot()
+        if source not in rates or end < start or (end - start).days > 365:
+            return self._error("Некорректный период или валюта")
+        currencies = params.get("currencies")
+        codes = [code for code in (currencies.split(",") if currencies else rates) if code in rates and code != source]
+        quotes = {}
+        day = start
+        while day <= end:
+            factor = 1 + 0.001 * (day.toordinal() % 7 - 3)
+            quotes[day.isoformat()] = {
+                source + code: rates[code] / rates[source] * factor
+                for code in codes
+            }
+            day += datetime.timedelta(days=1)
+        return {"success": True, "timeframe": True, "source": source,
+                "start_date": start.isoformat(), "end_date": end.isoformat(), "quotes": quotes}
+
+
+class FakeRatesServer:
+    """
+    HTTP-сервер в фоновом потоке, имитирующий exchangerate.host.
+
+    Каждый запрос задерживается на latency секунд (плюс случайные 0..jitter),
+    с вероятностью error_rate завершается HTTP 503, а после quota успешных запросов
+    сервер отвечает ошибкой usage_limit_reached, как настоящий API.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                 quota=None, access_key=None, seed=None):
+        """
+        Args:
+            host, port: Адрес сервера (port=0 — любой свободный порт)
+            latency: Задержка ответа в секундах
+            jitter: Дополнительная случайная задержка от 0 до jitter секунд
+            error_rate: Доля запросов, завершающихся HTTP 503
+            quota: Сколько запросов можно выполнить до исчерпания квоты (None — без ограничения)
+            access_key: Если задан, запросы без этого ключа отклоняются
+            seed: Начальное значение генератора случайных чисел (для воспроизводимых ошибок)
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota = quota
+        self.access_key = access_key
+        self._random = random.Random(seed)
+        self._provider = FakeRatesProvider()
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "errors": 0, "quota_exceeded": 0, "endpoints": {}}
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = server.handle(self.path)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def handle(self, path):
+        """Обработать запрос GET path; возвращает (HTTP-статус, тело ответа)"""
+        url = urlsplit(path)
+        endpoint = url.path.strip("/")
+        params = dict(parse_qsl(url.query))
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["endpoints"][endpoint] = self._stats["endpoints"].get(endpoint, 0) + 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            fail = self._random.random() < self.error_rate
+            over_quota = self.quota is not None and self._stats["requests"] - self._stats["errors"] > self.quota
+            if fail:
+                self._stats["errors"] += 1
+            elif over_quota:
+                self._stats["quota_exceeded"] += 1
+        if delay:
+            time.sleep(delay)
+
+        if fail:
+            return 503, {"success": False, "error": {"code": 503, "info": "Service Unavailable"}}
+        if self.access_key and params.get("access_key") != self.access_key:
+            return 200, _error(101, "invalid_access_key", "You have not supplied a valid API Access Key.")
+        if over_quota:
+            return 200, _error(104, "usage_limit_reached", "Your monthly usage limit has been reached.")
+        if endpoint not in ("live", "convert", "list", "timeframe"):
+            return 404, _error(103, "invalid_api_function", "This API Function does not exist.")
+        return 200, self._provider.get(endpoint, params)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["endpoints"] = dict(self._stats["endpoints"])
+        return stats
+
+    def start(self):
+        """Запустить сервер в фоновом потоке; возвращает его адрес"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-rates-server", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def _error(code, error_type, info):
+    return {"success": False, "error": {"code": code, "type": error_type, "info": info}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена API exchangerate.host")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, секунды")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, секунды")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов HTTP 503 (0..1)")
+    parser.add_argument("--quota", type=int, default=None, help="число запросов до исчерпания квоты")
+    parser.add_argument("--access-key", default=None, help="требовать этот access_key")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = FakeRatesServer(
+        args.host, args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        quota=args.quota, access_key=args.access_key, seed=args.seed,
+    )
+    print(f"Фейковый API курсов запущен: {server.url} (CURRENCY_API_URL={server.url})")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._httpd.server_close()
+        print(server.stats())
+
+
+if __name__ == "__main__":
+    main()
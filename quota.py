@@ -0,0 +1,236 @@
+import contextlib
+import contextvars
+import threading
+import time
+
+from currency_client import RequestNotSentError
+
+# Полосы приоритета: запросы пользователя и фоновые обновления курсов
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# Полоса текущего логического запроса; HTTP-попытки внутри него (повторы, hedged-запросы)
+# выполняются в других потоках, поэтому приоритет передается через контекст, а не аргументом
+_request_priority = contextvars.ContextVar("quota_request_priority", default=INTERACTIVE)
+
+
+class QuotaExceededError(RequestNotSentError):
+    """Запрос не отправлен: исчерпана квота API (в секунду или за месяц)"""
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """Выполнить блок с полосой квоты priority для всех HTTP-попыток внутри него"""
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+def current_priority():
+    return _request_priority.get()
+
+
+class TokenBucket:
+    """
+    Ведро токенов: пополняется на rate токенов в секунду, вмещает не больше capacity.
+    Каждый запрос забирает токен; пустое ведро означает, что лимит в секунду исчерпан.
+    Не потокобезопасно — синхронизацию обеспечивает вызывающий код.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = float(capacity)
+        self._updated_at = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    def try_acquire(self, tokens=1):
+        """Забрать токены, если они есть. Возвращает True при успехе"""
+        self._refill()
+        if self._tokens < tokens:
+            return False
+        self._tokens -= tokens
+        return True
+
+    def wait_time(self, tokens=1):
+        """Через сколько секунд в ведре наберется tokens токенов"""
+        self._refill()
+        return max(tokens - self._tokens, 0) / self.rate
+
+
+class QuotaManager:
+    """
+    Учет и ограничение запросов к API курсов.
+
+    Лимит в секунду соблюдается ведром токенов; если токенов нет, запрос ждет
+    не дольше max_wait секунд. Месячный расход хранится во внешнем хранилище
+    (load_usage / save_usage) и переживает перезапуск.
+
+    Запросы пользователя (INTERACTIVE) имеют приоритет перед фоновыми (BACKGROUND):
+    пока пользовательский запрос ждет токен, фоновые не получают токены вовсе,
+    а месячную квоту фоновые запросы могут израсходовать только на background_share,
+    остаток приберегается для пользователей.
+
+    Менеджер ведется отдельно для каждого источника курсов и подключается к его
+    HTTP-клиенту как before_request: квоту расходует каждая HTTP-попытка, включая повторы.
+    """
+
+    def __init__(self, per_second=5, burst=5, monthly_limit=0, background_share=0.8, max_wait=2.0,
+                 load_usage=None, save_usage=None, flush_every=10, flush_interval=30, clock=time.monotonic,
+                 name=None):
+        """
+        Args:
+            per_second: Сколько запросов в секунду разрешено в среднем
+            burst: Сколько запросов можно отправить подряд без паузы
+            monthly_limit: Лимит запросов за календарный месяц (0 — без ограничения, только учет)
+            background_share: Доля месячного лимита, доступная фоновым запросам
+            max_wait: Сколько секунд запрос может ждать токен
+            load_usage: Функция load_usage(period) -> число учтенных запросов за месяц "YYYY-MM"
+            save_usage: Функция save_usage(period, delta) -> новое значение счетчика
+            flush_every: Сохранять счетчик после стольких новых запросов
+            flush_interval: ...или если с последнего сохранения прошло столько секунд
+            name: Имя источника курсов, чью квоту ведет менеджер (для статистики)
+        """
+        self.name = name
+        self.monthly_limit = monthly_limit
+        self.background_share = background_share
+        self.max_wait = max_wait
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._load_usage = load_usage
+        self._save_usage = save_usage
+        self._clock = clock
+        self._bucket = TokenBucket(per_second, burst, clock)
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._waiting_interactive = 0
+        self._period = None
+        self._used = 0
+        self._unflushed = 0
+        self._flushed_at = clock()
+        self.granted = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.rejected = {INTERACTIVE: 0, BACKGROUND: 0}
+
+    def _sync_period_locked(self):
+        # Новый месяц — новый счетчик; загружаем сохраненное значение, если оно есть
+        period = _current_period()
+        if period == self._period:
+            return
+        self._period = period
+        self._unflushed = 0
+        self._used = 0
+        if self._load_usage is not None:
+            try:
+                self._used = self._load_usage(period)
+            except Exception:
+                pass
+
+    def _monthly_limit_for(self, priority):
+        if not self.monthly_limit:
+            return None
+        if priority == BACKGROUND:
+            return int(self.monthly_limit * self.background_share)
+        return self.monthly_limit
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        """
+        Получить разрешение на один запрос.
+
+        Raises:
+            QuotaExceededError: если месячная квота исчерпана или токен не освободился за timeout
+                (по умолчанию max_wait) секунд
+        """
+        deadline = self._clock() + (self.max_wait if timeout is None else timeout)
+        with self._cond:
+            self._sync_period_locked()
+            limit = self._monthly_limit_for(priority)
+            if limit is not None and self._used >= limit:
+                self.rejected[priority] += 1
+                raise QuotaExceededError(f"Месячная квота API курсов исчерпана ({self._used} из {self.monthly_limit})")
+            if priority == INTERACTIVE:
+                self._waiting_interactive += 1
+            try:
+                while not ((priority == INTERACTIVE or not self._waiting_interactive) and self._bucket.try_acquire()):
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        self.rejected[priority] += 1
+                        raise QuotaExceededError("Превышен лимит запросов к API курсов в секунду")
+                    self._cond.wait(min(remaining, self._bucket.wait_time() or remaining))
+            finally:
+                if priority == INTERACTIVE:
+                    self._waiting_interactive -= 1
+                    self._cond.notify_all()
+            self.granted[priority] += 1
+            self._used += 1
+            self._unflushed += 1
+            flush = self._unflushed >= self.flush_every or self._clock() - self._flushed_at >= self.flush_interval
+        if flush:
+            self.flush()
+
+    def before_request(self, endpoint=None):
+        """Хук для CurrencyClient: разрешение на одну HTTP-попытку с полосой текущего запроса"""
+        self.acquire(current_priority())
+
+    def flush(self):
+        """Сохранить накопленный расход во внешнее хранилище"""
+        if self._save_usage is None:
+            return
+        with self._flush_lock:
+            with self._cond:
+                period, delta = self._period, self._unflushed
+                self._unflushed = 0
+                self._flushed_at = self._clock()
+            if not delta:
+                return
+            try:
+                total = self._save_usage(period, delta)
+            except Exception:
+                with self._cond:
+                    if period == self._period:
+                        self._unflushed += delta
+                return
+            with self._cond:
+                # Счетчик общий для всех процессов с этой базой — берем учтенное ими тоже
+                if period == self._period and total is not None:
+                    self._used = max(self._used, total + self._unflushed)
+
+    def remaining(self, priority=INTERACTIVE):
+        """Сколько запросов еще можно сделать в этом месяце (None — без ограничения)"""
+        with self._cond:
+            self._sync_period_locked()
+            return self._remaining_locked(priority)
+
+    def stats(self):
+        with self._cond:
+            self._sync_period_locked()
+            return {
+                "name": self.name,
+                "period": self._period,
+                "used": self._used,
+                "monthly_limit": self.monthly_limit,
+                "remaining": self._remaining_locked(INTERACTIVE),
+                "remaining_background": self._remaining_locked(BACKGROUND),
+                "tokens": self._bucket.tokens,
+                "granted": dict(self.granted),
+                "rejected": dict(self.rejected),
+            }
+
+    def _remaining_locked(self, priority):
+        limit = self._monthly_limit_for(priority)
+        return None if limit is None else max(limit - self._used, 0)
+
+
+def _current_period():
+    return time.strftime("%Y-%m", time.gmtime())
@@ -0,0 +1,166 @@
+import threading
+import time
+
+
+class RateMatrix:
+    """
+    Матрица курсов по одному снимку /live.
+
+    Раз в refresh_interval секунд загружаются курсы всех валют к базовой (например, USD)
+    одним запросом. Кросс-курс A -> B вычисляется локально через базовую валюту:
+    rate(A, B) = quote(B) / quote(A), где quote(X) — сколько X дают за 1 базовую.
+    Поэтому число запросов к API не зависит от числа пар.
+    """
+
+    def __init__(self, fetch_quotes, base="USD", refresh_interval=3600, retry_interval=60, restore=None,
+                 background_fetch=None):
+        """
+        Args:
+            fetch_quotes: Функция fetch_quotes(base) -> ответ /live
+                ({'success': True, 'source': 'USD', 'quotes': {'USDEUR': 0.92, ...}, 'timestamp': ...})
+            base: Базовая валюта снимка
+            refresh_interval: Период обновления снимка в секундах
+            retry_interval: Через сколько секунд повторять неудачное обновление
+            restore: Функция restore(base) -> (quotes, возраст в секундах) или None;
+                вызывается один раз до первого запроса, чтобы после перезапуска
+                взять сохраненный снимок вместо нового запроса к API
+            background_fetch: Функция для фоновых обновлений (по умолчанию fetch_quotes),
+                например с пониженным приоритетом в квоте API
+        """
+        self.base = base
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self._fetch_quotes = fetch_quotes
+        self._background_fetch = background_fetch or fetch_quotes
+        self._restore = restore
+        self._quotes = {}
+        self._loaded_at = None
+        self._timestamp = None
+        self._retry_at = 0.0
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.refreshes = 0
+        self.failed_refreshes = 0
+
+    def refresh(self, background=False):
+        """Загрузить новый снимок курсов. Возвращает True при успехе"""
+        with self._refresh_lock:
+            return self._refresh_locked(background)
+
+    def refresh_if_stale(self, background=False):
+        """
+        Обновить снимок, если он устарел и не идет пауза после неудачного обновления.
+        Параллельные вызовы не дублируют запрос: остальные дождутся первого.
+        background=True — обновление не нужно пользователю прямо сейчас (см. background_fetch).
+        """
+        if not self.needs_refresh():
+            return False
+        with self._refresh_lock:
+            if self._restore is not None:
+                self._restore_locked()
+            if not self.needs_refresh():
+                return False
+            return self._refresh_locked(background)
+
+    def _restore_locked(self):
+        restore, self._restore = self._restore, None
+        try:
+            restored = restore(self.base)
+        except Exception:
+            restored = None
+        if not restored:
+            return
+        quotes, age = restored
+        if len(quotes) > 1 and age < self.refresh_interval:
+            self._quotes = dict(quotes)
+            self._loaded_at = time.monotonic() - age
+
+    def _refresh_locked(self, background=False):
+        fetch = self._background_fetch if background else self._fetch_quotes
+        try:
+            data = fetch(self.base)
+        except Exception:
+            data = None
+        quotes = self._parse(data)
+        if not quotes:
+            self.failed_refreshes += 1
+            self._retry_at = time.monotonic() + min(self.retry_interval, self.refresh_interval)
+            return False
+        # Подменяем словарь целиком: читатели без блокировок видят либо старый, либо новый снимок
+        self._quotes = quotes
+        self._timestamp = data.get("timestamp")
+        self._loaded_at = time.monotonic()
+        self.refreshes += 1
+        return True
+
+    def _parse(self, data):
+        if not data or not data.get("success"):
+            return None
+        source = data.get("source", self.base)
+        quotes = {source: 1.0}
+        for pair, value in (data.get("quotes") or {}).items():
+            if pair.startswith(source) and value:
+                quotes[pair[len(source):]] = float(value)
+        return quotes if len(quotes) > 1 else None
+
+    def age(self):
+        """Возраст снимка в секундах или None, если снимок еще не загружен"""
+        if self._loaded_at is None:
+            return None
+        return time.monotonic() - self._loaded_at
+
+    def is_stale(self):
+        age = self.age()
+        return age is None or age >= self.refresh_interval
+
+    def needs_refresh(self):
+        return self.is_stale() and time.monotonic() >= self._retry_at
+
+    def rate(self, from_currency, to_currency):
+        """Кросс-курс: сколько to_currency дают за 1 from_currency, или None, если валюты нет в снимке"""
+        quotes = self._quotes
+        from_quote = quotes.get(from_currency)
+        to_quote = quotes.get(to_currency)
+        if not from_quote or to_quote is None:
+            return None
+        return to_quote / from_quote
+
+    def currencies(self):
+        """Коды валют, присутствующих в текущем снимке"""
+        return frozenset(self._quotes)
+
+    def start(self):
+        """Запустить фоновое обновление снимка раз в refresh_interval секунд"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="rate-matrix", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh_if_stale(background=True)
+            age = self.age()
+            if age is not None and age < self.refresh_interval:
+                wait = self.refresh_interval - age
+            else:
+                # После неудачи пробуем снова через retry_interval
+                wait = max(self._retry_at - time.monotonic(), 1)
+            self._stop.wait(wait)
+
+    def stats(self):
+        return {
+            "base": self.base,
+            "currencies": len(self._quotes),
+            "age": self.age(),
+            "timestamp": self._timestamp,
+            "refreshes": self.refreshes,
+            "failed_refreshes": self.failed_refreshes,
+        }
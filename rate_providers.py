@@ -0,0 +1,315 @@
+import calendar
+import contextvars
+import json
+import os
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from currency_client import CurrencyAPIError, CurrencyClient, RequestRejectedError, UnsupportedEndpointError
+
+
+class SnapshotProvider:
+    """
+    Источник курсов, который умеет получать только снимок "все валюты к одной базовой".
+
+    Запросы live, convert и list обслуживаются по этому снимку и возвращаются в формате
+    exchangerate.host, поэтому такой источник взаимозаменяем с CurrencyClient:
+    у обоих есть get(endpoint, params, required) и supports(endpoint).
+    Исторических курсов (timeframe) в снимке нет.
+    """
+
+    name = "snapshot"
+    endpoints = ("live", "convert", "list")
+
+    def _snapshot(self):
+        """Вернуть (базовая валюта, {валюта: сколько ее дают за 1 базовую}, unix timestamp)"""
+        raise NotImplementedError
+
+    def supports(self, endpoint):
+        return endpoint in self.endpoints
+
+    def get(self, endpoint, params=None, required=()):
+        if not self.supports(endpoint):
+            raise UnsupportedEndpointError(f"Источник {self.name} не поддерживает запрос {endpoint}")
+        params = params or {}
+        base, rates, timestamp = self._snapshot()
+        rates = dict(rates)
+        rates[base] = 1.0
+        if endpoint == "live":
+            data = self._live(rates, timestamp, params)
+        elif endpoint == "convert":
+            data = self._convert(rates, timestamp, params)
+        elif endpoint == "list":
+            data = {"success": True, "currencies": {code: code for code in sorted(rates)}}
+        if data["success"]:
+            missing = [field for field in required if field not in data]
+            if missing:
+                raise CurrencyAPIError(f"В ответе {endpoint} от {self.name} нет полей: {', '.join(missing)}")
+        return data
+
+    def _live(self, rates, timestamp, params):
+        source = params.get("source", "USD")
+        if source not in rates:
+            return self._error(f"Валюта {source} отсутствует в источнике {self.name}")
+        currencies = params.get("currencies")
+        codes = currencies.split(",") if currencies else sorted(rates)
+        quotes = {
+            source + code: rates[code] / rates[source]
+            for code in codes
+            if code in rates and code != source
+        }
+        return {"success": True, "source": source, "timestamp": timestamp, "quotes": quotes}
+
+    def _convert(self, rates, timestamp, params):
+        from_currency = params.get("from")
+        to_currency = params.get("to")
+        missing = [code for code in (from_currency, to_currency) if code not in rates]
+        if missing:
+            return self._error(f"Валюта {', '.join(map(str, missing))} отсутствует в источнике {self.name}")
+        amount = float(params.get("amount", 1))
+        quote = rates[to_currency] / rates[from_currency]
+        return {
+            "success": True,
+            "query": {"from": from_currency, "to": to_currency, "amount": amount},
+            "info": {"timestamp": timestamp, "quote": quote},
+            "result": amount * quote,
+        }
+
+    def _error(self, info):
+        return {"success": False, "error": {"info": info}}
+
+    def close(self):
+        pass
+
+
+class FileRatesProvider(SnapshotProvider):
+    """
+    Офлайн-источник: курсы из локального файла.
+
+    Поддерживаются XML в формате ЕЦБ (eurofxref-daily.xml, базовая валюта EUR),
+    JSON вида {"base": "EUR", "date": "2026-10-16", "rates": {"USD": 1.08, ...}}
+    и сохраненный ответ /live ({"source": "USD", "quotes": {"USDEUR": 0.92, ...}}).
+    Файл перечитывается, только когда меняется время его изменения.
+    """
+
+    name = "file"
+
+    def __init__(self, path):
+        self.path = path
+        self._loaded = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _snapshot(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as exc:
+            raise CurrencyAPIError(f"Файл курсов {self.path} недоступен: {exc}") from exc
+        with self._lock:
+            if self._loaded is None or mtime != self._mtime:
+                self._loaded = self._load(mtime)
+                self._mtime = mtime
+            return self._loaded
+
+    def _load(self, mtime):
+        try:
+            with open(self.path, "rb") as f:
+                content = f.read()
+            if content.lstrip().startswith(b"<"):
+                base, rates, timestamp = self._parse_xml(content)
+            else:
+                base, rates, timestamp = self._parse_json(json.loads(content))
+        except (OSError, ValueError, ElementTree.ParseError) as exc:
+            raise CurrencyAPIError(f"Не удалось прочитать файл курсов {self.path}: {exc}") from exc
+        if not rates:
+            raise CurrencyAPIError(f"В файле курсов {self.path} нет курсов")
+        return base, rates, timestamp or int(mtime)
+
+    @staticmethod
+    def _parse_xml(content):
+        # <Cube time="2026-10-16"><Cube currency="USD" rate="1.0812"/>...</Cube>
+        root = ElementTree.fromstring(content)
+        rates = {}
+        timestamp = None
+        for element in root.iter():
+            if element.get("time") and timestamp is None:
+                timestamp = _date_to_timestamp(element.get("time"))
+            if element.get("currency") and element.get("rate"):
+                rates[element.get("currency").upper()] = float(element.get("rate"))
+        return "EUR", rates, timestamp
+
+    @staticmethod
+    def _parse_json(data):
+        if "quotes" in data:
+            source = data.get("source", "USD")
+            rates = {
+                pair[len(source):]: float(rate)
+                for pair, rate in data["quotes"].items()
+                if pair.startswith(source) and rate
+            }
+            return source, rates, data.get("timestamp")
+        timestamp = data.get("timestamp")
+        if timestamp is None and data.get("date"):
+            timestamp = _date_to_timestamp(data["date"])
+        rates = {code.upper(): float(rate) for code, rate in data.get("rates", {}).items() if rate}
+        return data.get("base", "EUR").upper(), rates, timestamp
+
+
+class OpenERAPIClient(CurrencyClient):
+    """CurrencyClient для open.er-api.com: успешный ответ помечен полем result = "success" """
+
+    def _validate(self, endpoint, data, required):
+        if not isinstance(data, dict) or "result" not in data:
+            self.failures += 1
+            raise CurrencyAPIError(f"Неожиданный формат ответа от {endpoint}")
+        if data["result"] != "success":
+            raise RequestRejectedError(f"Ошибка {data.get('error-type')} от {endpoint}")
+        return data
+
+
+class OpenERAPIProvider(SnapshotProvider):
+    """
+    Резервный сетевой источник open.er-api.com (без ключа доступа, курсы обновляются раз в сутки).
+    Снимок к базовой валюте загружается одним запросом и переиспользуется ttl секунд.
+    """
+
+    name = "open_er_api"
+
+    def __init__(self, client, base="USD", ttl=3600):
+        """
+        Args:
+            client: OpenERAPIClient (например, с адресом https://open.er-api.com/v6)
+            base: Базовая валюта снимка
+            ttl: Сколько секунд использовать загруженный снимок
+        """
+        self.client = client
+        self.base = base
+        self.ttl = ttl
+        self._loaded = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _snapshot(self):
+        with self._lock:
+            if self._loaded is None or time.monotonic() - self._loaded_at >= self.ttl:
+                data = self.client.get(f"latest/{self.base}")
+                rates = {code: float(rate) for code, rate in (data.get("rates") or {}).items() if rate}
+                if not rates:
+                    raise CurrencyAPIError(f"В ответе {self.name} нет курсов")
+                self._loaded = (data.get("base_code", self.base), rates, data.get("time_last_update_unix"))
+                self._loaded_at = time.monotonic()
+            return self._loaded
+
+    def close(self):
+        self.client.close()
+
+
+class HedgedProvider:
+    """
+    Несколько источников курсов с "подстраховывающими" (hedged) запросами.
+
+    Запрос уходит к первому источнику. Если за hedge_delay секунд он не ответил,
+    параллельно запрашивается следующий, и так далее; используется первый успешный ответ.
+    Если источник отказал (ошибка, success = false, разомкнутый предохранитель),
+    следующий запрашивается сразу, не дожидаясь hedge_delay. Поэтому задержка
+    определяется самым быстрым исправным источником, а не самым медленным.
+    Источники, которые не поддерживают запрос (supports(endpoint) ложно), пропускаются.
+
+    Запросы к источникам выполняются в контексте вызывающего (contextvars), поэтому
+    каждая попытка списывается с квоты своего источника с полосой исходного запроса.
+    """
+
+    def __init__(self, providers, hedge_delay=0.5, max_workers=8):
+        """
+        Args:
+            providers: Список пар (имя, источник) в порядке приоритета; у источника есть
+                get(endpoint, params, required) и supports(endpoint)
+            hedge_delay: Через сколько секунд без ответа запрашивать следующий источник
+            max_workers: Сколько запросов к источникам может выполняться одновременно
+        """
+        self.providers = list(providers)
+        self.hedge_delay = hedge_delay
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rate-hedge")
+        self._lock = threading.Lock()
+        self._stats = {name: {"requests": 0, "wins": 0, "failures": 0} for name, _ in self.providers}
+        self.hedged = 0
+
+    def get(self, endpoint, params=None, required=()):
+        """
+        Запрос к источникам по очереди с подстраховкой.
+
+        Returns:
+            Первый успешный ответ; если успешных нет — последний ответ с success = false
+
+        Raises:
+            CurrencyAPIError: если ни один источник не дал ответа
+            UnsupportedEndpointError: если запрос не поддерживает ни один источник
+        """
+        remaining = [(name, provider) for name, provider in self.providers if provider.supports(endpoint)]
+        if not remaining:
+            raise UnsupportedEndpointError(f"Ни один источник курсов не поддерживает запрос {endpoint}")
+        pending = {}
+        last_error = None
+        last_response = None
+
+        def launch():
+            name, provider = remaining.pop(0)
+            self._count(name, "requests")
+            context = contextvars.copy_context()
+            pending[self._executor.submit(context.run, provider.get, endpoint, params, required=required)] = name
+
+        launch()
+        while pending:
+            done, _ = wait(pending, timeout=self.hedge_delay if remaining else None, return_when=FIRST_COMPLETED)
+            if not done:
+                # Источник не уложился в hedge_delay — подключаем следующий, первый продолжает работать
+                with self._lock:
+                    self.hedged += 1
+                launch()
+                continue
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    data = future.result()
+                except Exception as exc:
+                    last_error = exc
+                    self._count(name, "failures")
+                    continue
+                if data.get("success"):
+                    self._count(name, "wins")
+                    return data
+                last_response = data
+                self._count(name, "failures")
+            if not pending and remaining:
+                launch()
+
+        if last_response is not None:
+            return last_response
+        if isinstance(last_error, CurrencyAPIError):
+            raise last_error
+        raise CurrencyAPIError(f"Ни один источник курсов не ответил на {endpoint}: {last_error}") from last_error
+
+    def supports(self, endpoint):
+        return any(provider.supports(endpoint) for _, provider in self.providers)
+
+    def _count(self, name, field):
+        with self._lock:
+            self._stats[name][field] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = {name: dict(counters) for name, counters in self._stats.items()}
+            stats["hedged"] = self.hedged
+        return stats
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        for _, provider in self.providers:
+            provider.close()
+
+
+def _date_to_timestamp(date):
+    # "2026-10-16" -> unix timestamp полуночи UTC
+    return calendar.timegm(time.strptime(date[:10], "%Y-%m-%d"))
@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+
+import database
+
+# Период обновления курсов активных путешествий, секунды
+TRIP_RATE_REFRESH = float(os.getenv("TRIP_RATE_REFRESH", 3600))
+
+
+class TripRateRefresher:
+    """
+    Фоновое обновление курсов активных путешествий с политикой "auto".
+
+    За один проход собираются различные пары (домашняя валюта, валюта путешествия)
+    по всем таким путешествиям, курсы для них берутся из одного снимка, и все
+    trips.exchange_rate / trip_currencies.exchange_rate_to_home обновляются одной
+    пачкой. Число запросов к API не зависит от числа путешествий.
+    """
+
+    def __init__(self, fetch_rates, interval=TRIP_RATE_REFRESH):
+        """
+        Args:
+            fetch_rates: Функция fetch_rates(pairs) -> ({(from, to): курс}, timestamp снимка);
+                пар, для которых курса нет, в результате быть не должно
+            interval: Период обновления в секундах
+        """
+        self.interval = interval
+        self._fetch_rates = fetch_rates
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.failed_runs = 0
+        self.last_pairs = 0
+        self.last_updated_trips = 0
+        self.last_run_at = None
+
+    def refresh_once(self):
+        """Обновить курсы один раз. Возвращает число путешествий, у которых изменился курс"""
+        pairs = database.get_auto_rate_pairs()
+        self.last_pairs = len(pairs)
+        self.last_run_at = time.time()
+        if not pairs:
+            self.last_updated_trips = 0
+            return 0
+        rates, timestamp = self._fetch_rates(pairs)
+        if not rates:
+            self.failed_runs += 1
+            return 0
+        self.last_updated_trips = database.apply_auto_rates(rates, timestamp)
+        self.runs += 1
+        return self.last_updated_trips
+
+    def start(self):
+        """Запустить фоновое обновление раз в interval секунд"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="trip-rate-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_once()
+            except Exception:
+                # Ошибка одного прохода (база, API) не должна останавливать обновление
+                self.failed_runs += 1
+            self._stop.wait(self.interval)
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "failed_runs": self.failed_runs,
+            "last_pairs": self.last_pairs,
+            "last_updated_trips": self.last_updated_trips,
+            "last_run_at": self.last_run_at,
+        }
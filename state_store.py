@@ -0,0 +1,315 @@
+import abc
+import json
+import os
+import threading
+import time
+
+import cache
+import database
+
+# Какое хранилище использовать: "memory" (по умолчанию) или "sqlite"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+# Через сколько секунд бездействия незавершенный диалог забывается
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", 24 * 3600))
+# Сколько диалогов держать в памяти (для хранилища "memory")
+FSM_MAX_STATES = int(os.getenv("FSM_MAX_STATES", 10000))
+
+# Словарь с нестроковыми ключами хранится в JSON как {_ITEMS_KEY: [[ключ, значение], ...]}
+_ITEMS_KEY = "__dict_items__"
+
+
+class StateExpiredError(KeyError):
+    """Состояния диалога нет: оно не создавалось, уже удалено или истекло по TTL"""
+
+
+class _TrackedDict(dict):
+    """
+    Словарь внутри состояния диалога: любое изменение сохраняет все состояние пользователя.
+    Вложенные словари и списки при записи тоже становятся отслеживаемыми.
+    """
+
+    def __init__(self, root, data=()):
+        self._root = root
+        super().__init__((key, _track(root, value)) for key, value in dict(data).items())
+
+    def _save(self):
+        self._root._save()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, _track(self._root, value))
+        self._save()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._save()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._save()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._save()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            super().__setitem__(key, _track(self._root, value))
+        self._save()
+
+    def clear(self):
+        super().clear()
+        self._save()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+class _TrackedList(list):
+    """Список внутри состояния диалога: любое изменение сохраняет все состояние пользователя"""
+
+    def __init__(self, root, data=()):
+        self._root = root
+        super().__init__(_track(root, value) for value in data)
+
+    def _save(self):
+        self._root._save()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [_track(self._root, item) for item in value]
+        else:
+            value = _track(self._root, value)
+        super().__setitem__(index, value)
+        self._save()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._save()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def append(self, value):
+        super().append(_track(self._root, value))
+        self._save()
+
+    def extend(self, values):
+        super().extend(_track(self._root, value) for value in values)
+        self._save()
+
+    def insert(self, index, value):
+        super().insert(index, _track(self._root, value))
+        self._save()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._save()
+        return value
+
+    def remove(self, value):
+        super().remove(value)
+        self._save()
+
+    def clear(self):
+        super().clear()
+        self._save()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._save()
+
+    def reverse(self):
+        super().reverse()
+        self._save()
+
+
+def _track(root, value):
+    # Вложенные словари и списки заменяются отслеживаемыми копиями, привязанными к состоянию root
+    if isinstance(value, (_TrackedDict, _TrackedList)) and value._root is root:
+        return value
+    if isinstance(value, dict):
+        return _TrackedDict(root, value)
+    if isinstance(value, list):
+        return _TrackedList(root, value)
+    return value
+
+
+class UserState(_TrackedDict):
+    """
+    Состояние диалога одного пользователя.
+
+    Ведет себя как обычный словарь, но каждое изменение сразу сохраняется в хранилище,
+    в том числе изменение вложенных словарей и списков, поэтому обработчики могут
+    по-прежнему писать user_data[user_id]['step'] = ... и
+    user_data[user_id]['temp_expense_data']['amount'] = ...
+    """
+
+    def __init__(self, store, user_id, data=()):
+        self._store = store
+        self._user_id = user_id
+        super().__init__(self, data)
+
+    def _save(self):
+        self._store.save(self._user_id, self)
+
+
+def _plain(value):
+    # Глубокая копия состояния из обычных dict/list (без привязки к хранилищу)
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    return value
+
+
+def _encode(value):
+    # JSON-совместимое представление: ключи-числа не превращаются в строки
+    if isinstance(value, dict):
+        if all(isinstance(key, str) for key in value) and _ITEMS_KEY not in value:
+            return {key: _encode(item) for key, item in value.items()}
+        return {_ITEMS_KEY: [[key, _encode(item)] for key, item in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if list(value) == [_ITEMS_KEY]:
+            return {key: _decode(item) for key, item in value[_ITEMS_KEY]}
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+class StateStore(abc.ABC):
+    """
+    Интерфейс хранилища состояний диалогов (конечного автомата бота).
+
+    Бэкенд реализует load/save/delete; доступ в стиле словаря
+    (user_data[user_id], user_data.get(...), `in`, del) построен поверх них.
+    Состояние хранится по значению: словари, списки, строки, числа, bool и None;
+    ключи словарей — строки или числа, кортежи возвращаются списками.
+
+    Состояние может истечь по TTL посреди диалога: тогда user_data[user_id]
+    выбрасывает StateExpiredError (подкласс KeyError), а del user_data[user_id]
+    ничего не делает.
+    """
+
+    @abc.abstractmethod
+    def load(self, user_id):
+        """Вернуть сохраненное состояние (dict) или None"""
+
+    @abc.abstractmethod
+    def save(self, user_id, state):
+        """Сохранить состояние целиком"""
+
+    @abc.abstractmethod
+    def delete(self, user_id):
+        """Удалить состояние. Возвращает False, если его не было"""
+
+    def __getitem__(self, user_id):
+        state = self.load(user_id)
+        if state is None:
+            raise StateExpiredError(user_id)
+        return UserState(self, user_id, state)
+
+    def get(self, user_id, default=None):
+        state = self.load(user_id)
+        if state is None:
+            return default
+        return UserState(self, user_id, state)
+
+    def __setitem__(self, user_id, state):
+        self.save(user_id, state)
+
+    def __delitem__(self, user_id):
+        # Истекшее состояние уже удалено — завершение диалога не должно из-за этого падать
+        self.delete(user_id)
+
+    def __contains__(self, user_id):
+        return self.load(user_id) is not None
+
+
+class MemoryStateStore(StateStore):
+    """
+    Хранилище в памяти процесса: не больше maxsize диалогов (давно не использованные
+    вытесняются), каждый живет ttl секунд с последнего изменения.
+    """
+
+    def __init__(self, maxsize=FSM_MAX_STATES, ttl=FSM_STATE_TTL, clock=time.monotonic):
+        self._states = cache.LRUCache(maxsize=maxsize, ttl=ttl, clock=clock)
+
+    def load(self, user_id):
+        return self._states.get(user_id)
+
+    def save(self, user_id, state):
+        self._states.set(user_id, _plain(state))
+
+    def delete(self, user_id):
+        return self._states.pop(user_id) is not None
+
+    def stats(self):
+        return self._states.stats()
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Хранилище в таблице fsm_state: переживает перезапуск бота и общее для всех
+    процессов, работающих с одной базой. Состояние хранится в JSON.
+
+    Просроченные состояния не возвращаются и периодически удаляются из таблицы.
+    """
+
+    def __init__(self, ttl=FSM_STATE_TTL, purge_interval=3600, clock=time.time):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._clock = clock
+        self._next_purge = clock() + purge_interval
+        self._purge_lock = threading.Lock()
+
+    def load(self, user_id):
+        row = database.get_fsm_state(user_id)
+        if row is None:
+            return None
+        state, updated_at = row
+        if updated_at < self._clock() - self.ttl:
+            return None
+        return _decode(json.loads(state))
+
+    def save(self, user_id, state):
+        now = self._clock()
+        database.save_fsm_state(user_id, json.dumps(_encode(state), ensure_ascii=False), now)
+        if now >= self._next_purge and self._purge_lock.acquire(blocking=False):
+            try:
+                self._next_purge = now + self.purge_interval
+                self.purge_expired()
+            finally:
+                self._purge_lock.release()
+
+    def delete(self, user_id):
+        return database.delete_fsm_state(user_id)
+
+    def purge_expired(self):
+        """Удалить из таблицы просроченные состояния. Возвращает число удаленных"""
+        return database.purge_fsm_states(self._clock() - self.ttl)
+
+
+def create_state_store(storage=None):
+    """Создать хранилище состояний по имени ("memory" или "sqlite"; по умолчанию FSM_STORAGE)"""
+    storage = (storage or FSM_STORAGE).lower()
+    if storage == "memory":
+        return MemoryStateStore()
+    if storage == "sqlite":
+        return SQLiteStateStore()
+    raise ValueError(f"Неизвестное хранилище состояний: {storage}")
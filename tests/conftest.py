@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Модуль database, настроенный на пустую временную базу с примененными миграциями"""
+    original_path = database.DB_PATH
+    database.configure(db_path=str(tmp_path / "travel_bot.db"))
+    database.init_db()
+    yield database
+    database.configure(db_path=original_path)
@@ -0,0 +1,102 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from async_currency_client import AsyncCurrencyClient
+from currency_client import CurrencyAPIError
+
+N = 16
+
+
+class _GatedProvider:
+    """Источник курсов, который отвечает только после release(): считает обращения к себе"""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+        self._gate = threading.Event()
+        self._lock = threading.Lock()
+
+    def release(self):
+        self._gate.set()
+
+    def get(self, endpoint, params=None, required=()):
+        with self._lock:
+            self.calls += 1
+        self._gate.wait(5)
+        if self.error is not None:
+            raise self.error
+        return {"success": True, "query": dict(params), "result": 3.1}
+
+
+@pytest.fixture
+def client():
+    clients = []
+
+    def make(provider):
+        clients.append(AsyncCurrencyClient(provider))
+        return clients[-1]
+
+    yield make
+    for async_client in clients:
+        async_client.close()
+
+
+def _fire(async_client, provider, params):
+    # N потоков запрашивают одно и то же; источник отвечает, когда все N уже ждут
+    with ThreadPoolExecutor(max_workers=N) as pool:
+        futures = [pool.submit(async_client.get_sync, "convert", params, ("result",)) for _ in range(N)]
+        deadline = time.monotonic() + 5
+        while async_client.coalesced < N - 1 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        provider.release()
+        outcomes = []
+        for future in futures:
+            try:
+                outcomes.append(future.result(5))
+            except Exception as exc:
+                outcomes.append(exc)
+    return outcomes
+
+
+def test_concurrent_identical_lookups_make_one_upstream_call(client):
+    provider = _GatedProvider()
+    async_client = client(provider)
+
+    results = _fire(async_client, provider, {"from": "RUB", "to": "THB", "amount": 1})
+
+    assert provider.calls == 1
+    assert async_client.upstream_calls == 1
+    assert async_client.coalesced == N - 1
+    assert results == [{"success": True, "query": {"from": "RUB", "to": "THB", "amount": 1}, "result": 3.1}] * N
+
+
+def test_error_is_delivered_to_every_waiter(client):
+    error = CurrencyAPIError("API недоступно")
+    provider = _GatedProvider(error=error)
+    async_client = client(provider)
+
+    outcomes = _fire(async_client, provider, {"from": "RUB", "to": "THB", "amount": 1})
+
+    assert provider.calls == 1
+    assert all(outcome is error for outcome in outcomes)
+    # После ошибки запрос не "залипает": следующий вызов снова идет к источнику
+    provider.error = None
+    assert async_client.get_sync("convert", {"from": "RUB", "to": "THB", "amount": 1}, ("result",))["success"]
+    assert provider.calls == 2
+
+
+def test_different_lookups_are_not_coalesced(client):
+    provider = _GatedProvider()
+    provider.release()
+    async_client = client(provider)
+
+    results = async_client.get_many_sync([
+        ("convert", {"from": "RUB", "to": "THB"}, ()),
+        ("convert", {"from": "RUB", "to": "EUR"}, ()),
+    ])
+
+    assert provider.calls == 2
+    assert [result["query"]["to"] for result in results] == ["THB", "EUR"]
@@ -0,0 +1,129 @@
+import random
+import threading
+from collections import defaultdict
+
+import pytest
+
+THREADS = 8
+CALLS_PER_THREAD = 100
+RATES = {"EUR": 0.4, "USD": 0.44}
+INITIAL_BALANCES = {"EUR": 400.0, "USD": 100.0}
+INITIAL_HOME_BALANCE = 1000.0
+CATEGORIES = (1, 2, 3)
+
+
+def _worker(db, trip_id, seed, barrier, expenses, adjustments, errors):
+    """
+    Случайная смесь record_expense / adjust_balance / update_expense / delete_expense.
+
+    Поток меняет только свои расходы и запоминает, что должно остаться в базе:
+    expenses — {expense_id: (валюта, категория, amount_target, amount_home)},
+    adjustments — {валюта: [сумма delta_target, сумма delta_home]}.
+    """
+    rng = random.Random(seed)
+    try:
+        barrier.wait()
+        for _ in range(CALLS_PER_THREAD):
+            action = rng.random()
+            currency = rng.choice(tuple(RATES))
+            amount = rng.randint(1, 400) / 4
+            if action < 0.4 or not expenses:
+                category_id = rng.choice(CATEGORIES)
+                result = db.record_expense(trip_id, category_id, amount, amount / RATES[currency], currency, "RUB")
+                expenses[result['expense_id']] = (currency, category_id, amount, amount / RATES[currency])
+            elif action < 0.6:
+                # home_balance ведется только для основной валюты путешествия
+                delta_home = amount / RATES[currency] if currency == "EUR" else 0.0
+                db.adjust_balance(trip_id, currency, amount, delta_home)
+                adjustments[currency][0] += amount
+                adjustments[currency][1] += delta_home
+            elif action < 0.8:
+                expense_id = rng.choice(list(expenses))
+                currency, _, _, _ = expenses[expense_id]
+                category_id = rng.choice(CATEGORIES)
+                assert db.update_expense(expense_id, amount / RATES[currency], amount, category_id)
+                expenses[expense_id] = (currency, category_id, amount, amount / RATES[currency])
+            else:
+                expense_id = rng.choice(list(expenses))
+                assert db.delete_expense(expense_id)
+                del expenses[expense_id]
+    except Exception as exc:  # pragma: no cover - сообщение попадет в assert ниже
+        errors.append(exc)
+
+
+def test_concurrent_balance_updates_lose_nothing(db):
+    trip_id = db.create_trip(1, "Стресс", "RUB", "EUR", RATES["EUR"], INITIAL_HOME_BALANCE,
+                             INITIAL_BALANCES["EUR"], 0, 80)
+    db.add_trip_currency(trip_id, "USD", INITIAL_BALANCES["USD"], RATES["USD"])
+    for category_id in CATEGORIES:
+        db.set_category_budget(trip_id, category_id, 10000.0, "RUB")
+
+    barrier = threading.Barrier(THREADS)
+    results = [({}, defaultdict(lambda: [0.0, 0.0])) for _ in range(THREADS)]
+    errors = []
+    threads = [
+        threading.Thread(target=_worker, args=(db, trip_id, seed, barrier, expenses, adjustments, errors))
+        for seed, (expenses, adjustments) in enumerate(results)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+    expected_expenses = {}
+    adjustments = defaultdict(lambda: [0.0, 0.0])
+    for thread_expenses, thread_adjustments in results:
+        expected_expenses.update(thread_expenses)
+        for currency, (delta_target, delta_home) in thread_adjustments.items():
+            adjustments[currency][0] += delta_target
+            adjustments[currency][1] += delta_home
+
+    conn = db.get_connection()
+    rows = conn.execute(
+        'SELECT expense_id, currency_target, category_id, amount_target, amount_home FROM expenses WHERE trip_id = ?',
+        (trip_id,),
+    ).fetchall()
+    assert {row['expense_id']: (row['currency_target'], row['category_id']) for row in rows} == {
+        expense_id: expense[:2] for expense_id, expense in expected_expenses.items()
+    }
+    assert {row['expense_id']: row['amount_target'] for row in rows} == pytest.approx(
+        {expense_id: expense[2] for expense_id, expense in expected_expenses.items()})
+    assert {row['expense_id']: row['amount_home'] for row in rows} == pytest.approx(
+        {expense_id: expense[3] for expense_id, expense in expected_expenses.items()})
+
+    spent_target = defaultdict(float)
+    spent_home = defaultdict(float)
+    totals = defaultdict(float)
+    spent_by_category = defaultdict(float)
+    for currency, category_id, amount_target, amount_home in expected_expenses.values():
+        spent_target[currency] += amount_target
+        spent_home[currency] += amount_home
+        spent_by_category[category_id] += amount_home
+        totals[(category_id, currency, 'amount_home')] += amount_home
+        totals[(category_id, currency, 'amount_target')] += amount_target
+        totals[(category_id, currency, 'expense_count')] += 1
+
+    balances = dict(conn.execute(
+        'SELECT currency_code, balance FROM trip_currencies WHERE trip_id = ?', (trip_id,)
+    ).fetchall())
+    for currency, initial in INITIAL_BALANCES.items():
+        assert balances[currency] == pytest.approx(initial - spent_target[currency] + adjustments[currency][0])
+
+    trip = conn.execute('SELECT home_balance, target_balance FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
+    assert trip['target_balance'] == pytest.approx(
+        INITIAL_BALANCES["EUR"] - spent_target["EUR"] + adjustments["EUR"][0])
+    assert trip['home_balance'] == pytest.approx(
+        INITIAL_HOME_BALANCE - spent_home["EUR"] + adjustments["EUR"][1])
+
+    stored_totals = {
+        (row['category_id'], row['currency_code'], field): row[field]
+        for row in conn.execute('SELECT * FROM trip_totals WHERE trip_id = ? AND expense_count > 0', (trip_id,))
+        for field in ('amount_home', 'amount_target', 'expense_count')
+    }
+    assert stored_totals == pytest.approx(dict(totals))
+
+    spent = dict(conn.execute(
+        'SELECT category_id, spent_amount FROM category_budgets WHERE trip_id = ?', (trip_id,)
+    ).fetchall())
+    assert spent == pytest.approx({category_id: spent_by_category[category_id] for category_id in CATEGORIES})
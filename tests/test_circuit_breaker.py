@@ -0,0 +1,238 @@
+import threading
+
+import pytest
+import requests
+
+import current_api
+from cache import LRUCache
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from currency_client import CircuitOpenError, CurrencyAPIError, CurrencyClient
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return _Clock()
+
+
+def _breaker(clock, threshold=3, reset_timeout=10.0):
+    return CircuitBreaker(failure_threshold=threshold, reset_timeout=reset_timeout, clock=clock)
+
+
+def test_opens_after_threshold_and_rejects(clock):
+    breaker = _breaker(clock)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.stats() == {"state": OPEN, "failures": 3, "rejected": 1, "trips": 1}
+
+
+def test_success_resets_failure_count(clock):
+    breaker = _breaker(clock)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_lets_single_trial_through(clock):
+    breaker = _breaker(clock)
+    for _ in range(3):
+        breaker.record_failure()
+
+    clock.now = 10.0
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow() and breaker.allow()
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_failed_trial_reopens(clock):
+    breaker = _breaker(clock)
+    for _ in range(3):
+        breaker.record_failure()
+
+    clock.now = 10.0
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.stats()["trips"] == 2
+
+    # Новый отсчет reset_timeout идет от момента неудачной пробы
+    clock.now = 19.0
+    assert not breaker.allow()
+    clock.now = 20.0
+    assert breaker.allow()
+
+
+def test_cancel_frees_trial_slot(clock):
+    breaker = _breaker(clock, threshold=1)
+    breaker.record_failure()
+    clock.now = 10.0
+    assert breaker.allow()
+    breaker.cancel()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+
+
+def test_stats_do_not_deadlock_with_concurrent_updates(clock):
+    breaker = _breaker(clock, threshold=1000)
+    stop = threading.Event()
+
+    def fail():
+        while not stop.is_set():
+            breaker.record_failure()
+
+    worker = threading.Thread(target=fail)
+    worker.start()
+    try:
+        for _ in range(200):
+            stats = breaker.stats()
+            assert stats["state"] == (OPEN if stats["failures"] >= 1000 else CLOSED)
+    finally:
+        stop.set()
+        worker.join()
+
+
+class _DownSession:
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.calls += 1
+        raise requests.ConnectionError("нет сети")
+
+
+def test_client_stops_calling_api_when_open(clock):
+    session = _DownSession()
+    client = CurrencyClient("http://rates.test", retries=0, backoff=0, session=session,
+                            breaker=_breaker(clock, threshold=2))
+    for _ in range(2):
+        with pytest.raises(CurrencyAPIError):
+            client.get("live")
+    with pytest.raises(CircuitOpenError):
+        client.get("live")
+    assert session.calls == 2
+
+
+# --- stale-while-revalidate в current_api ---
+
+class _EmptyMatrix:
+    def rate(self, from_currency, to_currency):
+        return None
+
+    def age(self):
+        return None
+
+    def is_stale(self):
+        return True
+
+    def needs_refresh(self):
+        return False
+
+
+class _ManualExecutor:
+    """Откладывает фоновые задачи, пока тест не выполнит их явно"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, func, *args):
+        self.jobs.append((func, args))
+
+    def run(self):
+        jobs, self.jobs = self.jobs, []
+        for func, args in jobs:
+            func(*args)
+
+
+@pytest.fixture
+def rates(monkeypatch):
+    executor = _ManualExecutor()
+    convert_calls = []
+    state = {"rate": 0.95}
+
+    def convert_currency(amount, from_currency, to_currency, priority=current_api.quota.INTERACTIVE):
+        convert_calls.append((from_currency, to_currency, priority))
+        if state["rate"] is None:
+            return {"success": False, "error": {"info": "нет сети"}}
+        return {"success": True, "info": {"quote": state["rate"]}, "result": amount * state["rate"]}
+
+    monkeypatch.setattr(current_api, "_rate_cache", LRUCache(maxsize=16))
+    monkeypatch.setattr(current_api, "rate_matrix", _EmptyMatrix())
+    monkeypatch.setattr(current_api, "_stored_rate", lambda *args: None)
+    monkeypatch.setattr(current_api, "_revalidate_executor", executor)
+    monkeypatch.setattr(current_api, "convert_currency", convert_currency)
+    return executor, convert_calls, state
+
+
+def _put_stale(rate, age):
+    current_api._rate_cache.set(("USD", "EUR"), (rate, current_api.time.monotonic() - age))
+
+
+def test_stale_rate_is_served_and_revalidated_in_background(rates):
+    executor, convert_calls, _ = rates
+    _put_stale(0.9, current_api.RATE_CACHE_TTL + 5)
+
+    quote = current_api.lookup_rate("USD", "EUR")
+    assert quote.rate == 0.9 and quote.stale
+    assert convert_calls == []
+
+    # Повторный запрос до обновления не ставит вторую фоновую задачу
+    assert current_api.lookup_rate("USD", "EUR").stale
+    assert len(executor.jobs) == 1
+
+    executor.run()
+    assert convert_calls == [("USD", "EUR", current_api.quota.BACKGROUND)]
+    quote = current_api.lookup_rate("USD", "EUR")
+    assert quote.rate == 0.95 and not quote.stale
+
+
+def test_stale_rate_survives_failed_revalidation(rates):
+    executor, _, state = rates
+    state["rate"] = None
+    _put_stale(0.9, current_api.RATE_CACHE_TTL + 5)
+
+    assert current_api.lookup_rate("USD", "EUR").rate == 0.9
+    executor.run()
+
+    quote = current_api.lookup_rate("USD", "EUR")
+    assert quote.rate == 0.9 and quote.stale
+    assert len(executor.jobs) == 1
+
+
+def test_fresh_rate_does_not_revalidate(rates):
+    executor, convert_calls, _ = rates
+    _put_stale(0.9, 1)
+
+    quote = current_api.lookup_rate("USD", "EUR")
+    assert quote.rate == 0.9 and not quote.stale
+    assert executor.jobs == [] and convert_calls == []
+
+
+def test_missing_rate_waits_for_api(rates, monkeypatch):
+    executor, convert_calls, _ = rates
+    monkeypatch.setattr(current_api, "get_matrix_rate", lambda *args: None)
+
+    quote = current_api.lookup_rate("USD", "EUR")
+    assert quote.rate == 0.95 and not quote.stale
+    assert convert_calls == [("USD", "EUR", current_api.quota.INTERACTIVE)]
+    assert executor.jobs == []
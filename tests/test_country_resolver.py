@@ -0,0 +1,82 @@
+import pytest
+
+import country_resolver
+
+
+@pytest.fixture(scope="module")
+def index():
+    return country_resolver.get_index()
+
+
+# Коды ISO 3166-1 alpha-2/alpha-3 в любом регистре
+@pytest.mark.parametrize("query, alpha2", [
+    ("RU", "RU"), ("rus", "RU"), ("DEU", "DE"), ("de", "DE"),
+    ("us", "US"), ("USA", "US"), ("DOM", "DO"), ("uk", "GB"), ("UAE", "AE"),
+])
+def test_iso_codes(index, query, alpha2):
+    assert index.resolve(query).alpha2 == alpha2
+
+
+# Русские и английские названия, синонимы, диакритика и пунктуация
+@pytest.mark.parametrize("query, alpha2", [
+    ("Германия", "DE"), ("Thailand", "TH"), ("Таиланд", "TH"), ("Тайланд", "TH"),
+    ("México", "MX"), ("mexico", "MX"), ("Кот-д’Ивуар", "CI"), ("Cote d'Ivoire", "CI"),
+    ("Голландия", "NL"), ("США", "US"), ("Америка", "US"), ("Англия", "GB"), ("ОАЭ", "AE"),
+    ("  великобритания  ", "GB"), ("Белоруссия", "BY"), ("Беларусь", "BY"),
+])
+def test_names_and_aliases(index, query, alpha2):
+    assert index.resolve(query).alpha2 == alpha2
+
+
+# Название по-русски, набранное латиницей
+@pytest.mark.parametrize("query, alpha2", [
+    ("Germaniya", "DE"), ("frantsiya", "FR"), ("italiya", "IT"), ("Avstriya", "AT"), ("Kazahstan", "KZ"),
+])
+def test_transliteration(index, query, alpha2):
+    assert index.resolve(query).alpha2 == alpha2
+
+
+# Опечатки: пропущенные и переставленные буквы
+@pytest.mark.parametrize("query, alpha2", [
+    ("Германи", "DE"), ("Гемрания", "DE"), ("Germny", "DE"), ("Tailand", "TH"),
+    ("Казахтан", "KZ"), ("Вьетнм", "VN"), ("Грузиа", "GE"), ("Австия", "AT"), ("Австалия", "AU"),
+])
+def test_typos(index, query, alpha2):
+    assert index.resolve(query).alpha2 == alpha2
+
+
+# Похожие названия разных стран не путаются между собой
+@pytest.mark.parametrize("query, alpha2", [
+    ("Австрия", "AT"), ("Австралия", "AU"),
+    ("Нигер", "NE"), ("Нигерия", "NG"), ("Нигериа", "NG"),
+    ("Мали", "ML"), ("Мальта", "MT"),
+    ("Доминика", "DM"), ("Доминикана", "DO"),
+    ("Iceland", "IS"), ("Ireland", "IE"), ("Исландия", "IS"), ("Ирландия", "IE"),
+    ("Корея", "KR"), ("Северная Корея", "KP"),
+    ("Гвинея", "GN"), ("Гвинея-Бисау", "GW"),
+])
+def test_ambiguous_queries(index, query, alpha2):
+    assert index.resolve(query).alpha2 == alpha2
+
+
+# Короткие запросы сравниваются только точно, а транслитерация не превращает слово в код ISO
+@pytest.mark.parametrize("query", ["", "   ", "ит", "Дом", "дом", "zzzz", "Franse"])
+def test_not_found(index, query):
+    assert index.resolve(query) is None
+
+
+def test_guess_currency_and_catalog():
+    assert country_resolver.guess_currency("Таиланд") == "THB"
+    assert country_resolver.guess_currency("Черногория") == "EUR"
+    assert country_resolver.guess_currency("Дом") is None
+    assert {"RUB", "EUR", "THB", "XOF"} <= country_resolver.currencies()
+
+
+def test_codes_are_not_matched_by_transliteration():
+    country = country_resolver.Country("DO", "DOM", "DOP", "Dominican Republic", "Доминиканская Республика")
+    house = country_resolver.Country("XX", None, "XXX", "Dom", "Дом")
+    index = country_resolver.CountryIndex([(country, [country.name_en, country.name_ru])])
+    assert index.resolve("dom").alpha2 == "DO"
+    assert index.resolve("дом") is None
+    index = country_resolver.CountryIndex([(country, [country.name_en]), (house, [house.name_ru])])
+    assert index.resolve("дом").alpha2 == "XX"
@@ -0,0 +1,107 @@
+import sqlite3
+
+import pytest
+
+from db_writer import WriteQueue
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "writer.db")
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("CREATE TABLE items (name TEXT PRIMARY KEY)")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def _connect(path):
+    return lambda: sqlite3.connect(path, check_same_thread=False)
+
+
+def _names(path):
+    conn = sqlite3.connect(path)
+    try:
+        return sorted(row[0] for row in conn.execute("SELECT name FROM items"))
+    finally:
+        conn.close()
+
+
+def _insert(cursor, name):
+    cursor.execute("INSERT INTO items (name) VALUES (?)", (name,))
+    return name
+
+
+def _insert_and_fail(cursor, name):
+    cursor.execute("INSERT INTO items (name) VALUES (?)", (name,))
+    raise ValueError(name)
+
+
+def _run_batch(writer, operations):
+    # Операции ставятся в очередь до запуска потока, поэтому попадают в одну пачку
+    futures = [writer.submit(func, *args) for func, *args in operations]
+    writer.start()
+    try:
+        for future in futures:
+            future.exception(5)
+    finally:
+        writer.stop(5)
+    return futures
+
+
+def test_failed_operation_rolls_back_only_its_savepoint(db_path):
+    writer = WriteQueue(_connect(db_path))
+    first, failed, duplicate, last = _run_batch(writer, [
+        (_insert, "a"),
+        (_insert_and_fail, "b"),
+        (_insert, "a"),  # нарушение PRIMARY KEY внутри той же пачки
+        (_insert, "c"),
+    ])
+
+    assert writer.batches == 1
+    assert first.result() == "a" and last.result() == "c"
+    assert isinstance(failed.exception(), ValueError)
+    assert isinstance(duplicate.exception(), sqlite3.IntegrityError)
+    assert _names(db_path) == ["a", "c"]
+
+
+def test_futures_resolve_only_after_commit(db_path):
+    writer = WriteQueue(_connect(db_path))
+    seen = {}
+
+    def check_committed(future):
+        # Колбэк выполняется в момент выдачи результата: другое соединение уже видит запись
+        seen[future.result()] = _names(db_path)
+
+    futures = [writer.submit(_insert, name) for name in ("a", "b")]
+    for future in futures:
+        future.add_done_callback(check_committed)
+    writer.start()
+    try:
+        for future in futures:
+            future.result(5)
+    finally:
+        writer.stop(5)
+
+    assert writer.batches == 1
+    assert seen == {"a": ["a", "b"], "b": ["a", "b"]}
+
+
+def test_after_batch_runs_before_any_future_resolves(db_path):
+    events = []
+    futures = []
+    writer = WriteQueue(_connect(db_path), after_batch=lambda: events.append(
+        ("after_batch", [future.done() for future in futures], _names(db_path))))
+    futures.extend([writer.submit(_insert, "a"), writer.submit(_insert_and_fail, "b")])
+    for future in futures:
+        future.add_done_callback(lambda future: events.append("resolved"))
+    writer.start()
+    try:
+        for future in futures:
+            future.exception(5)
+    finally:
+        writer.stop(5)
+
+    assert events == [("after_batch", [False, False], ["a"]), "resolved", "resolved"]
+
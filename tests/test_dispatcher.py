@@ -0,0 +1,184 @@
+from types import SimpleNamespace
+
+import pytest
+
+import dispatcher
+import state_store
+
+
+def _message(text, user_id=1):
+    return SimpleNamespace(text=text, from_user=SimpleNamespace(id=user_id))
+
+
+def _call(data, user_id=1):
+    return SimpleNamespace(data=data, from_user=SimpleNamespace(id=user_id))
+
+
+def test_error_handler_catches_expired_state():
+    router = dispatcher.Router(lambda user_id: None)
+    handled = []
+
+    @router.text("/go")
+    def go(message):
+        raise state_store.StateExpiredError(message.from_user.id)
+
+    @router.callback("go")
+    def go_callback(call):
+        raise state_store.StateExpiredError(call.from_user.id)
+
+    @router.error(KeyError)
+    def expired(update, exc):
+        handled.append((update, type(exc)))
+
+    message, call = _message("/go"), _call("go")
+    router.dispatch_message(message)
+    router.dispatch_callback(call)
+    assert handled == [(message, state_store.StateExpiredError), (call, state_store.StateExpiredError)]
+
+
+def test_unhandled_errors_propagate():
+    router = dispatcher.Router(lambda user_id: None)
+
+    @router.text("/boom")
+    def boom(message):
+        raise ValueError("boom")
+
+    @router.error(state_store.StateExpiredError)
+    def expired(update, exc):
+        pass
+
+    with pytest.raises(ValueError):
+        router.dispatch_message(_message("/boom"))
+    with pytest.raises(ValueError):
+        router.error(state_store.StateExpiredError)(expired)
+
+
+class _States:
+    """Состояния диалогов по user_id; считает обращения, чтобы проверить, когда они читаются"""
+
+    def __init__(self, **states):
+        self.states = {int(user_id[1:]): state for user_id, state in states.items()}
+        self.reads = 0
+
+    def __call__(self, user_id):
+        self.reads += 1
+        return self.states.get(user_id)
+
+
+def _named(name):
+    def handler(update):
+        pass
+    handler.__name__ = name
+    return handler
+
+
+@pytest.fixture
+def router():
+    states = _States(u1={"step": "amount"}, u2={"step": "category"}, u3={"budget_step": "limit"})
+    router = dispatcher.Router(states)
+    router.states = states
+    router.text("📊 Баланс", "/balance")(_named("balance"))
+    router.text("/start")(_named("start"))
+    router.step("amount")(_named("amount"))
+    router.step("category", "category_new")(_named("category"))
+    router.step("limit", field="budget_step")(_named("budget_limit"))
+    router.fallback(_named("fallback"))
+    router.callback("cat_budget_done")(_named("budget_done"))
+    router.callback_prefix("cat_")(_named("category_any"))
+    router.callback_prefix("cat_", step="category")(_named("category_step"))
+    router.callback_prefix("cur_del_")(_named("currency_delete"))
+    router.callback_prefix("cur_del_ok_")(_named("currency_delete_ok"))
+    return router
+
+
+@pytest.mark.parametrize("text, user_id, expected", [
+    ("📊 Баланс", 1, "balance"),
+    ("/balance", 1, "balance"),
+    ("/balance@travel_bot 10", 1, "balance"),
+    ("/start extra", 1, "start"),
+    ("/unknown", 1, "amount"),
+    ("150", 1, "amount"),
+    ("Еда", 2, "category"),
+    ("5000", 3, "budget_limit"),
+    ("150", 4, "fallback"),
+    ("", 4, "fallback"),
+])
+def test_message_routes(router, text, user_id, expected):
+    assert router.resolve_message(_message(text, user_id)).__name__ == expected
+
+
+def test_text_routes_win_over_steps_without_reading_state(router):
+    # Кнопка меню посреди диалога ведет в меню, и состояние для этого не читается
+    assert router.resolve_message(_message("📊 Баланс", 1)).__name__ == "balance"
+    assert router.states.reads == 0
+
+
+@pytest.mark.parametrize("data, user_id, expected", [
+    ("cat_budget_done", 1, "budget_done"),
+    ("cat_budget_done", 2, "budget_done"),
+    ("cat_3", 1, "category_any"),
+    ("cat_3", 4, "category_any"),
+    ("cat_3", 2, "category_step"),
+    ("cur_del_EUR", 1, "currency_delete"),
+    ("cur_del_ok_EUR", 1, "currency_delete_ok"),
+    ("cur_del_", 1, "currency_delete"),
+    ("cur_", 1, None),
+    ("unknown", 1, None),
+    ("", 1, None),
+])
+def test_callback_routes(router, data, user_id, expected):
+    handler = router.resolve_callback(_call(data, user_id))
+    assert (handler and handler.__name__) == expected
+
+
+def test_callback_state_is_read_only_for_step_routes(router):
+    router.resolve_callback(_call("cur_del_ok_EUR", 2))
+    router.resolve_callback(_call("cat_budget_done", 2))
+    assert router.states.reads == 0
+    router.resolve_callback(_call("cat_3", 2))
+    assert router.states.reads == 1
+
+
+def test_step_route_falls_back_to_generic_prefix():
+    router = dispatcher.Router(lambda user_id: {"step": "other"})
+    router.callback_prefix("cat_", step="category")(_named("category_step"))
+    router.callback_prefix("c")(_named("short"))
+    # У "cat_" нет обработчика для шага other — берется следующий по длине префикс
+    assert router.resolve_callback(_call("cat_3")).__name__ == "short"
+
+
+def test_duplicate_routes_are_rejected(router):
+    for register in (
+        router.text("/balance"),
+        router.step("amount"),
+        router.step("limit", field="budget_step"),
+        router.callback("cat_budget_done"),
+        router.callback_prefix("cat_"),
+        router.callback_prefix("cat_", step="category"),
+    ):
+        with pytest.raises(ValueError):
+            register(_named("duplicate"))
+    with pytest.raises(ValueError):
+        router.fallback(_named("duplicate"))
+
+    # Тот же префикс для другого шага и тот же шаг в другом поле — разные маршруты
+    router.callback_prefix("cat_", step="amount")(_named("category_amount"))
+    router.step("amount", field="budget_step")(_named("budget_amount"))
+
+
+def test_dispatch_calls_handler_and_ignores_unrouted():
+    router = dispatcher.Router(lambda user_id: None)
+    calls = []
+    router.text("/go")(calls.append)
+    router.callback_prefix("go_")(calls.append)
+
+    message, call = _message("/go"), _call("go_1")
+    router.dispatch_message(message)
+    router.dispatch_callback(call)
+    router.dispatch_message(_message("просто текст"))
+    router.dispatch_callback(_call("stop"))
+    assert calls == [message, call]
+
+
+def test_stats(router):
+    assert router.stats() == {"texts": 3, "steps": 4, "callbacks": 1, "callback_prefixes": 3, "errors": 0}
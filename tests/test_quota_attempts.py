@@ -0,0 +1,82 @@
+import pytest
+
+import quota
+from currency_client import CurrencyAPIError, CurrencyClient
+
+
+class _Response:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+class _FlakySession:
+    """Сессия без сети: первые failures ответов — HTTP 503, затем успешный ответ"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            return _Response(503)
+        return _Response(200, {"success": True, "quotes": {}})
+
+
+def _client(session, manager, retries=2):
+    return CurrencyClient("http://rates.test", retries=retries, backoff=0, session=session,
+                          before_request=manager.before_request)
+
+
+def test_each_retry_is_charged_to_quota():
+    manager = quota.QuotaManager(per_second=100, burst=100)
+    session = _FlakySession(failures=2)
+    _client(session, manager).get("live", required=("quotes",))
+
+    assert session.calls == 3
+    assert manager.stats()["used"] == 3
+    assert manager.granted[quota.INTERACTIVE] == 3
+
+
+def test_retries_stop_when_quota_is_exhausted():
+    manager = quota.QuotaManager(per_second=100, burst=100, monthly_limit=2)
+    session = _FlakySession(failures=5)
+    with pytest.raises(quota.QuotaExceededError):
+        _client(session, manager).get("live")
+
+    # Третья попытка не отправлена: квота кончилась после двух
+    assert session.calls == 2
+    assert manager.rejected[quota.INTERACTIVE] == 1
+
+
+def test_priority_is_taken_from_request_context():
+    manager = quota.QuotaManager(per_second=100, burst=100)
+    client = _client(_FlakySession(failures=1), manager)
+    with quota.request_priority(quota.BACKGROUND):
+        client.get("live")
+
+    assert manager.granted == {quota.INTERACTIVE: 0, quota.BACKGROUND: 2}
+
+
+def test_usage_is_persisted_per_provider(db):
+    period = "2026-10"
+    db.add_api_usage(period, 3, "exchangerate_host")
+    db.add_api_usage(period, 5, "open_er_api")
+    assert db.add_api_usage(period, 2, "open_er_api") == 7
+
+    assert db.get_api_usage(period, "exchangerate_host") == 3
+    assert db.get_api_usage(period, "open_er_api") == 7
+    assert db.get_api_usage(period) == 3
+    assert db.get_api_usage("2026-09", "open_er_api") == 0
+
+
+def test_failed_attempts_still_raise_after_retries():
+    manager = quota.QuotaManager(per_second=100, burst=100)
+    session = _FlakySession(failures=10)
+    with pytest.raises(CurrencyAPIError):
+        _client(session, manager, retries=1).get("live")
+    assert manager.stats()["used"] == session.calls == 2
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from currency_client import UnsupportedEndpointError
+from rate_providers import FileRatesProvider, HedgedProvider
+
+
+class _HistoryProvider:
+    """Источник, который отдает только исторические курсы"""
+
+    def __init__(self):
+        self.calls = []
+
+    def supports(self, endpoint):
+        return endpoint == "timeframe"
+
+    def get(self, endpoint, params=None, required=()):
+        self.calls.append(endpoint)
+        return {"success": True, "quotes": {"2026-10-01": {"USDEUR": 0.9}}}
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def file_provider(tmp_path):
+    path = tmp_path / "rates.json"
+    path.write_text(json.dumps({"base": "EUR", "date": "2026-10-16", "rates": {"USD": 1.08, "RUB": 100.0}}))
+    return FileRatesProvider(str(path))
+
+
+def test_snapshot_provider_rejects_timeframe(file_provider):
+    assert file_provider.supports("live")
+    assert not file_provider.supports("timeframe")
+    with pytest.raises(UnsupportedEndpointError):
+        file_provider.get("timeframe", {"start_date": "2026-10-01", "end_date": "2026-10-02"})
+
+
+def test_hedged_provider_routes_to_provider_that_supports_endpoint(file_provider):
+    history = _HistoryProvider()
+    hedged = HedgedProvider([("file", file_provider), ("history", history)], hedge_delay=0.01)
+    try:
+        assert hedged.supports("timeframe")
+        data = hedged.get("timeframe", {"source": "USD"}, required=("quotes",))
+        assert data["quotes"] == {"2026-10-01": {"USDEUR": 0.9}}
+        assert history.calls == ["timeframe"]
+        # Неподдерживающий источник не запрашивался и не считается отказавшим
+        assert hedged.stats()["file"] == {"requests": 0, "wins": 0, "failures": 0}
+
+        live = hedged.get("live", {"source": "EUR", "currencies": "USD"})
+        assert live["quotes"] == {"EURUSD": pytest.approx(1.08)}
+        assert history.calls == ["timeframe"]
+    finally:
+        hedged.close()
+
+
+def test_hedged_provider_without_history_raises(file_provider):
+    hedged = HedgedProvider([("file", file_provider)], hedge_delay=0.01)
+    try:
+        assert not hedged.supports("timeframe")
+        with pytest.raises(UnsupportedEndpointError):
+            hedged.get("timeframe")
+    finally:
+        hedged.close()
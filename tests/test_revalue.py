@@ -0,0 +1,76 @@
+import pytest
+
+RATE = 0.4
+
+
+def _make_trip(db, rate_policy):
+    trip_id = db.create_trip(1, "Поездка", "RUB", "EUR", RATE, 1000.0, 400.0, 0, 80, rate_policy)
+    db.add_trip_currency(trip_id, "USD", 100.0, 0.5)
+    db.record_expense(trip_id, 1, 100.0, 100.0 / RATE, "EUR", "RUB")
+    db.record_expense(trip_id, 2, 20.0, 20.0 / 0.5, "USD", "RUB")
+    return trip_id
+
+
+def _market_rates(db, trip_id, home_per_unit):
+    # Курсы "на дату покупки" для всех сочетаний, которые нужны переоценке
+    return [(currency, home, day, home_per_unit[currency])
+            for currency, home, day in db.get_expense_rate_keys(trip_id)]
+
+
+def _amounts_home(db, trip_id):
+    return dict(db.get_connection().execute(
+        'SELECT currency_target, amount_home FROM expenses WHERE trip_id = ?', (trip_id,)
+    ).fetchall())
+
+
+def _trip(db, trip_id):
+    return db.get_connection().execute('SELECT * FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
+
+
+def test_legacy_pinned_policy_is_not_a_manual_pin(db):
+    # Путешествия до миграции получили политику 'pinned', но курс вручную никто не задавал
+    trip_id = _make_trip(db, db.RATE_POLICY_AUTO)
+    db.set_trip_rate_policy(trip_id, db.RATE_POLICY_PINNED)
+
+    result = db.revalue_expenses(trip_id, _market_rates(db, trip_id, {"EUR": 3.0, "USD": 2.5}))
+
+    assert result['skipped_currencies'] == []
+    assert result['updated'] == 2
+    assert _amounts_home(db, trip_id) == pytest.approx({"EUR": 300.0, "USD": 50.0})
+
+
+def test_manually_pinned_currency_is_skipped_unless_forced(db):
+    trip_id = _make_trip(db, db.RATE_POLICY_AUTO)
+    db.set_trip_currency_rate(trip_id, "USD", 0.5)
+    rates = _market_rates(db, trip_id, {"EUR": 3.0, "USD": 2.5})
+
+    result = db.revalue_expenses(trip_id, rates)
+    assert result['skipped_currencies'] == ["USD"]
+    assert _amounts_home(db, trip_id) == pytest.approx({"EUR": 300.0, "USD": 40.0})
+
+    result = db.revalue_expenses(trip_id, rates, include_pinned=True)
+    assert result['skipped_currencies'] == []
+    assert _amounts_home(db, trip_id) == pytest.approx({"EUR": 300.0, "USD": 50.0})
+
+
+def test_trip_created_with_manual_rate_skips_target_currency(db):
+    trip_id = _make_trip(db, db.RATE_POLICY_PINNED)
+    result = db.revalue_expenses(trip_id, _market_rates(db, trip_id, {"EUR": 3.0, "USD": 2.5}))
+    assert result['skipped_currencies'] == ["EUR"]
+    assert _amounts_home(db, trip_id) == pytest.approx({"EUR": 250.0, "USD": 50.0})
+
+
+def test_home_balance_follows_one_definition_after_setrate_and_revalue(db):
+    trip_id = _make_trip(db, db.RATE_POLICY_AUTO)
+    db.set_trip_currency_rate(trip_id, "EUR", 0.5)
+    db.revalue_expenses(trip_id, _market_rates(db, trip_id, {"EUR": 3.0, "USD": 2.5}), include_pinned=True)
+
+    trip = _trip(db, trip_id)
+    assert trip['target_balance'] == pytest.approx(300.0)
+    assert trip['home_balance'] == pytest.approx(trip['target_balance'] / trip['exchange_rate'])
+
+
+def test_revalue_of_deleted_trip(db):
+    trip_id = _make_trip(db, db.RATE_POLICY_AUTO)
+    db.delete_trip(trip_id)
+    assert db.revalue_expenses(trip_id, []) is None
@@ -0,0 +1,122 @@
+import pytest
+
+import state_store
+
+
+class _Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return _Clock()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, db, clock):
+    if request.param == "memory":
+        return state_store.MemoryStateStore(maxsize=10, ttl=60, clock=clock)
+    return state_store.SQLiteStateStore(ttl=60, clock=clock)
+
+
+def test_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        state_store.StateStore()
+
+
+def test_top_level_changes_are_saved(store):
+    store[1] = {'step': 'home_currency'}
+    store[1]['rate'] = 0.4
+    del store[1]['step']
+    assert store[1] == {'rate': 0.4}
+
+
+def test_nested_changes_are_saved(store):
+    store[1] = {'temp_expense_data': {'amount_target': 10.0}, 'history': []}
+
+    store[1]['temp_expense_data']['category_id'] = 3
+    store[1]['history'].append({'page': 1})
+    store[1]['history'][0]['page'] = 2
+    state = store[1]
+    state.setdefault('temp_expense_data', {})['amount_home'] = 25.0
+    state['new'] = {}
+    state['new']['key'] = 'value'
+
+    assert store[1] == {
+        'temp_expense_data': {'amount_target': 10.0, 'category_id': 3, 'amount_home': 25.0},
+        'history': [{'page': 2}],
+        'new': {'key': 'value'},
+    }
+
+
+def test_state_round_trips_with_key_types(store):
+    state = {
+        'step': 'edit',
+        'budgets': {1: 100.0, 2: 250.5},
+        'pages': [[1, 2], {'cursor': None, 'done': True}],
+        'nested': {7: {'name': 'Еда'}},
+        'clash': {state_store._ITEMS_KEY: 1},
+    }
+    store[42] = state
+    assert store[42] == state
+    assert list(store[42]['budgets']) == [1, 2]
+
+
+def test_stored_state_is_a_copy(store):
+    original = {'data': {'a': 1}}
+    store[1] = original
+    original['data']['a'] = 2
+    loaded = store.get(1)
+    dict.__setitem__(loaded['data'], 'a', 3)  # изменение в обход отслеживания не сохраняется
+    assert store[1] == {'data': {'a': 1}}
+
+
+def test_ttl_expiry_mid_flow(store, clock):
+    store[1] = {'step': 'manual_rate'}
+    clock.now += 30
+    store[1]['rate'] = 0.5  # изменение продлевает жизнь состояния
+    clock.now += 45
+    assert store[1] == {'step': 'manual_rate', 'rate': 0.5}
+
+    clock.now += 61
+    assert 1 not in store
+    assert store.get(1) is None
+    with pytest.raises(state_store.StateExpiredError):
+        store[1]['step']
+    with pytest.raises(KeyError):
+        store[1]
+    del store[1]  # завершение истекшего диалога не падает
+
+
+def test_memory_store_evicts_least_recently_used(clock):
+    store = state_store.MemoryStateStore(maxsize=2, ttl=60, clock=clock)
+    store[1] = {'step': 'a'}
+    store[2] = {'step': 'b'}
+    assert store[1]['step'] == 'a'  # 1 использован недавно, вытеснится 2
+    store[3] = {'step': 'c'}
+
+    assert 2 not in store
+    assert store[1] == {'step': 'a'}
+    assert store[3] == {'step': 'c'}
+    assert store.stats()['evictions'] == 1
+
+
+def test_sqlite_store_purges_expired_rows(db, clock):
+    store = state_store.SQLiteStateStore(ttl=60, clock=clock)
+    store[1] = {'step': 'a'}
+    clock.now += 30
+    store[2] = {'step': 'b'}
+    clock.now += 45
+
+    assert store.purge_expired() == 1
+    assert db.get_fsm_state(1) is None
+    assert store[2] == {'step': 'b'}
+
+
+def test_sqlite_store_survives_restart(db, clock):
+    state_store.SQLiteStateStore(ttl=60, clock=clock)[5] = {'budgets': {3: 10.0}}
+    assert state_store.SQLiteStateStore(ttl=60, clock=clock)[5] == {'budgets': {3: 10.0}}
@@ -0,0 +1,87 @@
+import threading
+
+USER_ID = 1
+
+
+def _make_trip(db):
+    return db.create_trip(USER_ID, "Поездка", "RUB", "EUR", 0.01, 10000.0, 100.0, 0, 80)
+
+
+def _hits(db):
+    return db.get_trip_cache_stats()["hits"]
+
+
+def test_active_trip_is_cached(db):
+    trip_id = _make_trip(db)
+    assert db.get_active_trip(USER_ID)["target_balance"] == 100.0
+
+    # Запись в обход потока-писателя кэш не сбрасывает — значит, второе чтение пришло из кэша
+    conn = db.get_connection()
+    conn.execute('UPDATE trips SET target_balance = 1 WHERE trip_id = ?', (trip_id,))
+    conn.commit()
+    hits = _hits(db)
+    assert db.get_active_trip(USER_ID)["target_balance"] == 100.0
+    assert _hits(db) == hits + 1
+
+    db.invalidate_active_trips(trip_id=trip_id)
+    assert db.get_active_trip(USER_ID)["target_balance"] == 1.0
+
+
+def test_cached_trip_is_a_copy(db):
+    _make_trip(db)
+    trip = db.get_active_trip(USER_ID)
+    trip["target_balance"] = 0
+    trip["currencies"].clear()
+    trip = db.get_active_trip(USER_ID)
+    assert trip["target_balance"] == 100.0
+    assert len(trip["currencies"]) == 1
+
+
+def test_write_invalidates_before_future_resolves(db):
+    trip_id = _make_trip(db)
+    assert db.get_active_trip(USER_ID)["target_balance"] == 100.0
+
+    # Держим поток-писатель, чтобы колбэк гарантированно был добавлен до завершения записи
+    release = threading.Event()
+    blocker = db.submit_write(lambda cursor: release.wait(5))
+    future = db.submit_write(db._apply_balance_delta, trip_id, "EUR", -30.0, -3000.0)
+    seen = []
+    future.add_done_callback(lambda _: seen.append(db.get_active_trip(USER_ID)["target_balance"]))
+    release.set()
+    blocker.result()
+    future.result()
+
+    assert seen == [70.0]
+    assert db.get_active_trip(USER_ID)["target_balance"] == 70.0
+
+
+def test_write_invalidates_only_its_trip(db):
+    _make_trip(db)
+    other_trip = db.create_trip(2, "Другая", "RUB", "USD", 0.011, 10000.0, 110.0, 0, 80)
+    db.get_active_trip(USER_ID)
+    db.get_active_trip(2)
+
+    db.set_trip_currency_rate(other_trip, "USD", 0.012)
+    hits = _hits(db)
+    assert db.get_active_trip(USER_ID)["exchange_rate"] == 0.01
+    assert _hits(db) == hits + 1
+    assert db.get_active_trip(2)["exchange_rate"] == 0.012
+    assert _hits(db) == hits + 1
+
+
+def test_read_racing_a_write_is_not_cached(db, monkeypatch):
+    trip_id = _make_trip(db)
+    get_connection = db.get_connection
+
+    def write_during_read():
+        # Запись завершается после того, как чтение запомнило поколение кэша
+        monkeypatch.setattr(db, "get_connection", get_connection)
+        db.adjust_balance(trip_id, "EUR", -30.0, -3000.0)
+        return get_connection()
+
+    monkeypatch.setattr(db, "get_connection", write_during_read)
+    db.get_active_trip(USER_ID)
+
+    misses = db.get_trip_cache_stats()["misses"]
+    db.get_active_trip(USER_ID)
+    assert db.get_trip_cache_stats()["misses"] == misses + 1
@@ -0,0 +1,151 @@
+import pytest
+
+HOME_BALANCE = 1000.0
+RATE = 0.4
+NEW_RATE = 0.5
+
+
+def _make_trip(db, rate_policy="pinned"):
+    trip_id = db.create_trip(1, "Поездка", "RUB", "EUR", RATE, HOME_BALANCE, HOME_BALANCE * RATE, 0, 80, rate_policy)
+    db.add_trip_currency(trip_id, "USD", 100.0, 0.44)
+    db.set_category_budget(trip_id, 1, 1000.0, "RUB")
+    db.set_category_budget(trip_id, 2, 1000.0, "RUB")
+    for amount, category_id in ((120.0, 1), (250.0, 2), (474.0, 1)):
+        db.record_expense(trip_id, category_id, amount, amount / RATE, "EUR", "RUB")
+    db.record_expense(trip_id, 2, 22.0, 22.0 / 0.44, "USD", "RUB")
+    return trip_id
+
+
+def _trip(db, trip_id):
+    return db.get_connection().execute('SELECT * FROM trips WHERE trip_id = ?', (trip_id,)).fetchone()
+
+
+def _currency(db, trip_id, currency):
+    return db.get_connection().execute(
+        'SELECT * FROM trip_currencies WHERE trip_id = ? AND currency_code = ?', (trip_id, currency)
+    ).fetchone()
+
+
+def _expenses(db, trip_id, currency):
+    rows = db.get_connection().execute(
+        'SELECT amount_target, amount_home FROM expenses WHERE trip_id = ? AND currency_target = ?',
+        (trip_id, currency),
+    ).fetchall()
+    return [(row['amount_target'], row['amount_home']) for row in rows]
+
+
+def _assert_aggregates_match_expenses(db, trip_id):
+    conn = db.get_connection()
+    spent = dict(conn.execute(
+        'SELECT category_id, spent_amount FROM category_budgets WHERE trip_id = ?', (trip_id,)
+    ).fetchall())
+    expected = dict(conn.execute(
+        'SELECT category_id, SUM(amount_home) FROM expenses WHERE trip_id = ? GROUP BY category_id', (trip_id,)
+    ).fetchall())
+    assert spent == pytest.approx(expected)
+    total = conn.execute('SELECT SUM(amount_home) FROM expenses WHERE trip_id = ?', (trip_id,)).fetchone()[0]
+    assert db.get_trip_total_spent(trip_id) == pytest.approx(total)
+
+
+def test_set_rate_without_recompute_keeps_expenses(db):
+    trip_id = _make_trip(db)
+    before = _expenses(db, trip_id, "EUR")
+
+    result = db.set_trip_currency_rate(trip_id, "EUR", NEW_RATE)
+
+    assert result['updated'] == 0
+    assert result['total_after'] == pytest.approx(result['total_before'])
+    assert _expenses(db, trip_id, "EUR") == before
+    trip = _trip(db, trip_id)
+    assert trip['exchange_rate'] == NEW_RATE
+    assert trip['target_balance'] == pytest.approx(400.0 - 844.0)
+    assert trip['home_balance'] == pytest.approx(trip['target_balance'] / NEW_RATE)
+    _assert_aggregates_match_expenses(db, trip_id)
+
+
+def test_set_rate_with_recompute_rederives_amount_home(db):
+    trip_id = _make_trip(db)
+    usd_before = _expenses(db, trip_id, "USD")
+
+    result = db.set_trip_currency_rate(trip_id, "EUR", NEW_RATE, recompute_expenses=True)
+
+    assert result['updated'] == 3
+    for amount_target, amount_home in _expenses(db, trip_id, "EUR"):
+        assert amount_home == pytest.approx(amount_target / NEW_RATE)
+    assert _expenses(db, trip_id, "USD") == usd_before
+    assert result['total_after'] == pytest.approx(844.0 / NEW_RATE + 22.0 / 0.44)
+    trip = _trip(db, trip_id)
+    assert trip['home_balance'] == pytest.approx(trip['target_balance'] / NEW_RATE)
+    _assert_aggregates_match_expenses(db, trip_id)
+
+
+def test_set_rate_of_secondary_currency_leaves_trip_rate(db):
+    trip_id = _make_trip(db)
+    trip_before = _trip(db, trip_id)
+
+    result = db.set_trip_currency_rate(trip_id, "USD", 0.55, recompute_expenses=True)
+
+    assert result['updated'] == 1
+    assert _expenses(db, trip_id, "USD") == [(22.0, pytest.approx(22.0 / 0.55))]
+    trip = _trip(db, trip_id)
+    assert trip['exchange_rate'] == trip_before['exchange_rate']
+    assert trip['home_balance'] == pytest.approx(trip_before['home_balance'])
+    assert _currency(db, trip_id, "USD")['exchange_rate_to_home'] == 0.55
+    _assert_aggregates_match_expenses(db, trip_id)
+
+
+def test_set_rate_of_unknown_currency(db):
+    trip_id = _make_trip(db)
+    assert db.set_trip_currency_rate(trip_id, "JPY", 150.0) is None
+    with pytest.raises(ValueError):
+        db.set_trip_currency_rate(trip_id, "EUR", 0)
+
+
+def test_manual_rate_pins_only_its_currency(db):
+    trip_id = _make_trip(db, db.RATE_POLICY_AUTO)
+    assert not _currency(db, trip_id, "EUR")['rate_pinned']
+
+    db.set_trip_currency_rate(trip_id, "USD", 0.55)
+
+    assert _trip(db, trip_id)['rate_policy'] == db.RATE_POLICY_AUTO
+    assert _currency(db, trip_id, "USD")['rate_pinned']
+    assert not _currency(db, trip_id, "EUR")['rate_pinned']
+    assert db.get_auto_rate_pairs() == [("RUB", "EUR")]
+
+    assert db.apply_auto_rates({("RUB", "EUR"): 0.45, ("RUB", "USD"): 0.6}) == 1
+    assert _currency(db, trip_id, "USD")['exchange_rate_to_home'] == 0.55
+    assert _currency(db, trip_id, "EUR")['exchange_rate_to_home'] == 0.45
+    assert _trip(db, trip_id)['exchange_rate'] == 0.45
+
+
+def test_manual_target_rate_keeps_secondary_currencies_on_auto(db):
+    trip_id = _make_trip(db, db.RATE_POLICY_AUTO)
+
+    db.set_trip_currency_rate(trip_id, "EUR", NEW_RATE)
+
+    assert _trip(db, trip_id)['rate_policy'] == db.RATE_POLICY_AUTO
+    assert db.get_auto_rate_pairs() == [("RUB", "USD")]
+    assert db.apply_auto_rates({("RUB", "EUR"): 0.45, ("RUB", "USD"): 0.6}) == 1
+    assert _trip(db, trip_id)['exchange_rate'] == NEW_RATE
+    assert _currency(db, trip_id, "EUR")['exchange_rate_to_home'] == NEW_RATE
+    assert _currency(db, trip_id, "USD")['exchange_rate_to_home'] == 0.6
+
+
+def test_trip_created_with_manual_rate_pins_target_currency(db):
+    trip_id = _make_trip(db, db.RATE_POLICY_PINNED)
+    assert _currency(db, trip_id, "EUR")['rate_pinned']
+    assert not _currency(db, trip_id, "USD")['rate_pinned']
+
+
+def test_auto_refresh_rederives_home_balance_like_manual_change(db):
+    auto_trip = _make_trip(db, db.RATE_POLICY_AUTO)
+    db.apply_auto_rates({("RUB", "EUR"): NEW_RATE})
+    auto = _trip(db, auto_trip)
+
+    manual_trip = _make_trip(db, db.RATE_POLICY_AUTO)
+    db.set_trip_currency_rate(manual_trip, "EUR", NEW_RATE)
+    manual = _trip(db, manual_trip)
+
+    assert auto['exchange_rate'] == manual['exchange_rate'] == NEW_RATE
+    assert auto['home_balance'] == pytest.approx(auto['target_balance'] / NEW_RATE)
+    assert auto['home_balance'] == pytest.approx(manual['home_balance'])